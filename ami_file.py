@@ -1,8 +1,31 @@
 import sys
 import os
+import io
 import json
 import time
+import math
+import shutil
+import tempfile
+import hashlib
+import zlib
+import struct
+import re
+import abc
+import collections
+import argparse
+import zipfile
+import tarfile
+import multiprocessing
+import asyncio
+import urllib.parse
+import urllib.request
+import http.server
+import socket
+import uuid
+import hmac
 import concurrent.futures
+import queue
+import tkinter as tk
 from tkinter import filedialog, messagebox
 import customtkinter as ctk
 import threading
@@ -23,14 +46,20 @@ HAVE_VIPS = True
 
 # Пробуем импортировать библиотеки с обработкой ошибок
 try:
-    from PIL import Image as PILImage
+    from PIL import Image as PILImage, ImageOps
 except ImportError:
     HAVE_PIL = False
     print("PIL not available")
 
+# NumPy нужен OpenCV, а также оценке качества и без OpenCV
+HAVE_NUMPY = True
 try:
-    import cv2
     import numpy as np
+except ImportError:
+    HAVE_NUMPY = False
+
+try:
+    import cv2
 except ImportError:
     HAVE_CV2 = False
     print("OpenCV not available")
@@ -49,6 +78,14 @@ except ImportError:
     HAVE_VIPS = False
     print("Pyvips not available")
 
+# Необязательная библиотека для событий файловой системы (inotify/ReadDirectoryChangesW)
+HAVE_WATCHDOG = True
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    HAVE_WATCHDOG = False
+
 # Проверяем и выводим информацию о доступных библиотеках
 print(f"Available libraries: PIL={HAVE_PIL}, OpenCV={HAVE_CV2}, Wand={HAVE_WAND}, Vips={HAVE_VIPS}")
 print(f"ImageMagick path: {IMAGEMAGICK_PATH}")
@@ -66,763 +103,5006 @@ if not any([HAVE_PIL, HAVE_CV2, HAVE_WAND, HAVE_VIPS]):
     )
     sys.exit(1)
 
-# Поддерживаемые форматы для каждой библиотеки
-SUPPORTED_FORMATS = {
-    'wand': {
-        'input': {'png', 'jpg', 'jpeg', 'bmp', 'gif', 'tiff', 'webp', 'svg', 
-                 'pdf', 'eps', 'psd', 'heic', 'avif', 'jpegxl', 'ico', 'ppm',
-                 'rla', 'pcx', 'pnm', 'xbm', 'tga', 'djvu'},
-        'output': {'png', 'jpg', 'jpeg', 'bmp', 'gif', 'tiff', 'webp', 'svg', 
-                 'pdf', 'eps', 'psd', 'heic', 'avif', 'jpegxl', 'ico', 'ppm',
-                 'rla', 'pcx', 'pnm', 'xbm', 'tga', 'djvu'}
-    },
-    'pil': {
-        'input': {'png', 'jpg', 'jpeg', 'bmp', 'gif', 'tiff', 'webp', 'ico', 'ppm'},
-        'output': {'png', 'jpg', 'jpeg', 'bmp', 'gif', 'tiff', 'webp', 'ico'}
-    },
-    'cv2': {
-        'input': {'png', 'jpg', 'jpeg', 'bmp', 'tiff', 'webp'},
-        'output': {'png', 'jpg', 'jpeg', 'bmp', 'tiff', 'webp'}
-    },
-    'vips': {
-        'input': {'png', 'jpg', 'jpeg', 'webp', 'tiff', 'gif', 'pdf', 'svg', 'heif', 'avif'},
-        'output': {'png', 'jpg', 'jpeg', 'webp', 'tiff', 'gif', 'heif', 'avif'}
-    }
-}
-
 class ProcessingLibrary:
     WAND = "wand"
     PIL = "pil"
     CV2 = "cv2"
     VIPS = "vips"
 
-def convert_image(args):
-    """Оптимизированная функция конвертации с резервными вариантами"""
-    input_path, output_path, output_format, needs_alpha_removal = args
+class EncoderProfile:
+    DEFAULT = "default"    # без профиля: прежние параметры каждой библиотеки
+    FASTEST = "fastest"
+    BALANCED = "balanced"
+    SMALLEST = "smallest"
+
+# Общие параметры профилей: качество и усилие кодера (0 - быстрее всего, 1 - плотнее всего)
+ENCODER_PROFILES = {
+    EncoderProfile.FASTEST: {'quality': 90, 'effort': 0.0},
+    EncoderProfile.BALANCED: {'quality': 90, 'effort': 0.5},
+    EncoderProfile.SMALLEST: {'quality': 82, 'effort': 1.0},
+}
+
+# Разные имена одного и того же формата
+FORMAT_ALIASES = {'jpg': 'jpeg', 'jpe': 'jpeg', 'tif': 'tiff', 'heic': 'heif', 'jxl': 'jpegxl'}
+
+def canonical_format(fmt):
+    """Приводит имя формата или расширение к одному написанию: jpg -> jpeg, tif -> tiff"""
+    fmt = fmt.lower().lstrip('.')
+    return FORMAT_ALIASES.get(fmt, fmt)
+
+def encoder_options(backend, output_format, profile=None, quality=None):
+    """Переводит профиль кодера в параметры сохранения конкретной библиотеки.
     
-    # Пробуем разные библиотеки по порядку
-    errors = []
+    Без профиля и качества возвращает прежние значения по умолчанию.
+    Для cv2 возвращает список параметров imwrite, для остальных - словарь.
+    """
+    fmt = canonical_format(output_format)
     
-    # 1. Попытка использовать PIL
-    if HAVE_PIL:
+    if profile is None and quality is None:
+        if backend == 'vips' and fmt in ('jpeg', 'webp'):
+            return {'Q': 95}
+        return [] if backend == 'cv2' else {}
+    
+    settings = ENCODER_PROFILES.get(profile or EncoderProfile.BALANCED, ENCODER_PROFILES[EncoderProfile.BALANCED])
+    q = int(quality if quality is not None else settings['quality'])
+    effort = settings['effort']
+    zlib_level = 1 + round(effort * 8)
+    tiff_index = round(effort * 2)
+    
+    if backend == 'pil':
+        return {
+            'jpeg': {'quality': q, 'optimize': effort > 0, 'progressive': effort >= 1},
+            'webp': {'quality': q, 'method': round(effort * 6)},
+            'png': {'compress_level': zlib_level, 'optimize': effort >= 1},
+            'avif': {'quality': q, 'speed': round(10 - effort * 8)},
+            'heif': {'quality': q},
+            'jpegxl': {'quality': q, 'effort': 1 + round(effort * 8)},
+            'tiff': {'compression': ['raw', 'tiff_lzw', 'tiff_adobe_deflate'][tiff_index]},
+            'gif': {'optimize': effort > 0},
+        }.get(fmt, {})
+    
+    if backend == 'cv2':
+        params = {
+            'jpeg': [cv2.IMWRITE_JPEG_QUALITY, q,
+                     cv2.IMWRITE_JPEG_OPTIMIZE, int(effort > 0),
+                     cv2.IMWRITE_JPEG_PROGRESSIVE, int(effort >= 1)],
+            'webp': [cv2.IMWRITE_WEBP_QUALITY, q],
+            'png': [cv2.IMWRITE_PNG_COMPRESSION, zlib_level],
+            'tiff': [cv2.IMWRITE_TIFF_COMPRESSION, [1, 5, 8][tiff_index]],
+        }.get(fmt, [])
+        # Параметры AVIF есть только в OpenCV 4.8+
+        if fmt == 'avif' and hasattr(cv2, 'IMWRITE_AVIF_QUALITY'):
+            params = [cv2.IMWRITE_AVIF_QUALITY, q, cv2.IMWRITE_AVIF_SPEED, round(10 - effort * 8)]
+        return params
+    
+    if backend == 'wand':
+        if fmt == 'png':
+            # Для PNG десятки - уровень zlib, единицы - фильтр (5 - адаптивный)
+            return {'quality': zlib_level * 10 + 5, 'options': {}}
+        return {
+            'jpeg': {'quality': q, 'options': {'jpeg:optimize-coding': 'true' if effort > 0 else 'false'}},
+            'webp': {'quality': q, 'options': {'webp:method': str(round(effort * 6))}},
+            'avif': {'quality': q, 'options': {'heic:speed': str(round(10 - effort * 8))}},
+            'heif': {'quality': q, 'options': {'heic:speed': str(round(10 - effort * 8))}},
+            'jpegxl': {'quality': q, 'options': {'jxl:effort': str(1 + round(effort * 8))}},
+            'tiff': {'compression': ['no', 'lzw', 'zip'][tiff_index], 'options': {}},
+        }.get(fmt, {'options': {}})
+    
+    if backend == 'vips':
+        return {
+            'jpeg': {'Q': q, 'optimize_coding': effort > 0, 'interlace': effort >= 1},
+            'webp': {'Q': q, 'effort': round(effort * 6)},
+            'png': {'compression': zlib_level},
+            'avif': {'Q': q, 'effort': round(effort * 9)},
+            'heif': {'Q': q, 'effort': round(effort * 9)},
+            'tiff': {'compression': ['none', 'lzw', 'deflate'][tiff_index]},
+            'gif': {'effort': 1 + round(effort * 9)},
+        }.get(fmt, {})
+    
+    return {}
+
+def _apply_wand_encoder(img, output_format, profile=None, quality=None):
+    """Настраивает кодер Wand по профилю"""
+    settings = encoder_options('wand', output_format, profile, quality)
+    if 'quality' in settings:
+        img.compression_quality = settings['quality']
+    if 'compression' in settings:
+        img.compression = settings['compression']
+    for key, value in settings.get('options', {}).items():
+        img.options[key] = value
+
+def _benchmark_decode(data, output_format):
+    """(бэкенд, изображение) первого бэкенда, который декодирует файл для этого формата"""
+    errors = []
+    for backend in route_backends(sniff_image_format(data), output_format):
         try:
-            with PILImage.open(input_path) as img:
-                if needs_alpha_removal and img.mode == 'RGBA':
-                    background = PILImage.new('RGB', img.size, (255, 255, 255))
-                    background.paste(img, mask=img.split()[3])
-                    background.save(output_path, format=output_format.upper())
-                else:
-                    img.save(output_path, format=output_format.upper())
-            return True
+            return backend, backend.decode(data, sniff_image_format(data))
         except Exception as e:
-            errors.append(f"PIL: {str(e)}")
+            errors.append(f"{backend.label}: {str(e)}")
+    raise ValueError("Failed to decode using any method:\n" + "\n".join(errors))
+
+def benchmark_profiles(input_paths, output_format, profiles=None):
+    """Кодирует файлы каждым профилем в памяти и считает размер и время кодирования.
     
-    # 2. Попытка использовать OpenCV
-    if HAVE_CV2:
+    Файл декодируется один раз вне замера (PIL или первым подходящим
+    бэкендом), и замеряется только кодирование.
+    """
+    profiles = profiles or list(ENCODER_PROFILES)
+    rows = {name: {'profile': name, 'files': 0, 'bytes': 0, 'seconds': 0.0, 'errors': 0} for name in profiles}
+    needs_alpha_removal = output_format in ['jpg', 'jpeg', 'bmp']
+    input_bytes = 0
+    
+    for path in input_paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        input_bytes += len(data)
+        
+        image = None
+        if HAVE_PIL:
+            try:
+                image = PILImage.open(io.BytesIO(data))
+                image.load()
+                if needs_alpha_removal and image.mode == 'RGBA':
+                    background = PILImage.new('RGB', image.size, (255, 255, 255))
+                    background.paste(image, mask=image.split()[3])
+                    image = background
+            except Exception:
+                image = None
+        
+        fallback = None
+        for name in profiles:
+            row = rows[name]
+            try:
+                started = time.perf_counter()
+                try:
+                    if image is None:
+                        raise ValueError("not decoded by PIL")
+                    buffer = io.BytesIO()
+                    image.save(buffer, format=_pil_format_name(output_format),
+                               **encoder_options('pil', output_format, name))
+                    size = buffer.tell()
+                except Exception:
+                    # Другой бэкенд декодирует файл один раз, до замера
+                    if fallback is None:
+                        fallback = _benchmark_decode(data, output_format)
+                    backend, decoded = fallback
+                    started = time.perf_counter()
+                    size = len(backend.encode(decoded, output_format, None, needs_alpha_removal, name))
+                row['seconds'] += time.perf_counter() - started
+                row['bytes'] += size
+                row['files'] += 1
+            except Exception:
+                row['errors'] += 1
+        if fallback is not None:
+            fallback[0].release(fallback[1])
+    
+    return input_bytes, [rows[name] for name in profiles]
+
+def format_benchmark_summary(input_bytes, rows):
+    """Таблица итогов бенчмарка профилей"""
+    lines = [f"{'profile':<10} {'files':>6} {'bytes':>14} {'ratio':>7} {'encode s':>10} {'errors':>7}"]
+    for row in rows:
+        ratio = row['bytes'] / input_bytes if input_bytes else 0
+        lines.append(
+            f"{row['profile']:<10} {row['files']:>6} {row['bytes']:>14,} {ratio:>7.1%} "
+            f"{row['seconds']:>10.3f} {row['errors']:>7}"
+        )
+    lines.append(f"{'input':<10} {'':>6} {input_bytes:>14,}")
+    return "\n".join(lines)
+
+class MetadataPolicy:
+    KEEP = "keep"                  # EXIF, XMP и ICC переносятся как есть
+    STRIP = "strip"                # все метаданные удаляются
+    ICC = "icc"                    # остается только цветовой профиль
+    ORIENT_STRIP = "orient_strip"  # поворот по EXIF, затем удаление всего
+
+METADATA_POLICIES = (MetadataPolicy.KEEP, MetadataPolicy.STRIP, MetadataPolicy.ICC, MetadataPolicy.ORIENT_STRIP)
+
+def apply_metadata_policy(image, policy):
+    """Приводит изображение PIL или pyvips к политике метаданных.
+    
+    Возвращает (изображение, дополнительные параметры сохранения).
+    """
+    if HAVE_PIL and isinstance(image, PILImage.Image):
+        if policy == MetadataPolicy.ORIENT_STRIP:
+            return ImageOps.exif_transpose(image), {}
+        if policy == MetadataPolicy.STRIP:
+            return image, {}
+        # PIL не переносит метаданные сам - передаем их явно
+        keys = ('icc_profile', 'exif', 'xmp') if policy == MetadataPolicy.KEEP else ('icc_profile',)
+        return image, {key: image.info[key] for key in keys if image.info.get(key)}
+    
+    if policy == MetadataPolicy.ORIENT_STRIP:
+        return image.autorot(), {'strip': True}
+    if policy == MetadataPolicy.STRIP:
+        return image, {'strip': True}
+    if policy == MetadataPolicy.ICC:
+        fields = [name for name in image.get_fields()
+                  if name in ('exif-data', 'xmp-data', 'iptc-data') or name.startswith('exif-')]
+        if fields:
+            image = image.copy()
+            for name in fields:
+                image.remove(name)
+    return image, {}
+
+def _apply_wand_metadata(img, policy):
+    """Приводит изображение Wand к политике метаданных (ImageMagick по умолчанию сохраняет все)"""
+    if policy == MetadataPolicy.KEEP:
+        return
+    if policy == MetadataPolicy.ORIENT_STRIP:
+        img.auto_orient()
+    icc = img.profiles['icc'] if policy == MetadataPolicy.ICC else None
+    img.strip()
+    if icc:
+        img.profiles['icc'] = icc
+
+def _jpeg_header_segments(data):
+    """Перебирает сегменты JPEG до начала сжатых данных: (маркер, начало, конец)"""
+    if data[:2] != b'\xff\xd8':
+        raise ValueError("Not a JPEG file")
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError("Corrupt JPEG marker")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Байты-заполнители перед маркером
+            pos += 1
+            continue
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            yield marker, pos, pos + 2
+            pos += 2
+            continue
+        end = pos + 2 + int.from_bytes(data[pos + 2:pos + 4], 'big')
+        yield marker, pos, end
+        if marker == 0xDA:
+            return
+        pos = end
+    raise ValueError("JPEG has no image data")
+
+def _keep_jpeg_segment(marker, payload, keep_icc):
+    if marker == 0xE0:
+        # JFIF оставляем, JFXX с миниатюрой - нет
+        return payload.startswith(b'JFIF\0')
+    if marker == 0xEE:
+        # Adobe APP14 определяет цветовое преобразование - без него меняются цвета
+        return True
+    if marker == 0xE2 and payload.startswith(b'ICC_PROFILE\0'):
+        return keep_icc
+    return not (0xE0 <= marker <= 0xEF or marker == 0xFE)
+
+def strip_jpeg_metadata(data, keep_icc=False):
+    """Удаляет из JPEG сегменты метаданных без декодирования пикселей"""
+    parts = [b'\xff\xd8']
+    for marker, start, end in _jpeg_header_segments(data):
+        if marker == 0xDA:
+            # Сжатые данные копируем до EOI, хвост (MPF-превью и мусор) отбрасываем
+            eoi = data.find(b'\xff\xd9', end)
+            parts.append(data[start:] if eoi < 0 else data[start:eoi + 2])
+        elif _keep_jpeg_segment(marker, data[start + 4:end], keep_icc):
+            parts.append(data[start:end])
+    return b''.join(parts)
+
+def jpeg_exif_orientation(data):
+    """Читает тег Orientation из EXIF JPEG, None если его нет"""
+    for marker, start, end in _jpeg_header_segments(data):
+        if marker != 0xE1 or data[start + 4:start + 10] != b'Exif\0\0':
+            continue
+        tiff = data[start + 10:end]
+        endian = '<' if tiff[:2] == b'II' else '>'
         try:
-            img = cv2.imread(input_path, cv2.IMREAD_UNCHANGED)
-            if img is not None:
-                if needs_alpha_removal and img.shape[-1] == 4:
-                    img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
-                cv2.imwrite(output_path, img)
-                return True
-        except Exception as e:
-            errors.append(f"OpenCV: {str(e)}")
+            ifd = struct.unpack_from(endian + 'I', tiff, 4)[0]
+            for index in range(struct.unpack_from(endian + 'H', tiff, ifd)[0]):
+                tag, _, _, value = struct.unpack_from(endian + 'HHIH', tiff, ifd + 2 + index * 12)
+                if tag == 0x0112:
+                    return value
+        except struct.error:
+            return None
+        return None
+    return None
+
+def jpeg_metadata_fast_path(data, policy):
+    """Применяет политику метаданных к JPEG без перекодирования.
     
-    # 3. Попытка использовать Wand
-    if HAVE_WAND:
+    Возвращает None, если политика требует изменить пиксели (поворот по EXIF).
+    """
+    if policy == MetadataPolicy.KEEP:
+        return data
+    if policy == MetadataPolicy.ORIENT_STRIP and jpeg_exif_orientation(data) not in (None, 1):
+        return None
+    return strip_jpeg_metadata(data, keep_icc=policy == MetadataPolicy.ICC)
+
+def _needs_reencode(options):
+    """Параметры задачи, при которых файл нужно декодировать и закодировать заново.
+    
+    Выбранный профиль или качество - тоже просьба перекодировать, даже в тот же формат.
+    """
+    return bool(options.get('page') is not None or options.get('target_size') or options.get('quality_metric')
+                or options.get('transforms') or options.get('profile') or options.get('quality') is not None)
+
+def _can_repack_jpeg(input_format, output_format, options):
+    """JPEG в JPEG без перекодирования можно переупаковать без декодирования"""
+    return (input_format in ('jpg', 'jpeg') and output_format.lower() in ('jpg', 'jpeg')
+            and not _needs_reencode(options))
+
+# Результат convert_image, когда файл скопирован без перекодирования
+PASSTHROUGH = "passthrough"
+
+def _is_identity(input_format, output_format, needs_alpha_removal, options):
+    target = canonical_format(output_format)
+    if canonical_format(input_format) != target:
+        return False
+    if _needs_reencode(options):
+        return False
+    if options.get('metadata', MetadataPolicy.KEEP) != MetadataPolicy.KEEP:
+        return False
+    # В JPEG альфы не бывает, для остальных форматов ее удаление меняет пиксели
+    return not needs_alpha_removal or target == 'jpeg'
+
+def is_identity_conversion(input_path, output_format, needs_alpha_removal, options=None):
+    """Проверяет, что конвертация ничего не меняет и файл можно просто скопировать.
+    
+    Формат сверяется и по расширению, и по сигнатуре, чтобы не скопировать
+    под видом JPEG файл с неверным расширением.
+    """
+    input_format = os.path.splitext(str(input_path))[1]
+    if not _is_identity(input_format, output_format, needs_alpha_removal, options or {}):
+        return False
+    try:
+        with open(input_path, 'rb') as f:
+            sniffed = sniff_image_format(f.read(32))
+    except OSError:
+        return False
+    return sniffed is not None and canonical_format(sniffed) == canonical_format(output_format)
+
+def passthrough_copy(input_path, output_path, hardlink=False):
+    """Копирует файл без участия Python-буферов.
+    
+    copy_file_range копирует внутри ядра (и делает reflink на btrfs/xfs),
+    shutil.copyfile сам использует sendfile/fcopyfile там, где они есть.
+    """
+    if os.path.exists(output_path):
+        if os.path.samefile(input_path, output_path):
+            return
+        os.remove(output_path)
+    if hardlink:
         try:
-            with WandImage(filename=input_path) as img:
-                if needs_alpha_removal and img.alpha_channel:
-                    with Color('white') as background:
-                        img.background_color = background
-                        img.alpha_channel = 'remove'
-                img.format = output_format.upper()
-                img.save(filename=output_path)
-            return True
+            os.link(input_path, output_path)
+            return
+        except OSError:
+            # Другой диск или файловая система без жестких ссылок
+            pass
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                shutil.copystat(input_path, output_path)
+                return
+        except OSError:
+            pass
+    shutil.copy2(input_path, output_path)
+
+# Форматы с регулируемым качеством, для которых имеет смысл подбор
+LOSSY_FORMATS = {'jpg', 'jpeg', 'webp', 'avif', 'heif', 'heic', 'jpegxl'}
+
+def _encode_with_quality(image, output_format, profile=None, quality=None, save_options=None):
+    """Кодирует уже декодированное изображение PIL или pyvips в байты"""
+    if HAVE_PIL and isinstance(image, PILImage.Image):
+        buffer = io.BytesIO()
+        image.save(buffer, format=_pil_format_name(output_format),
+                   **encoder_options('pil', output_format, profile, quality), **(save_options or {}))
+        return buffer.getvalue()
+    return image.write_to_buffer(f".{output_format}", **encoder_options('vips', output_format, profile, quality),
+                                 **(save_options or {}))
+
+def _decode_for_search(source, needs_alpha_removal, page=None, transforms=None):
+    """Один раз декодирует изображение (путь или байты) для многократного кодирования"""
+    errors = []
+    if HAVE_PIL:
+        try:
+            img = PILImage.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+            if page is not None:
+                img.seek(page)
+            if transforms:
+                img = get_backend(ProcessingLibrary.PIL).transform(img, transforms)
+            img.load()
+            if needs_alpha_removal and img.mode in ('RGBA', 'LA', 'P'):
+                img = img.convert('RGBA')
+                background = PILImage.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[3])
+                img = background
+            return img
         except Exception as e:
-            errors.append(f"Wand: {str(e)}")
-    
-    # 4. Попытка использовать Pyvips
+            errors.append(f"PIL: {str(e)}")
     if HAVE_VIPS:
         try:
-            image = pyvips.Image.new_from_file(input_path)
+            load_options = {'page': page} if page is not None else {}
+            if isinstance(source, bytes):
+                image = pyvips.Image.new_from_buffer(source, "", **load_options)
+            else:
+                image = pyvips.Image.new_from_file(source, **load_options)
+            if transforms:
+                image = get_backend(ProcessingLibrary.VIPS).transform(image, transforms)
             if needs_alpha_removal and image.hasalpha():
-                # Удаляем альфа-канал
                 image = image.flatten(background=[255, 255, 255])
-            
-            # Сохраняем с учетом формата
-            if output_format.lower() in ['jpg', 'jpeg']:
-                image.jpegsave(output_path, Q=95)
-            elif output_format.lower() == 'png':
-                image.pngsave(output_path)
-            elif output_format.lower() == 'webp':
-                image.webpsave(output_path, Q=95)
-            elif output_format.lower() == 'tiff':
-                image.tiffsave(output_path)
-            else:
-                image.write_to_file(output_path)
-            return True
+            # Растр в памяти, чтобы каждая попытка не декодировала файл заново
+            return image.copy_memory()
         except Exception as e:
             errors.append(f"Vips: {str(e)}")
+    raise Exception("Failed to decode image using any method:\n" + "\n".join(errors))
+
+def encode_to_target_size(image, output_format, max_bytes, profile=None,
+                          min_quality=10, max_quality=95, max_iterations=7,
+                          metadata=MetadataPolicy.KEEP):
+    """Бинарным поиском подбирает наибольшее качество, при котором файл не больше max_bytes.
     
-    # Если все методы не сработали, возвращаем ошибку
-    return (input_path, "\n".join(errors))
+    Все попытки кодируются в памяти из одного растра. Возвращает (байты, качество),
+    качество равно None для форматов без регулировки качества.
+    """
+    image, save_options = apply_metadata_policy(image, metadata)
+    if output_format.lower() not in LOSSY_FORMATS:
+        data = _encode_with_quality(image, output_format, profile, save_options=save_options)
+        if len(data) > max_bytes:
+            raise ValueError(f"{output_format.upper()} has no quality setting; "
+                             f"result is {len(data) // 1024} KB, target {max_bytes // 1024} KB")
+        return data, None
+    
+    # Сначала проверяем максимальное качество: часто подходит сразу
+    data = _encode_with_quality(image, output_format, profile, max_quality, save_options)
+    if len(data) <= max_bytes:
+        return data, max_quality
+    
+    best = None
+    low, high = min_quality, max_quality - 1
+    for _ in range(max_iterations - 1):
+        if low > high:
+            break
+        quality = (low + high) // 2
+        data = _encode_with_quality(image, output_format, profile, quality, save_options)
+        if len(data) <= max_bytes:
+            best = (data, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+    
+    if best is None:
+        raise ValueError(f"Cannot reach {max_bytes // 1024} KB even at quality {min_quality}")
+    return best
 
-def merge_images_optimized(images, direction='horizontal', output_path=None, output_format='png'):
-    """Оптимизированная функция слияния с резервными вариантами"""
-    errors = []
+# Метрики качества и сторона уменьшенной копии, на которой они считаются
+QUALITY_METRICS = ('ssim', 'psnr')
+QUALITY_PROXY_SIZE = 512
+
+def _metric_proxy(image, size=QUALITY_PROXY_SIZE):
+    """Уменьшенная копия в оттенках серого (float64) для быстрой оценки качества"""
+    if HAVE_PIL and isinstance(image, PILImage.Image):
+        proxy = image.convert('L')
+        proxy.thumbnail((size, size), PILImage.BOX)
+        return np.asarray(proxy, dtype=np.float64)
+    if image.hasalpha():
+        image = image.flatten(background=[255, 255, 255])
+    proxy = image.thumbnail_image(size).colourspace('b-w').extract_band(0).cast('uchar')
+    return np.ndarray(buffer=proxy.write_to_memory(), dtype=np.uint8,
+                      shape=(proxy.height, proxy.width)).astype(np.float64)
+
+def _decode_candidate(data, like):
+    """Декодирует закодированную попытку той же библиотекой, что и оригинал"""
+    if HAVE_PIL and isinstance(like, PILImage.Image):
+        return PILImage.open(io.BytesIO(data))
+    return pyvips.Image.new_from_buffer(data, "")
+
+def _box_mean(values, window):
+    """Среднее по скользящему окну через интегральное изображение"""
+    integral = np.pad(values, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    return (integral[window:, window:] - integral[:-window, window:]
+            - integral[window:, :-window] + integral[:-window, :-window]) / (window * window)
+
+def compute_ssim(reference, candidate, window=7):
+    """SSIM по яркости с квадратным окном"""
+    window = max(1, min(window, *reference.shape))
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mean_x = _box_mean(reference, window)
+    mean_y = _box_mean(candidate, window)
+    var_x = _box_mean(reference * reference, window) - mean_x * mean_x
+    var_y = _box_mean(candidate * candidate, window) - mean_y * mean_y
+    covar = _box_mean(reference * candidate, window) - mean_x * mean_y
+    ssim_map = ((2 * mean_x * mean_y + c1) * (2 * covar + c2)) / \
+               ((mean_x * mean_x + mean_y * mean_y + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
+
+def compute_psnr(reference, candidate):
+    """PSNR в децибелах, для одинаковых изображений - бесконечность"""
+    mse = float(np.mean((reference - candidate) ** 2))
+    return math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+def encode_to_quality_target(image, output_format, metric='ssim', threshold=0.98, profile=None,
+                             min_quality=10, max_quality=95, max_iterations=7,
+                             metadata=MetadataPolicy.KEEP):
+    """Бинарным поиском подбирает наименьшее качество, при котором метрика не ниже порога.
     
-    # 1. Попытка использовать PIL
-    if HAVE_PIL:
+    Метрика считается на уменьшенной копии, кодирование - в памяти из одного растра.
+    Если порог недостижим, возвращается результат с max_quality.
+    Возвращает (байты, качество, значение метрики).
+    """
+    if not HAVE_NUMPY:
+        raise Exception("NumPy is required for quality-guided encoding")
+    measure = compute_ssim if metric == 'ssim' else compute_psnr
+    image, save_options = apply_metadata_policy(image, metadata)
+    reference = _metric_proxy(image)
+    
+    def attempt(quality):
+        data = _encode_with_quality(image, output_format, profile, quality, save_options)
+        candidate = _metric_proxy(_decode_candidate(data, image))
+        return data, quality, measure(reference, candidate)
+    
+    best = None
+    low, high = min_quality, max_quality
+    for _ in range(max_iterations):
+        if low > high:
+            break
+        result = attempt((low + high) // 2)
+        if result[2] >= threshold:
+            best = result
+            high = result[1] - 1
+        else:
+            low = result[1] + 1
+    
+    return best or attempt(max_quality)
+
+def format_quality_report(path, report):
+    """Строка отчета о подобранном качестве"""
+    return f"{os.path.basename(str(path))}: quality {report['quality']}, {report['metric'].upper()} {report['score']:.4f}"
+
+def _save_vips_image(image, output_path, output_format, profile=None, quality=None, **save_options):
+    """Сохраняет изображение pyvips с параметрами профиля"""
+    image.write_to_file(output_path, **encoder_options('vips', output_format, profile, quality), **save_options)
+
+# Форматы, которые проверяются у OpenCV через haveImageWriter
+CV2_PROBE_FORMATS = ('png', 'jpeg', 'bmp', 'tiff', 'webp', 'avif', 'jp2', 'ppm', 'pgm', 'pbm', 'pnm',
+                     'sr', 'ras', 'exr', 'hdr', 'pfm')
+# Форматы, которые собирает сам Ami File поверх кодеков библиотеки (пирамида DZI)
+PIPELINE_FORMATS = {'dzi'}
+# ImageMagick умеет только читать эти форматы
+WAND_READ_ONLY_FORMATS = {'djvu', 'rla'}
+# Загрузчики libvips и форматы, которые они читают
+VIPS_LOADERS = {
+    'jpegload': ('jpeg',), 'pngload': ('png',), 'webpload': ('webp',), 'tiffload': ('tiff',),
+    'gifload': ('gif',), 'pdfload': ('pdf',), 'svgload': ('svg',), 'heifload': ('heif', 'avif'),
+    'jxlload': ('jpegxl',), 'jp2kload': ('jp2',), 'ppmload': ('ppm', 'pgm', 'pbm', 'pnm'),
+    'radload': ('hdr',), 'openexrload': ('exr',),
+}
+
+# Шаги преобразования между декодированием и кодированием:
+# ('resize', ширина, высота, фильтр, точно), ('crop', x, y, ширина, высота),
+# ('rotate', угол по часовой), ('flip', 'h' | 'v'), ('auto_orient',), ('colorspace', 'gray' | 'srgb')
+TRANSFORM_OPS = ('resize', 'crop', 'rotate', 'flip', 'auto_orient', 'colorspace')
+RESIZE_FILTERS = ('nearest', 'bilinear', 'bicubic', 'lanczos', 'area')
+TRANSFORM_COLORSPACES = ('gray', 'srgb')
+
+def _parse_transform_step(name, args):
+    if name == 'resize' and 1 <= len(args) <= 2:
+        match = re.fullmatch(r'(\d*)(?:x(\d*))?(!?)', args[0].lower())
+        resample = args[1].lower() if len(args) > 1 else 'lanczos'
+        if match and (match.group(1) or match.group(2)) and resample in RESIZE_FILTERS:
+            return ('resize', int(match.group(1) or 0), int(match.group(2) or 0), resample,
+                    bool(match.group(3)))
+    elif name == 'crop' and len(args) == 4:
+        left, top, width, height = (int(arg) for arg in args)
+        if left >= 0 and top >= 0 and width > 0 and height > 0:
+            return ('crop', left, top, width, height)
+    elif name == 'rotate' and len(args) == 1 and int(args[0]) % 90 == 0:
+        return ('rotate', int(args[0]) % 360)
+    elif name == 'flip' and len(args) == 1 and args[0].lower() in ('h', 'v'):
+        return ('flip', args[0].lower())
+    elif name == 'auto_orient' and not args:
+        return ('auto_orient',)
+    elif name == 'colorspace' and len(args) == 1 and args[0].lower() in TRANSFORM_COLORSPACES:
+        return ('colorspace', args[0].lower())
+    return None
+
+def parse_transforms(text):
+    """Разбирает цепочку преобразований вида "auto_orient; resize 800x600 lanczos; rotate 90".
+    
+    resize WxH вписывает в рамку с сохранением пропорций (W или xH - по одной
+    стороне, WxH! - точный размер), crop принимает x,y,ширина,высота,
+    rotate - углы, кратные 90. Возвращает список шагов, при ошибке - ValueError.
+    """
+    steps = []
+    for part in (text or '').split(';'):
+        words = part.replace(',', ' ').split()
+        if not words:
+            continue
         try:
-            if direction == 'horizontal':
-                imgs = [PILImage.open(img) for img in images]
-                total_width = sum(img.width for img in imgs)
-                max_height = max(img.height for img in imgs)
-                merged_image = PILImage.new('RGB', (total_width, max_height), (255, 255, 255))
-                x_offset = 0
-                for img in imgs:
-                    merged_image.paste(img, (x_offset, 0))
-                    x_offset += img.width
-                    img.close()
-            else:
-                imgs = [PILImage.open(img) for img in images]
-                total_height = sum(img.height for img in imgs)
-                max_width = max(img.width for img in imgs)
-                merged_image = PILImage.new('RGB', (max_width, total_height), (255, 255, 255))
-                y_offset = 0
-                for img in imgs:
-                    merged_image.paste(img, (0, y_offset))
-                    y_offset += img.height
-                    img.close()
+            step = _parse_transform_step(words[0].lower().replace('-', '_'), words[1:])
+        except ValueError:
+            step = None
+        if step is None:
+            raise ValueError(f"Invalid transform: {part.strip()}")
+        if step != ('rotate', 0):
+            steps.append(step)
+    return steps
+
+def _transform_size(width, height, step):
+    """Итоговый размер шага resize"""
+    _, box_width, box_height, _, exact = step
+    if exact and box_width and box_height:
+        return box_width, box_height
+    return _fit_size(width, height, box_width or math.inf, box_height or math.inf)
+
+def _crop_box(width, height, step):
+    """Обрезает рамку crop по границам изображения: (x, y, ширина, высота)"""
+    _, left, top, crop_width, crop_height = step
+    right, bottom = min(width, left + crop_width), min(height, top + crop_height)
+    if left >= right or top >= bottom:
+        raise ValueError(f"crop {left},{top},{crop_width},{crop_height} is outside the {width}x{height} image")
+    return left, top, right - left, bottom - top
+
+class ImageBackend(abc.ABC):
+    """Библиотека обработки изображений, подключаемая через реестр BACKENDS.
+    
+    Бэкенд объявляет форматы чтения и записи и реализует decode, encode,
+    merge (вставку плиток в холст) и transform. Бэкенд без склейки ставит
+    merge_rank = None, без преобразований - пустой transform_ops.
+    Маршрутизатор route_backends сам выбирает порядок попыток.
+    """
+    name = None
+    label = None
+    input_formats = frozenset()
+    output_formats = frozenset()
+    # Порядок попыток при конвертации и склейке (меньше - раньше, None - не склеивает)
+    convert_rank = 100
+    merge_rank = 100
+    # Встроенные библиотеки пробуются и для необъявленных форматов
+    # (плагины PIL, делегаты ImageMagick), сторонние - только для объявленных
+    fallback = False
+    supports_pages = True
+    writes_metadata = True
+    # Форматы, реально найденные probe_capabilities: {'input': ..., 'output': ...}
+    probed = None
+    # Шаги преобразования, которые бэкенд выполняет сам, и порядок попыток
+    # для задач с преобразованиями (меньше - быстрее)
+    transform_ops = frozenset()
+    transform_rank = 100
+    
+    def probe(self):
+        """Доступна ли библиотека в текущем окружении"""
+        return False
+    
+    def version(self):
+        """Версии библиотеки для отпечатка кэша возможностей"""
+        return None
+    
+    def probe_formats(self):
+        """Спрашивает библиотеку, какие кодеки собраны: (чтение, запись) или None"""
+        return None
+    
+    def formats(self, direction):
+        if self.probed is not None:
+            return self.probed[direction]
+        return self.input_formats if direction == 'input' else self.output_formats
+    
+    def can_decode(self, fmt):
+        return canonical_format(fmt) in {canonical_format(f) for f in self.formats('input')}
+    
+    def can_encode(self, fmt):
+        return canonical_format(fmt) in {canonical_format(f) for f in self.formats('output')}
+    
+    def accepts(self, page=None):
+        """Жесткие ограничения бэкенда, не зависящие от формата"""
+        return page is None or self.supports_pages
+    
+    def keeps_metadata(self, metadata=MetadataPolicy.KEEP):
+        """Выполнит ли бэкенд политику метаданных полностью, а не по возможности"""
+        return self.writes_metadata or metadata == MetadataPolicy.STRIP
+    
+    @abc.abstractmethod
+    def decode(self, source, input_format=None, page=None, dpi=None):
+        """Декодирует путь, байты или элемент архива в изображение библиотеки"""
+    
+    @abc.abstractmethod
+    def encode(self, image, output_format, target=None, needs_alpha_removal=False,
+               profile=None, metadata=MetadataPolicy.KEEP):
+        """Пишет изображение в файл target или, если target не задан, возвращает байты"""
+    
+    def release(self, image):
+        pass
+    
+    @abc.abstractmethod
+    def merge(self, images, canvas_size, placements, output_path, output_format='png',
+              load=None, workers=1, profile=None):
+        """Вставляет изображения в холст по готовой раскладке и сохраняет результат"""
+    
+    def can_merge(self):
+        return self.merge_rank is not None
+    
+    @abc.abstractmethod
+    def transform(self, image, transforms):
+        """Применяет цепочку шагов (см. parse_transforms) к декодированному изображению"""
+    
+    def can_transform(self, transforms):
+        return {step[0] for step in transforms} <= self.transform_ops
+    
+    def convert(self, source, target, output_format, needs_alpha_removal=False, input_format=None,
+                page=None, dpi=None, profile=None, metadata=MetadataPolicy.KEEP, transforms=None):
+        decoded = image = self.decode(source, input_format, page, dpi)
+        try:
+            if transforms:
+                image = self.transform(image, transforms)
+            return self.encode(image, output_format, target, needs_alpha_removal, profile, metadata)
+        finally:
+            self.release(decoded)
+
+class PilBackend(ImageBackend):
+    name = ProcessingLibrary.PIL
+    label = "PIL"
+    input_formats = frozenset({'png', 'jpg', 'jpeg', 'bmp', 'gif', 'tiff', 'webp', 'ico', 'ppm'})
+    output_formats = frozenset({'png', 'jpg', 'jpeg', 'bmp', 'gif', 'tiff', 'webp', 'ico', 'dzi'})
+    convert_rank = 0
+    merge_rank = 0
+    fallback = True
+    transform_ops = frozenset(TRANSFORM_OPS)
+    transform_rank = 2
+    resize_filters = {'nearest': 'NEAREST', 'bilinear': 'BILINEAR', 'bicubic': 'BICUBIC',
+                      'lanczos': 'LANCZOS', 'area': 'BOX'}
+    
+    def probe(self):
+        return HAVE_PIL
+    
+    def version(self):
+        import PIL
+        return PIL.__version__
+    
+    def probe_formats(self):
+        from PIL import features
+        PILImage.init()
+        readable, writable = set(), set()
+        for ext, fmt in PILImage.registered_extensions().items():
+            if fmt in PILImage.OPEN:
+                readable.add(canonical_format(ext))
+            if fmt in PILImage.SAVE:
+                writable.add(canonical_format(ext))
+        # Плагин регистрируется всегда, а кодек может быть не собран
+        for codec in ('webp', 'avif'):
+            if codec in features.modules and not features.check_module(codec):
+                readable.discard(codec)
+                writable.discard(codec)
+        return readable, writable
+    
+    def decode(self, source, input_format=None, page=None, dpi=None):
+        img = PILImage.open(io.BytesIO(source) if isinstance(source, bytes) else _pil_source(source))
+        if page is not None:
+            img.seek(page)
+        return img
+    
+    def encode(self, image, output_format, target=None, needs_alpha_removal=False,
+               profile=None, metadata=MetadataPolicy.KEEP):
+        image, metadata_options = apply_metadata_policy(image, metadata)
+        if needs_alpha_removal and image.mode == 'RGBA':
+            background = PILImage.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[3])
+            image = background
+        buffer = io.BytesIO() if target is None else target
+        image.save(buffer, format=_pil_format_name(output_format),
+                   **{**encoder_options('pil', output_format, profile), **metadata_options})
+        return buffer.getvalue() if target is None else True
+    
+    def release(self, image):
+        image.close()
+    
+    def transform(self, image, transforms):
+        for index, step in enumerate(transforms):
+            op = step[0]
+            if op == 'resize':
+                size = _transform_size(image.width, image.height, step)
+                if size == image.size:
+                    continue
+                if index == 0:
+                    # JPEG уменьшается еще при декодировании (масштабирование DCT)
+                    image.draft(None, size)
+                if image.mode in ('1', 'P') and step[3] != 'nearest':
+                    # Палитровые изображения PIL масштабирует только ближайшим соседом
+                    image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+                # reducing_gap: сначала быстрое целочисленное reduce(), затем точный фильтр
+                image = image.resize(size, getattr(PILImage, self.resize_filters[step[3]]), reducing_gap=3.0)
+            elif op == 'crop':
+                left, top, width, height = _crop_box(image.width, image.height, step)
+                image = image.crop((left, top, left + width, top + height))
+            elif op == 'rotate':
+                image = image.transpose({90: PILImage.ROTATE_270, 180: PILImage.ROTATE_180,
+                                         270: PILImage.ROTATE_90}[step[1]])
+            elif op == 'flip':
+                image = image.transpose(PILImage.FLIP_LEFT_RIGHT if step[1] == 'h' else PILImage.FLIP_TOP_BOTTOM)
+            elif op == 'auto_orient':
+                image = ImageOps.exif_transpose(image)
+            elif op == 'colorspace':
+                alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+                image = image.convert(('LA' if alpha else 'L') if step[1] == 'gray' else ('RGBA' if alpha else 'RGB'))
+                # Профиль исходного пространства к новому не подходит
+                image.info.pop('icc_profile', None)
+        return image
+    
+    def merge(self, images, canvas_size, placements, output_path, output_format='png',
+              load=None, workers=1, profile=None):
+        # Каждый поток пишет в свой непересекающийся срез буфера NumPy.
+        # При одном потоке вставляем прямо в холст PIL, без лишней копии буфера
+        canvas_width, canvas_height = canvas_size
+        if HAVE_NUMPY and workers > 1:
+            canvas = np.full((canvas_height, canvas_width, 3), 255, dtype=np.uint8)
+            
+            def place(item):
+                path, (x, y, width, height) = item
+                tile = _prepare_tile(load(path, _load_pil_image, 'pil'), width, height)
+                canvas[y:y + height, x:x + width] = np.asarray(tile)
+            
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(place, zip(images, placements)))
+            merged_image = PILImage.fromarray(canvas)
+        else:
+            merged_image = PILImage.new('RGB', (canvas_width, canvas_height), (255, 255, 255))
+            paste_lock = threading.Lock()
+            
+            def place(item):
+                path, (x, y, width, height) = item
+                tile = _prepare_tile(load(path, _load_pil_image, 'pil'), width, height)
+                with paste_lock:
+                    merged_image.paste(tile, (x, y))
             
-            if output_path:
-                merged_image.save(output_path, format=output_format.upper())
-            return merged_image
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(place, zip(images, placements)))
+        
+        if output_path:
+            merged_image.save(output_path, format=_pil_format_name(output_format),
+                              **encoder_options('pil', output_format, profile))
+        return merged_image
+
+class Cv2Backend(ImageBackend):
+    name = ProcessingLibrary.CV2
+    label = "OpenCV"
+    input_formats = frozenset({'png', 'jpg', 'jpeg', 'bmp', 'tiff', 'webp'})
+    output_formats = frozenset({'png', 'jpg', 'jpeg', 'bmp', 'tiff', 'webp'})
+    convert_rank = 1
+    merge_rank = 1
+    fallback = True
+    # OpenCV не читает страницы и не пишет метаданные
+    supports_pages = False
+    writes_metadata = False
+    # EXIF OpenCV не читает, поэтому auto_orient ему недоступен
+    transform_ops = frozenset(TRANSFORM_OPS) - {'auto_orient'}
+    transform_rank = 1
+    resize_filters = {'nearest': 'INTER_NEAREST', 'bilinear': 'INTER_LINEAR', 'bicubic': 'INTER_CUBIC',
+                      'lanczos': 'INTER_LANCZOS4', 'area': 'INTER_AREA'}
+    
+    def probe(self):
+        return HAVE_CV2
+    
+    def version(self):
+        # Одна версия OpenCV бывает собрана с разными кодеками
+        build = hashlib.md5(cv2.getBuildInformation().encode('utf-8')).hexdigest()[:8]
+        return f"{cv2.__version__}+{build}"
+    
+    def probe_formats(self):
+        # haveImageReader проверяет сигнатуру существующего файла, поэтому
+        # спрашиваем кодировщики; декодеры OpenCV собираются вместе с ними
+        writable = {fmt for fmt in CV2_PROBE_FORMATS if cv2.haveImageWriter(f"probe.{fmt}")}
+        return set(writable), writable
+    
+    def decode(self, source, input_format=None, page=None, dpi=None):
+        if isinstance(source, ArchiveMember):
+            source = source.read()
+        if isinstance(source, bytes):
+            img = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        else:
+            img = cv2.imread(source, cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise ValueError("cannot decode image")
+        return img
+    
+    def encode(self, image, output_format, target=None, needs_alpha_removal=False,
+               profile=None, metadata=MetadataPolicy.KEEP):
+        if needs_alpha_removal and image.ndim == 3 and image.shape[-1] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+        params = encoder_options('cv2', output_format, profile)
+        if target is None:
+            ok, encoded = cv2.imencode(f".{output_format}", image, params)
+            if not ok:
+                raise ValueError(f"cannot encode {output_format}")
+            return encoded.tobytes()
+        if not cv2.imwrite(target, image, params):
+            raise ValueError(f"cannot write {output_format}")
+        return True
+    
+    def transform(self, image, transforms):
+        for step in transforms:
+            op = step[0]
+            height, width = image.shape[:2]
+            if op == 'resize':
+                size = _transform_size(width, height, step)
+                if size != (width, height):
+                    image = cv2.resize(image, size, interpolation=getattr(cv2, self.resize_filters[step[3]]))
+            elif op == 'crop':
+                left, top, crop_width, crop_height = _crop_box(width, height, step)
+                image = image[top:top + crop_height, left:left + crop_width]
+            elif op == 'rotate':
+                image = cv2.rotate(image, {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180,
+                                           270: cv2.ROTATE_90_COUNTERCLOCKWISE}[step[1]])
+            elif op == 'flip':
+                image = cv2.flip(image, 1 if step[1] == 'h' else 0)
+            elif op == 'colorspace':
+                channels = 1 if image.ndim == 2 else image.shape[2]
+                if step[1] == 'srgb' and channels == 1:
+                    image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+                elif step[1] == 'gray' and channels == 3:
+                    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                elif step[1] == 'gray' and channels == 4:
+                    # imwrite не пишет серый с альфой - серые значения в трех каналах
+                    gray = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+                    image = cv2.merge([gray, gray, gray, image[:, :, 3]])
+        return image
+    
+    def merge(self, images, canvas_size, placements, output_path, output_format='png',
+              load=None, workers=1, profile=None):
+        canvas_width, canvas_height = canvas_size
+        canvas = np.full((canvas_height, canvas_width, 3), 255, dtype=np.uint8)
+        
+        def place(item):
+            path, (x, y, width, height) = item
+            tile = load(path, _load_cv2_image, 'cv2')
+            if tile is None:
+                raise ValueError(f"Cannot decode {path}")
+            if (tile.shape[1], tile.shape[0]) != (width, height):
+                tile = cv2.resize(tile, (width, height), interpolation=cv2.INTER_AREA)
+            canvas[y:y + height, x:x + width] = tile
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(place, zip(images, placements)))
+        if not cv2.imwrite(output_path, canvas, encoder_options('cv2', output_format, profile)):
+            raise ValueError(f"cannot write {output_format}")
+        return True
+
+class WandBackend(ImageBackend):
+    name = ProcessingLibrary.WAND
+    label = "Wand"
+    input_formats = frozenset({'png', 'jpg', 'jpeg', 'bmp', 'gif', 'tiff', 'webp', 'svg',
+                               'pdf', 'eps', 'psd', 'heic', 'avif', 'jpegxl', 'ico', 'ppm',
+                               'rla', 'pcx', 'pnm', 'xbm', 'tga', 'djvu'})
+    output_formats = input_formats
+    convert_rank = 2
+    merge_rank = 3
+    fallback = True
+    transform_ops = frozenset(TRANSFORM_OPS)
+    transform_rank = 3
+    resize_filters = {'nearest': 'point', 'bilinear': 'triangle', 'bicubic': 'catrom',
+                      'lanczos': 'lanczos', 'area': 'box'}
+    
+    def probe(self):
+        return HAVE_WAND
+    
+    def version(self):
+        from wand.version import VERSION, MAGICK_VERSION
+        return f"{VERSION}/{MAGICK_VERSION}"
+    
+    def probe_formats(self):
+        from wand.version import formats
+        # ImageMagick перечисляет только форматы с установленными делегатами
+        readable = {canonical_format(name) for name in formats()}
+        return readable, readable - WAND_READ_ONLY_FORMATS
+    
+    def decode(self, source, input_format=None, page=None, dpi=None):
+        if isinstance(source, ArchiveMember):
+            source = source.read()
+        if not isinstance(source, bytes):
+            return WandImage(filename=f"{source}[{page}]" if page is not None else source, resolution=dpi)
+        img = WandImage(blob=source, resolution=dpi)
+        if page is None:
+            return img
+        with img:
+            return WandImage(image=img.sequence[page])
+    
+    def encode(self, image, output_format, target=None, needs_alpha_removal=False,
+               profile=None, metadata=MetadataPolicy.KEEP):
+        if needs_alpha_removal and image.alpha_channel:
+            with Color('white') as background:
+                image.background_color = background
+                image.alpha_channel = 'remove'
+        _apply_wand_metadata(image, metadata)
+        image.format = output_format.upper()
+        _apply_wand_encoder(image, output_format, profile)
+        if target is None:
+            return image.make_blob()
+        image.save(filename=target)
+        return True
+    
+    def release(self, image):
+        image.close()
+    
+    def transform(self, image, transforms):
+        # ImageMagick меняет изображение на месте
+        for step in transforms:
+            op = step[0]
+            if op == 'resize':
+                width, height = _transform_size(image.width, image.height, step)
+                if (width, height) != (image.width, image.height):
+                    image.resize(width, height, filter=self.resize_filters[step[3]])
+            elif op == 'crop':
+                left, top, width, height = _crop_box(image.width, image.height, step)
+                image.crop(left=left, top=top, width=width, height=height)
+                image.reset_coords()
+            elif op == 'rotate':
+                image.rotate(step[1])
+            elif op == 'flip':
+                if step[1] == 'h':
+                    image.flop()
+                else:
+                    image.flip()
+            elif op == 'auto_orient':
+                image.auto_orient()
+            elif op == 'colorspace':
+                image.transform_colorspace(step[1])
+                if 'icc' in image.profiles:
+                    del image.profiles['icc']
+        return image
+    
+    def merge(self, images, canvas_size, placements, output_path, output_format='png',
+              load=None, workers=1, profile=None):
+        canvas_width, canvas_height = canvas_size
+        with Color('white') as background:
+            canvas = WandImage(width=canvas_width, height=canvas_height, background=background)
+        with canvas:
+            for path, (x, y, width, height) in zip(images, placements):
+                # Изображение из кэша не меняем: масштабируем его копию
+                tile = load(path, _wand_open, 'wand')
+                if (tile.width, tile.height) != (width, height):
+                    with tile.clone() as resized:
+                        resized.resize(width, height)
+                        canvas.composite(resized, left=x, top=y)
+                else:
+                    canvas.composite(tile, left=x, top=y)
+            canvas.format = output_format.upper()
+            _apply_wand_encoder(canvas, output_format, profile)
+            canvas.save(filename=output_path)
+        return True
+
+class VipsBackend(ImageBackend):
+    name = ProcessingLibrary.VIPS
+    label = "Vips"
+    input_formats = frozenset({'png', 'jpg', 'jpeg', 'webp', 'tiff', 'gif', 'pdf', 'svg', 'heif', 'avif'})
+    output_formats = frozenset({'png', 'jpg', 'jpeg', 'webp', 'tiff', 'gif', 'heif', 'avif', 'dzi'})
+    convert_rank = 3
+    merge_rank = 2
+    fallback = True
+    transform_ops = frozenset(TRANSFORM_OPS)
+    # libvips масштабирует и поворачивает по полосам во всех потоках - самый быстрый путь
+    transform_rank = 0
+    # Честного усреднения по площади (area) у resize нет: такие шаги уходят
+    # к библиотекам с box-фильтром
+    resize_filters = {'nearest': 'nearest', 'bilinear': 'linear', 'bicubic': 'cubic',
+                      'lanczos': 'lanczos3'}
+    
+    def probe(self):
+        return HAVE_VIPS
+    
+    def can_transform(self, transforms):
+        return super().can_transform(transforms) and all(
+            step[3] in self.resize_filters for step in transforms if step[0] == 'resize')
+    
+    def version(self):
+        return f"{pyvips.__version__}/{pyvips.version(0)}.{pyvips.version(1)}.{pyvips.version(2)}"
+    
+    def probe_formats(self):
+        readable = set()
+        for loader, names in VIPS_LOADERS.items():
+            if pyvips.type_find("VipsOperation", loader) != 0:
+                readable.update(names)
+        writable = {canonical_format(suffix) for suffix in pyvips.get_suffixes()}
+        if 'dz' in writable:
+            writable.add('dzi')
+        return readable, writable
+    
+    def decode(self, source, input_format=None, page=None, dpi=None):
+        load_options = {}
+        if page is not None:
+            load_options['page'] = page
+        if dpi and input_format and canonical_format(input_format) in ('pdf', 'svg'):
+            load_options['dpi'] = dpi
+        if isinstance(source, ArchiveMember):
+            source = source.read()
+        if isinstance(source, bytes):
+            return pyvips.Image.new_from_buffer(source, "", **load_options)
+        return pyvips.Image.new_from_file(source, **load_options)
+    
+    def encode(self, image, output_format, target=None, needs_alpha_removal=False,
+               profile=None, metadata=MetadataPolicy.KEEP):
+        if needs_alpha_removal and image.hasalpha():
+            image = image.flatten(background=[255, 255, 255])
+        image, metadata_options = apply_metadata_policy(image, metadata)
+        if target is None:
+            return image.write_to_buffer(f".{output_format}", **encoder_options('vips', output_format, profile),
+                                         **metadata_options)
+        _save_vips_image(image, target, output_format, profile, **metadata_options)
+        return True
+    
+    def transform(self, image, transforms):
+        for step in transforms:
+            op = step[0]
+            if op == 'resize':
+                width, height = _transform_size(image.width, image.height, step)
+                if (width, height) == (image.width, image.height):
+                    continue
+                # resize сначала сжимает блоками (shrink), затем доводит ядром фильтра
+                scale, options = width / image.width, {'vscale': height / image.height,
+                                                       'kernel': self.resize_filters[step[3]]}
+                if image.hasalpha():
+                    image = image.premultiply().resize(scale, **options).unpremultiply().cast(image.format)
+                else:
+                    image = image.resize(scale, **options)
+            elif op == 'crop':
+                image = image.crop(*_crop_box(image.width, image.height, step))
+            elif op == 'rotate':
+                image = image.rot(f"d{step[1]}")
+            elif op == 'flip':
+                image = image.flip('horizontal' if step[1] == 'h' else 'vertical')
+            elif op == 'auto_orient':
+                image = image.autorot()
+            elif op == 'colorspace':
+                image = image.colourspace('b-w' if step[1] == 'gray' else 'srgb')
+                if 'icc-profile-data' in image.get_fields():
+                    image = image.copy()
+                    image.remove('icc-profile-data')
+        return image
+    
+    def merge(self, images, canvas_size, placements, output_path, output_format='png',
+              load=None, workers=1, profile=None):
+        # Ленивые вставки, декодирование идёт потоками libvips
+        canvas_width, canvas_height = canvas_size
+        canvas = pyvips.Image.black(canvas_width, canvas_height, bands=3) + 255
+        for path, (x, y, width, height) in zip(images, placements):
+            # libvips декодирует лениво, при сохранении; кэш держит открытые изображения
+            tile = load(path, _vips_open, 'vips')
+            if tile.hasalpha():
+                tile = tile.flatten(background=[255, 255, 255])
+            if tile.bands == 1:
+                tile = tile.colourspace('srgb')
+            if (tile.width, tile.height) != (width, height):
+                tile = tile.resize(width / tile.width, vscale=height / tile.height)
+            canvas = canvas.insert(tile, x, y)
+        _save_vips_image(canvas.cast('uchar'), output_path, output_format, profile)
+        return True
+
+# Реестр бэкендов; SUPPORTED_FORMATS строится из него и обновляется при регистрации
+BACKENDS = []
+SUPPORTED_FORMATS = {}
+
+def _with_aliases(formats):
+    """Добавляет к форматам все их варианты расширений (jpeg -> jpg, jpe)"""
+    formats = {canonical_format(fmt) for fmt in formats}
+    return formats | {alias for alias, fmt in FORMAT_ALIASES.items() if fmt in formats}
+
+def _update_supported_formats(backend):
+    SUPPORTED_FORMATS[backend.name] = {
+        'input': _with_aliases(backend.formats('input')),
+        'output': _with_aliases(backend.formats('output')),
+    }
+
+def register_backend(backend):
+    """Добавляет бэкенд (или заменяет бэкенд с тем же именем)"""
+    if not isinstance(backend, ImageBackend):
+        raise TypeError(f"{backend!r} is not an ImageBackend instance")
+    BACKENDS[:] = [b for b in BACKENDS if b.name != backend.name] + [backend]
+    BACKENDS.sort(key=lambda b: b.convert_rank)
+    _update_supported_formats(backend)
+    return backend
+
+def get_backend(name):
+    return next((b for b in BACKENDS if b.name == name), None)
+
+def route_backends(input_format, output_format, page=None, metadata=MetadataPolicy.KEEP,
+                   preferred=None, operation='convert', transforms=None):
+    """Порядок бэкендов для задачи.
+    
+    Сначала идут бэкенды, объявившие оба формата, затем встроенные
+    как запасной вариант. Задачи с преобразованиями получают только
+    бэкенды, умеющие все шаги, самые быстрые первыми. Бэкенды, которые
+    не запишут метаданные, политика keep не исключает, а ставит в конец.
+    Выбранная пользователем библиотека - всегда первой.
+    """
+    ensure_capabilities()
+    if operation == 'merge':
+        candidates = sorted((b for b in BACKENDS if b.can_merge()), key=lambda b: b.merge_rank)
+    else:
+        candidates = list(BACKENDS)
+    candidates = [b for b in candidates if b.accepts(page) and b.probe()]
+    if transforms:
+        candidates = sorted((b for b in candidates if b.can_transform(transforms)),
+                            key=lambda b: b.transform_rank)
+    declared = [b for b in candidates
+                if (not input_format or b.can_decode(input_format)) and b.can_encode(output_format)]
+    chain = declared + [b for b in candidates if b not in declared and b.fallback]
+    chain.sort(key=lambda b: (b.name != preferred, not b.keeps_metadata(metadata)))
+    return chain
+
+for _backend in (PilBackend(), Cv2Backend(), WandBackend(), VipsBackend()):
+    register_backend(_backend)
+
+# Версия формата кэша возможностей: при изменении логики проб кэш пересоздаётся
+CAPABILITY_SCHEMA = 1
+_capabilities_lock = threading.Lock()
+_capabilities_loaded = False
+
+def capability_cache_path():
+    return os.path.join(config_dir(), 'capabilities.json')
+
+def probe_capabilities(cache_path=None, refresh=False):
+    """Узнаёт у установленных библиотек, какие форматы они реально читают и пишут.
+    
+    Результат кэшируется вместе с версиями библиотек, так что следующие
+    запуски только читают файл, пока не обновится какая-нибудь библиотека.
+    Если проба не удалась, у бэкенда остаются объявленные форматы.
+    """
+    global _capabilities_loaded
+    cache_path = cache_path or capability_cache_path()
+    backends = [b for b in BACKENDS if b.probe()]
+    fingerprint = {'schema': CAPABILITY_SCHEMA}
+    for backend in backends:
+        try:
+            fingerprint[backend.name] = backend.version()
+        except Exception:
+            fingerprint[backend.name] = None
+    
+    cached = {}
+    if not refresh:
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+    
+    if isinstance(cached, dict) and cached.get('fingerprint') == fingerprint:
+        formats = cached.get('formats', {})
+    else:
+        formats = {}
+        complete = True
+        for backend in backends:
+            try:
+                result = backend.probe_formats()
+            except Exception:
+                result = None
+                complete = False
+            if result:
+                formats[backend.name] = {'input': sorted(result[0]), 'output': sorted(result[1])}
+        # Неудачная проба не кэшируется, чтобы следующий запуск попробовал снова
+        if complete:
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                # Пробу могут одновременно выполнить несколько процессов пула
+                temp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'fingerprint': fingerprint, 'formats': formats}, f, indent=2)
+                os.replace(temp_path, cache_path)
+            except OSError:
+                pass
+    
+    for backend in backends:
+        entry = formats.get(backend.name)
+        if entry:
+            backend.probed = {
+                'input': frozenset(entry['input']),
+                'output': frozenset(entry['output']) | (backend.output_formats & PIPELINE_FORMATS),
+            }
+            _update_supported_formats(backend)
+    _capabilities_loaded = True
+    return formats
+
+def ensure_capabilities():
+    """Однократно загружает возможности библиотек (из кэша, если он актуален)"""
+    if _capabilities_loaded:
+        return
+    with _capabilities_lock:
+        if not _capabilities_loaded:
+            probe_capabilities()
+
+def convert_image(args):
+    """Оптимизированная функция конвертации с резервными вариантами"""
+    input_path, output_path, output_format, needs_alpha_removal = args[:4]
+    # Необязательные параметры задачи: страница многостраничного документа и DPI
+    options = args[4] if len(args) > 4 else {}
+    page = options.get('page')
+    dpi = options.get('dpi')
+    profile = options.get('profile')
+    metadata = options.get('metadata', MetadataPolicy.KEEP)
+    transforms = options.get('transforms')
+    input_ext = os.path.splitext(input_path.lower())[1][1:]
+    
+    # Пирамида тайлов строится отдельным конвейером
+    if output_format.lower() == 'dzi':
+        try:
+            generate_pyramid(input_path, output_path, transforms=transforms)
+            return True
         except Exception as e:
-            errors.append(f"PIL: {str(e)}")
+            return (input_path, str(e))
     
-    # 2. Попытка использовать OpenCV
-    if HAVE_CV2:
+    # Формат тот же и пиксели не меняются - копируем файл как есть
+    if is_identity_conversion(input_path, output_format, needs_alpha_removal, options):
         try:
-            cv_images = [cv2.imread(img) for img in images]
-            if direction == 'horizontal':
-                merged_image = np.hstack(cv_images)
-            else:
-                merged_image = np.vstack(cv_images)
-            cv2.imwrite(output_path, merged_image)
+            passthrough_copy(input_path, output_path, hardlink=options.get('hardlink', False))
+            return PASSTHROUGH
+        except OSError as e:
+            return (input_path, str(e))
+    
+    # Анимация конвертируется всеми кадрами, а не только первым
+    if _needs_animation_pipeline(input_path, output_format, options):
+        if transforms:
+            return (input_path, "Transforms are not supported for animated images")
+        try:
+            convert_animation(input_path, output_path, output_format, options)
             return True
         except Exception as e:
-            errors.append(f"OpenCV: {str(e)}")
+            return (input_path, str(e))
     
-    # 3. Попытка использовать Wand
-    if HAVE_WAND:
+    # JPEG в JPEG: меняются только метаданные, пиксели не декодируются
+    if _can_repack_jpeg(input_ext, output_format, options):
         try:
-            with WandImage() as merged_image:
-                with WandImage(filename=images[0]) as first:
-                    merged_image.format = first.format
-                    if direction == 'horizontal':
-                        for img_path in images[1:]:
-                            with WandImage(filename=img_path) as img:
-                                merged_image.sequence.append(img)
-                        merged_image.reset_sequence()
-                    else:
-                        for img_path in images[1:]:
-                            with WandImage(filename=img_path) as img:
-                                merged_image.sequence.extend(img.sequence)
-                if output_path:
-                    merged_image.save(filename=output_path)
-                return merged_image
+            with open(input_path, 'rb') as f:
+                data = jpeg_metadata_fast_path(f.read(), metadata)
+            if data is not None:
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+                return True
+        except ValueError:
+            # Нестандартная структура - пусть разбираются декодеры
+            pass
+    
+    # Подбор качества под размер: одно декодирование, попытки в памяти, на диск - только результат
+    if options.get('target_size'):
+        try:
+            image = _decode_for_search(input_path, needs_alpha_removal, page, transforms)
+            data, _ = encode_to_target_size(image, output_format, options['target_size'], profile,
+                                            metadata=metadata)
+            with open(output_path, 'wb') as f:
+                f.write(data)
+            return True
         except Exception as e:
-            errors.append(f"Wand: {str(e)}")
+            return (input_path if page is None else f"{input_path} [{page + 1}]", str(e))
     
-    # 4. Попытка использовать Pyvips
-    if HAVE_VIPS:
+    # Подбор наименьшего качества, удовлетворяющего порогу SSIM/PSNR
+    if options.get('quality_metric') and output_format.lower() in LOSSY_FORMATS:
         try:
-            # Загружаем изображения
-            vips_images = [pyvips.Image.new_from_file(img) for img in images]
-            
-            # Объединяем изображения
-            if direction == 'horizontal':
-                merged = pyvips.Image.arrayjoin(vips_images, across=len(vips_images))
-            else:
-                merged = pyvips.Image.arrayjoin(vips_images, across=1)
-            
-            # Сохраняем результат
-            if output_path:
-                if output_format.lower() in ['jpg', 'jpeg']:
-                    merged.jpegsave(output_path, Q=95)
-                elif output_format.lower() == 'png':
-                    merged.pngsave(output_path)
-                elif output_format.lower() == 'webp':
-                    merged.webpsave(output_path, Q=95)
-                elif output_format.lower() == 'tiff':
-                    merged.tiffsave(output_path)
-                else:
-                    merged.write_to_file(output_path)
+            image = _decode_for_search(input_path, needs_alpha_removal, page, transforms)
+            data, quality, score = encode_to_quality_target(
+                image, output_format, options['quality_metric'], options['quality_threshold'], profile,
+                metadata=metadata
+            )
+            with open(output_path, 'wb') as f:
+                f.write(data)
+            return {'quality': quality, 'metric': options['quality_metric'], 'score': score}
+        except Exception as e:
+            return (input_path if page is None else f"{input_path} [{page + 1}]", str(e))
+    
+    # Пробуем библиотеки в порядке, который выбирает маршрутизатор
+    errors = []
+    for backend in route_backends(input_ext, output_format, page, metadata, options.get('backend'),
+                                  transforms=transforms):
+        try:
+            backend.convert(input_path, output_path, output_format, needs_alpha_removal,
+                            input_ext, page, dpi, profile, metadata, transforms)
             return True
         except Exception as e:
-            errors.append(f"Vips: {str(e)}")
+            errors.append(f"{backend.label}: {str(e)}")
     
-    raise Exception("Failed to merge images using any method:\n" + "\n".join(errors))
+    # Если все методы не сработали, возвращаем ошибку
+    if page is not None:
+        input_path = f"{input_path} [{page + 1}]"
+    return (input_path, "\n".join(errors))
+
+# Имена форматов PIL, отличающиеся от расширения
+PIL_FORMAT_NAMES = {'jpg': 'JPEG', 'tif': 'TIFF', 'heic': 'HEIF', 'jpegxl': 'JXL'}
 
-def batch_convert(conversion_args, progress_callback, batch_size=10):
-    """Обновленная версия с поддержкой расширенного прогресса"""
+def _pil_format_name(output_format):
+    fmt = output_format.lower()
+    return PIL_FORMAT_NAMES.get(fmt, fmt.upper())
+
+def convert_bytes(data, to='webp', **options):
+    """Конвертирует изображение в памяти: байты на входе, байты на выходе"""
+    output_format = to.lower()
+    needs_alpha_removal = options.get('alpha_removal', output_format in ['jpg', 'jpeg', 'bmp'])
+    page = options.get('page')
+    dpi = options.get('dpi')
+    profile = options.get('profile')
+    metadata = options.get('metadata', MetadataPolicy.KEEP)
+    transforms = options.get('transforms')
     errors = []
-    total = len(conversion_args)
-    progress_info = ProgressInfo(total)
     
-    for i in range(0, total, batch_size):
-        batch = conversion_args[i:i + batch_size]
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=min(os.cpu_count(), len(batch))) as executor:
-            futures = {executor.submit(convert_image, args): args[0] for args in batch}
-            
-            for future in concurrent.futures.as_completed(futures):
-                result = future.result()
-                if isinstance(result, tuple):
-                    errors.append(result)
-                
-                progress_info.complete_file()
-                progress_callback(1.0, progress_info)  # Файл завершен
-                
-    return errors
+    # Формат тот же и пиксели не меняются - возвращаем исходные байты
+    source_format = sniff_image_format(data)
+    if source_format and _is_identity(source_format, output_format, needs_alpha_removal, options):
+        return data
+    
+    # Анимация из памяти (сервис, архивы, потоки) тоже сохраняет все кадры
+    if source_format and _needs_animation_pipeline(data, output_format, options, source_format):
+        if transforms:
+            raise ValueError("Transforms are not supported for animated images")
+        return convert_animation(data, None, output_format, options)
+    
+    if _can_repack_jpeg(source_format, output_format, options):
+        try:
+            repacked = jpeg_metadata_fast_path(data, metadata)
+            if repacked is not None:
+                return repacked
+        except ValueError:
+            pass
+    
+    if options.get('target_size'):
+        image = _decode_for_search(data, needs_alpha_removal, page, transforms)
+        return encode_to_target_size(image, output_format, options['target_size'], profile,
+                                     metadata=metadata)[0]
+    if options.get('quality_metric') and output_format.lower() in LOSSY_FORMATS:
+        image = _decode_for_search(data, needs_alpha_removal, page, transforms)
+        return encode_to_quality_target(
+            image, output_format, options['quality_metric'], options['quality_threshold'], profile,
+            metadata=metadata
+        )[0]
+    
+    # Каждый бэкенд декодирует и кодирует в памяти: PIL - BytesIO, OpenCV - imdecode/imencode,
+    # Wand - blob=, pyvips - new_from_buffer/write_to_buffer
+    for backend in route_backends(source_format, output_format, page, metadata, options.get('backend'),
+                                  transforms=transforms):
+        try:
+            return backend.convert(data, None, output_format, needs_alpha_removal,
+                                   source_format, page, dpi, profile, metadata, transforms)
+        except Exception as e:
+            errors.append(f"{backend.label}: {str(e)}")
+    
+    raise Exception("Failed to convert image using any method:\n" + "\n".join(errors))
+
+def convert_stream(source, destination=None, to='webp', **options):
+    """Потоковый вариант convert_bytes для файловых объектов.
+    
+    Если destination не задан, возвращает BytesIO с результатом.
+    """
+    created = destination is None
+    if created:
+        destination = io.BytesIO()
+    
+    # Pyvips читает и пишет потоками без полной буферизации; подбору качества,
+    # повороту по EXIF и преобразованиям нужен весь растр, они идут через convert_bytes.
+    # Возможная анимация тоже: convert_bytes сохранит все кадры
+    metadata = options.get('metadata', MetadataPolicy.KEEP)
+    head = source.read(32)
+    maybe_animated = (sniff_image_format(head) in ANIMATED_INPUTS
+                      and canonical_format(to) in ANIMATED_OUTPUTS and options.get('page') is None)
+    streamable = not maybe_animated and not any(
+        options.get(key) for key in ('page', 'dpi', 'target_size', 'quality_metric', 'transforms')
+    )
+    if HAVE_VIPS and streamable and metadata != MetadataPolicy.ORIENT_STRIP:
+        try:
+            # Уже прочитанная сигнатура отдается первой
+            unread = [head]
+            
+            def read(size):
+                if unread[0]:
+                    chunk, unread[0] = unread[0][:size], unread[0][size:]
+                    return chunk
+                return source.read(size)
+            
+            vips_source = pyvips.SourceCustom()
+            vips_source.on_read(read)
+            vips_target = pyvips.TargetCustom()
+            vips_target.on_write(lambda chunk: destination.write(chunk) or len(chunk))
+            image = pyvips.Image.new_from_source(vips_source, "", access='sequential')
+            if options.get('alpha_removal', to.lower() in ['jpg', 'jpeg', 'bmp']) and image.hasalpha():
+                image = image.flatten(background=[255, 255, 255])
+            image, metadata_options = apply_metadata_policy(image, metadata)
+            image.write_to_target(vips_target, f".{to.lower()}",
+                                  **encoder_options('vips', to, options.get('profile')), **metadata_options)
+            if created:
+                destination.seek(0)
+            return destination
+        except Exception:
+            # Источник мог быть частично прочитан - остальные библиотеки требуют перемотки
+            if not (hasattr(source, 'seekable') and source.seekable()):
+                raise
+            source.seek(0)
+            head = b''
+            destination.seek(0)
+            destination.truncate()
+    
+    destination.write(convert_bytes(head + source.read(), to=to, **options))
+    if created:
+        destination.seek(0)
+    return destination
+
+# Форматы, которые могут содержать несколько страниц
+MULTIPAGE_INPUTS = {'pdf', 'djvu', 'tiff', 'gif'}
+MULTIPAGE_OUTPUTS = {'pdf', 'tiff', 'gif'}
+
+class PageMode:
+    AUTO = "auto"            # документы по страницам, контейнер если формат позволяет
+    PAGES = "pages"          # отдельный файл на каждую страницу
+    CONTAINER = "container"  # страницы параллельно, затем сборка в один файл
+    SINGLE = "single"        # весь документ одним вызовом, как раньше
+
+def count_pages(input_path):
+    """Возвращает количество страниц, читая только заголовок"""
+    ext = os.path.splitext(input_path.lower())[1][1:]
+    
+    if HAVE_PIL and ext in ('tiff', 'gif'):
+        try:
+            with PILImage.open(input_path) as img:
+                return getattr(img, 'n_frames', 1)
+        except Exception:
+            pass
+    
+    if HAVE_VIPS and ext in ('pdf', 'tiff', 'gif'):
+        try:
+            image = pyvips.Image.new_from_file(input_path)
+            if image.get_typeof('n-pages'):
+                return image.get('n-pages')
+            return 1
+        except Exception:
+            pass
+    
+    if HAVE_WAND:
+        try:
+            with WandImage(filename=input_path, ping=True) as img:
+                return len(img.sequence)
+        except Exception:
+            pass
+    
+    return 1
+
+# Параметры задачи, которые переходят на промежуточные PNG страниц
+PAGE_TASK_OPTIONS = ('transforms', 'backend')
+
+def expand_multipage_tasks(conversion_args, page_mode=PageMode.AUTO, dpi=150):
+    """Разбивает многостраничные документы на задачи по страницам для пула"""
+    tasks = []
+    assemblies = []
+    
+    for args in conversion_args:
+        input_path, output_path, output_format, needs_alpha_removal = args[:4]
+        options = args[4] if len(args) > 4 else {}
+        input_ext = os.path.splitext(input_path.lower())[1][1:]
+        
+        # Документ в тот же формат копируется целиком, без разбора на страницы
+        if page_mode != PageMode.PAGES and is_identity_conversion(input_path, output_format, needs_alpha_removal, options):
+            tasks.append(args)
+            continue
+        
+        # В режиме auto анимированные GIF не режутся на кадры
+        splittable = input_ext in MULTIPAGE_INPUTS
+        if page_mode == PageMode.AUTO and input_ext == 'gif':
+            splittable = False
+        
+        pages = count_pages(input_path) if page_mode != PageMode.SINGLE and splittable else 1
+        if pages <= 1:
+            tasks.append(args)
+            continue
+        
+        to_container = output_format.lower() in MULTIPAGE_OUTPUTS and page_mode in (PageMode.AUTO, PageMode.CONTAINER)
+        if to_container:
+            # Страницы рендерятся во временные PNG и затем собираются обратно.
+            # Промежуточным страницам нужны только преобразования: профиль,
+            # качество и подбор размера относятся к собранному файлу
+            temp_dir = tempfile.mkdtemp(prefix='ami_pages_')
+            page_paths = [os.path.join(temp_dir, f"{i + 1:05d}.png") for i in range(pages)]
+            page_options = {key: options[key] for key in PAGE_TASK_OPTIONS if key in options}
+            for i, page_path in enumerate(page_paths):
+                tasks.append((input_path, page_path, 'png', False, dict(page_options, page=i, dpi=dpi)))
+            assemblies.append((input_path, output_path, output_format, page_paths, temp_dir, options))
+        else:
+            base, ext = os.path.splitext(output_path)
+            width = max(3, len(str(pages)))
+            for i in range(pages):
+                tasks.append((
+                    input_path,
+                    f"{base}_{i + 1:0{width}d}{ext}",
+                    output_format,
+                    needs_alpha_removal,
+                    dict(options, page=i, dpi=dpi)
+                ))
+    
+    return tasks, assemblies
+
+def assemble_pages(page_paths, output_path, output_format, profile=None, quality=None):
+    """Собирает отрендеренные страницы в многостраничный файл с параметрами кодера"""
+    errors = []
+    
+    # 1. Попытка использовать PIL
+    if HAVE_PIL:
+        try:
+            pages = [PILImage.open(path) for path in page_paths]
+            try:
+                first = pages[0]
+                if output_format.lower() == 'pdf':
+                    first = first.convert('RGB')
+                    rest = (page.convert('RGB') for page in pages[1:])
+                else:
+                    rest = pages[1:]
+                first.save(output_path, format=output_format.upper(), save_all=True, append_images=list(rest),
+                           **encoder_options('pil', output_format, profile, quality))
+            finally:
+                for page in pages:
+                    page.close()
+            return True
+        except Exception as e:
+            errors.append(f"PIL: {str(e)}")
+    
+    # 2. Попытка использовать Wand
+    if HAVE_WAND:
+        try:
+            with WandImage() as document:
+                for path in page_paths:
+                    with WandImage(filename=path) as page:
+                        document.sequence.append(page)
+                document.format = output_format.upper()
+                _apply_wand_encoder(document, output_format, profile, quality)
+                document.save(filename=output_path)
+            return True
+        except Exception as e:
+            errors.append(f"Wand: {str(e)}")
+    
+    raise Exception("Failed to assemble pages using any method:\n" + "\n".join(errors))
+
+def assemble_multipage_outputs(assemblies):
+    """Собирает все документы после постраничной конвертации и чистит временные файлы"""
+    errors = []
+    for input_path, output_path, output_format, page_paths, temp_dir, options in assemblies:
+        try:
+            missing = [path for path in page_paths if not os.path.exists(path)]
+            if missing:
+                raise Exception(f"{len(missing)} page(s) failed to render")
+            assemble_pages(page_paths, output_path, output_format, options.get('profile'), options.get('quality'))
+        except Exception as e:
+            errors.append((input_path, str(e)))
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return errors
+
+def discard_multipage_outputs(assemblies):
+    """Удаляет временные страницы документов, которые не будут собраны (после отмены)"""
+    for assembly in assemblies:
+        shutil.rmtree(assembly[4], ignore_errors=True)
+
+# Форматы, которые могут хранить анимацию
+ANIMATED_INPUTS = {'gif', 'webp', 'png', 'apng', 'avif'}
+ANIMATED_OUTPUTS = {'gif', 'webp', 'png', 'avif'}
+
+def is_animated(input_path):
+    """Проверяет по заголовку, есть ли в файле (путь или байты) больше одного кадра"""
+    if HAVE_PIL:
+        try:
+            with PILImage.open(io.BytesIO(input_path) if isinstance(input_path, bytes) else input_path) as img:
+                return getattr(img, 'is_animated', False)
+        except Exception:
+            pass
+    if HAVE_VIPS:
+        try:
+            if isinstance(input_path, bytes):
+                image = pyvips.Image.new_from_buffer(input_path, "")
+            else:
+                image = pyvips.Image.new_from_file(input_path)
+            return 'n-pages' in image.get_fields() and image.get('n-pages') > 1
+        except Exception:
+            pass
+    return False
+
+def _needs_animation_pipeline(input_path, output_format, options, input_format=None):
+    ext = input_format or os.path.splitext(input_path.lower())[1][1:]
+    return (ext in ANIMATED_INPUTS and canonical_format(output_format) in ANIMATED_OUTPUTS
+            and options.get('page') is None and is_animated(input_path))
+
+class _FrameDurations(list):
+    """Задержки кадров для save_all, которые читаются в том же проходе, что и кадры.
+    
+    Кодеры PIL берут duration[i], когда исходник уже переведён на кадр i,
+    поэтому задержка читается из текущего кадра без отдельного прохода по файлу.
+    """
+    def __init__(self, image):
+        super().__init__()
+        self._image = image
+    
+    def __getitem__(self, index):
+        return self._image.info.get('duration', 100)
+
+def convert_animation(input_path, output_path, output_format, options=None):
+    """Конвертирует анимацию целиком, не держа в памяти все декодированные кадры.
+    
+    pyvips читает кадры последовательно как одну "ленту" и кодирует ее потоком.
+    PIL получает исходный файл как последовательность: кадры декодируются по одному
+    при записи, задержка каждого кадра читается в том же проходе. ImageMagick
+    читает все кадры сразу и пробуется последним. input_path может быть байтами;
+    без output_path результат возвращается байтами.
+    """
+    options = options or {}
+    from_bytes = isinstance(input_path, bytes)
+    fmt = canonical_format(output_format)
+    profile = options.get('profile')
+    dedupe = options.get('dedupe_frames', True)
+    reuse_palette = options.get('reuse_palette', False)
+    strip = options.get('metadata', MetadataPolicy.KEEP) in (MetadataPolicy.STRIP, MetadataPolicy.ORIENT_STRIP)
+    errors = []
+    
+    # 1. Pyvips: n=-1 загружает все кадры, sequential - построчно и без кэша целого растра
+    if HAVE_VIPS and fmt != 'png':
+        try:
+            if from_bytes:
+                image = pyvips.Image.new_from_buffer(input_path, "", n=-1, access='sequential')
+            else:
+                image = pyvips.Image.new_from_file(input_path, n=-1, access='sequential')
+            save_options = encoder_options('vips', fmt, profile)
+            if fmt == 'gif' and reuse_palette:
+                # Палитра исходного GIF вместо повторного квантования каждого кадра
+                save_options['reuse'] = True
+            elif fmt == 'webp' and dedupe:
+                # Совпадающие кадры схлопываются в один с увеличенной задержкой
+                save_options['min_size'] = True
+            if strip:
+                save_options['strip'] = True
+            if output_path is None:
+                return image.write_to_buffer(f".{fmt}", **save_options)
+            image.write_to_file(output_path, **save_options)
+            return True
+        except Exception as e:
+            errors.append(f"Vips: {str(e)}")
+    
+    # 2. PIL: save_all с исходным файлом в качестве последовательности кадров
+    if HAVE_PIL:
+        try:
+            with PILImage.open(io.BytesIO(input_path) if from_bytes else input_path) as img:
+                save_options = encoder_options('pil', fmt, profile)
+                save_options.update(save_all=True, duration=_FrameDurations(img), loop=img.info.get('loop', 0))
+                if fmt == 'webp':
+                    save_options['minimize_size'] = dedupe
+                elif fmt == 'gif' and reuse_palette and img.mode == 'P':
+                    save_options['palette'] = img.getpalette()
+                elif fmt == 'png':
+                    # APNG: кадры, совпадающие с предыдущим, PIL объединяет сам
+                    save_options['default_image'] = False
+                buffer = io.BytesIO() if output_path is None else output_path
+                img.save(buffer, format=_pil_format_name(fmt), **save_options)
+            return buffer.getvalue() if output_path is None else True
+        except Exception as e:
+            errors.append(f"PIL: {str(e)}")
+    
+    # 3. Wand: держит все кадры в памяти, используется последним
+    if HAVE_WAND:
+        try:
+            with (WandImage(blob=input_path) if from_bytes else WandImage(filename=input_path)) as img:
+                if strip:
+                    img.strip()
+                if dedupe and fmt in ('gif', 'webp'):
+                    img.optimize_layers()
+                img.format = fmt.upper()
+                _apply_wand_encoder(img, fmt, profile)
+                if output_path is None:
+                    return img.make_blob()
+                img.save(filename=output_path)
+            return True
+        except Exception as e:
+            errors.append(f"Wand: {str(e)}")
+    
+    raise Exception("Failed to convert animation using any method:\n" + "\n".join(errors))
+
+# Параметры DeepZoom-пирамиды
+DZI_TILE_SIZE = 254
+DZI_OVERLAP = 1
+
+def _dzi_descriptor(width, height, tile_size, overlap, tile_format):
+    """Возвращает XML-описание пирамиды DeepZoom"""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+        f'Format="{tile_format}" Overlap="{overlap}" TileSize="{tile_size}">\n'
+        f'  <Size Width="{width}" Height="{height}"/>\n'
+        '</Image>\n'
+    )
+
+def _save_dzi_tile(level_image, box, tile_path, tile_format):
+    """Вырезает и сохраняет один тайл уровня"""
+    tile = level_image.crop(box)
+    if tile_format == 'jpg':
+        tile.save(tile_path, format='JPEG', quality=90)
+    else:
+        tile.save(tile_path, format=tile_format.upper())
+
+def generate_pyramid(input_path, output_path, tile_size=DZI_TILE_SIZE, overlap=DZI_OVERLAP,
+                     tile_format='jpg', max_workers=None, transforms=None):
+    """Строит DeepZoom-пирамиду (файл .dzi и папку _files) из одного декодирования"""
+    base_path = os.path.splitext(output_path)[0]
+    errors = []
+    
+    # 1. Pyvips умеет строить пирамиду потоково
+    if HAVE_VIPS:
+        try:
+            if transforms:
+                # Поворот и обрезка читают растр не по порядку строк
+                image = get_backend(ProcessingLibrary.VIPS).transform(pyvips.Image.new_from_file(input_path),
+                                                                      transforms)
+            else:
+                image = pyvips.Image.new_from_file(input_path, access='sequential')
+            if tile_format == 'jpg' and image.hasalpha():
+                image = image.flatten(background=[255, 255, 255])
+            image.dzsave(
+                base_path,
+                tile_size=tile_size,
+                overlap=overlap,
+                suffix=f".{tile_format}[Q=90]" if tile_format == 'jpg' else f".{tile_format}"
+            )
+            return True
+        except Exception as e:
+            errors.append(f"Vips: {str(e)}")
+    
+    # 2. PIL: каждый уровень уменьшается из предыдущего, тайлы кодируются параллельно
+    if HAVE_PIL:
+        try:
+            with PILImage.open(input_path) as img:
+                if transforms:
+                    img = get_backend(ProcessingLibrary.PIL).transform(img, transforms)
+                if tile_format == 'jpg':
+                    if img.mode in ('RGBA', 'LA', 'P'):
+                        img = img.convert('RGBA')
+                        level_image = PILImage.new('RGB', img.size, (255, 255, 255))
+                        level_image.paste(img, mask=img.split()[3])
+                    else:
+                        level_image = img.convert('RGB')
+                else:
+                    level_image = img.convert('RGBA')
+            
+            width, height = level_image.size
+            max_level = math.ceil(math.log2(max(width, height, 1)))
+            tiles_dir = f"{base_path}_files"
+            
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+                for level in range(max_level, -1, -1):
+                    level_dir = os.path.join(tiles_dir, str(level))
+                    os.makedirs(level_dir, exist_ok=True)
+                    level_width, level_height = level_image.size
+                    
+                    futures = []
+                    for col in range(math.ceil(level_width / tile_size)):
+                        for row in range(math.ceil(level_height / tile_size)):
+                            box = (
+                                max(col * tile_size - overlap, 0),
+                                max(row * tile_size - overlap, 0),
+                                min((col + 1) * tile_size + overlap, level_width),
+                                min((row + 1) * tile_size + overlap, level_height)
+                            )
+                            tile_path = os.path.join(level_dir, f"{col}_{row}.{tile_format}")
+                            futures.append(executor.submit(
+                                _save_dzi_tile, level_image, box, tile_path, tile_format
+                            ))
+                    
+                    # Следующий уровень уменьшаем из текущего, пока тайлы кодируются
+                    if level > 0:
+                        next_image = level_image.resize(
+                            (max(1, math.ceil(level_width / 2)), max(1, math.ceil(level_height / 2))),
+                            PILImage.BOX
+                        )
+                    for future in futures:
+                        future.result()
+                    if level > 0:
+                        level_image = next_image
+            
+            with open(f"{base_path}.dzi", 'w', encoding='utf-8') as f:
+                f.write(_dzi_descriptor(width, height, tile_size, overlap, tile_format))
+            return True
+        except Exception as e:
+            errors.append(f"PIL: {str(e)}")
+    
+    raise Exception("Failed to build pyramid using any method:\n" + "\n".join(errors))
+
+# Архивы, которые принимаются как источник изображений
+ARCHIVE_EXTENSIONS = ('.zip', '.cbz', '.tar', '.cbt', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+# Форматы, которые уже сжаты и не выигрывают от deflate внутри ZIP
+PRECOMPRESSED_FORMATS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'avif', 'heic', 'heif', 'jpegxl'}
+
+# Открытые архивы: (pid, путь) -> (архив, блокировка)
+_ARCHIVE_HANDLES = {}
+_ARCHIVE_HANDLES_LOCK = threading.Lock()
+
+def is_archive(path):
+    return isinstance(path, str) and path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def _open_archive(archive_path):
+    """Возвращает закэшированный в процессе дескриптор архива.
+    
+    Ключ включает pid: дочерний процесс, созданный через fork, наследует
+    дескрипторы родителя вместе с общим смещением в файле и должен открыть свои.
+    """
+    key = (os.getpid(), os.path.abspath(archive_path))
+    with _ARCHIVE_HANDLES_LOCK:
+        entry = _ARCHIVE_HANDLES.get(key)
+        if entry is None:
+            if zipfile.is_zipfile(archive_path):
+                handle = zipfile.ZipFile(archive_path)
+            else:
+                handle = tarfile.open(archive_path)
+            entry = (handle, threading.Lock())
+            _ARCHIVE_HANDLES[key] = entry
+        return entry
+
+def list_archive_images(archive_path):
+    """Возвращает отсортированные имена изображений внутри архива"""
+    handle, lock = _open_archive(archive_path)
+    with lock:
+        if isinstance(handle, zipfile.ZipFile):
+            names = [info.filename for info in handle.infolist() if not info.is_dir()]
+        else:
+            names = [member.name for member in handle.getmembers() if member.isfile()]
+    
+    result = []
+    for name in names:
+        normalized = name.replace('\\', '/')
+        # Пропускаем абсолютные пути и выход за пределы архива
+        if normalized.startswith('/') or '..' in normalized.split('/'):
+            continue
+        if os.path.splitext(normalized.lower())[1] in IMAGE_EXTENSIONS:
+            result.append(name)
+    return sorted(result)
+
+def read_archive_member(archive_path, name):
+    """Читает один элемент архива без распаковки на диск"""
+    handle, lock = _open_archive(archive_path)
+    if isinstance(handle, zipfile.ZipFile):
+        # Потоки одного процесса: ZipFile сам синхронизирует чтение, распаковка идёт параллельно
+        with handle.open(name) as f:
+            return f.read()
+    with lock:
+        return handle.extractfile(name).read()
+
+class ArchiveMember(collections.namedtuple('ArchiveMember', ['archive', 'name'])):
+    """Изображение внутри ZIP/CBZ/TAR-архива"""
+    __slots__ = ()
+    
+    def read(self):
+        return read_archive_member(self.archive, self.name)
+    
+    def open(self):
+        return io.BytesIO(self.read())
+    
+    def size(self):
+        handle, lock = _open_archive(self.archive)
+        with lock:
+            if isinstance(handle, zipfile.ZipFile):
+                return handle.getinfo(self.name).file_size
+            return handle.getmember(self.name).size
+    
+    def __str__(self):
+        return f"{self.archive}::{self.name}"
+
+def _convert_archive_member(archive_path, name, output_format, needs_alpha_removal, options=None):
+    """Конвертирует один элемент архива в процессе-воркере"""
+    try:
+        data = read_archive_member(archive_path, name)
+        return ('ok', convert_bytes(data, to=output_format, alpha_removal=needs_alpha_removal, **(options or {})))
+    except Exception as e:
+        return ('error', str(e))
+
+def convert_archive(archive_path, output_folder, output_format, to_archive=False,
+                    progress_callback=None, max_workers=None, options=None, progress=None, token=None):
+    """Конвертирует изображения архива, читая элементы параллельно в процессах"""
+    members = list_archive_images(archive_path)
+    errors = []
+    progress_info = ProgressInfo(len(members))
+    if progress is not None:
+        progress.add_total(len(members))
+    needs_alpha_removal = output_format in ['jpg', 'jpeg', 'bmp']
+    name = os.path.basename(archive_path)
+    stem = name[:-len(next(ext for ext in ARCHIVE_EXTENSIONS if name.lower().endswith(ext)))]
+    
+    output_archive = None
+    if to_archive:
+        suffix = '.cbz' if name.lower().endswith(('.cbz', '.cbt')) else '.zip'
+        output_archive = zipfile.ZipFile(os.path.join(output_folder, stem + suffix), 'w')
+    compress_type = zipfile.ZIP_STORED if output_format in PRECOMPRESSED_FORMATS else zipfile.ZIP_DEFLATED
+    
+    # Воркеры обгоняют запись не больше чем на окно, чтобы пауза и отмена срабатывали сразу
+    window = (max_workers or os.cpu_count() or 1) * 2
+    remaining = iter(members)
+    pending = collections.deque()
+    
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            def fill():
+                while len(pending) < window and not (token is not None and (token.cancelled or token.paused)):
+                    member = next(remaining, None)
+                    if member is None:
+                        return
+                    pending.append((member, executor.submit(
+                        _convert_archive_member, archive_path, member, output_format, needs_alpha_removal, options
+                    )))
+            
+            while True:
+                if not pending:
+                    # Все выданные задачи готовы: на паузе ждем здесь
+                    if token is not None and not token.wait_if_paused():
+                        break
+                    fill()
+                    if not pending:
+                        break
+                # Очередь сохраняет порядок элементов
+                member, future = pending.popleft()
+                state, payload = future.result()
+                if token is not None and token.aborted:
+                    continue
+                output_name = f"{os.path.splitext(member)[0]}.{output_format}"
+                if state != 'ok':
+                    errors.append((f"{archive_path}::{member}", payload))
+                elif output_archive is not None:
+                    output_archive.writestr(output_name, payload, compress_type=compress_type)
+                else:
+                    output_path = os.path.join(output_folder, stem, *output_name.replace('\\', '/').split('/'))
+                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                    with open(output_path, 'wb') as f:
+                        f.write(payload)
+                
+                progress_info.complete_file()
+                if progress is not None:
+                    progress.advance(failed=state != 'ok')
+                if progress_callback:
+                    progress_callback(1.0, progress_info)
+                fill()
+    finally:
+        if output_archive is not None:
+            output_archive.close()
+            if token is not None and token.aborted:
+                _remove_partial_output(output_archive.filename)
+    
+    return errors
+
+def _pil_source(source):
+    """Путь для PIL или файловый объект для элемента архива"""
+    return source.open() if isinstance(source, ArchiveMember) else source
+
+class DecodedImageCache:
+    """LRU-кэш декодированных изображений с лимитом по байтам и выгрузкой на диск"""
+    def __init__(self, max_bytes=512 * 1024 * 1024, spill_dir=None, compress=True):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_bytes * 4
+        self.compress = compress
+        self.current_bytes = 0
+        self.spill_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._spilled = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def configure(self, max_bytes=None, spill_dir=None, compress=None):
+        """Меняет бюджет и папку выгрузки, вытесняя лишнее"""
+        with self._lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+                self.max_spill_bytes = max_bytes * 4
+            if spill_dir != self.spill_dir:
+                self._clear_spilled()
+                self.spill_dir = spill_dir
+            if compress is not None:
+                self.compress = compress
+            self._evict()
+    
+    @staticmethod
+    def make_key(path, kind):
+        """Ключ кэша: путь, время изменения, размер файла и тип растра"""
+        if isinstance(path, ArchiveMember):
+            stat = os.stat(path.archive)
+            return (str(path), stat.st_mtime_ns, path.size(), kind)
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, kind)
+    
+    @staticmethod
+    def _nbytes(image):
+        if HAVE_NUMPY and isinstance(image, np.ndarray):
+            return image.nbytes
+        if HAVE_PIL and isinstance(image, PILImage.Image):
+            return image.width * image.height * len(image.getbands())
+        if HAVE_VIPS and isinstance(image, pyvips.Image):
+            return image.width * image.height * image.bands
+        # Wand: ImageMagick держит до 4 каналов по 16 бит
+        return image.width * image.height * 8
+    
+    def get(self, path, loader, kind='pil'):
+        """Возвращает растр из кэша или декодирует его через loader(path)"""
+        key = self.make_key(path, kind)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            image = self._load_spilled(key)
+            if image is not None:
+                self.hits += 1
+                self._store(key, image)
+                return image
+            self.misses += 1
+        
+        # Декодируем вне блокировки, чтобы не тормозить другие потоки
+        image = loader(path)
+        if image is None:
+            raise ValueError(f"Cannot decode {path}")
+        with self._lock:
+            self._store(key, image)
+        return image
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self._clear_spilled()
+    
+    def _store(self, key, image):
+        size = self._nbytes(image)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.current_bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (image, size)
+        self.current_bytes += size
+        self._evict()
+    
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            key, (image, size) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+            self._spill(key, image)
+    
+    def _spill_path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.spill_dir, f"{digest}.raw")
+    
+    def _spill(self, key, image):
+        """Сохраняет вытесненный растр на диск (сырой или сжатый zlib)"""
+        if not self.spill_dir or key in self._spilled:
+            return
+        # На диск выгружаются только растры PIL и NumPy
+        if not ((HAVE_NUMPY and isinstance(image, np.ndarray))
+                or (HAVE_PIL and isinstance(image, PILImage.Image))):
+            return
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            if hasattr(image, 'nbytes'):
+                header = {'kind': 'array', 'shape': list(image.shape), 'dtype': str(image.dtype)}
+                payload = image.tobytes()
+            else:
+                header = {'kind': 'pil', 'mode': image.mode, 'size': list(image.size)}
+                payload = image.tobytes()
+                if image.mode == 'P':
+                    header['palette'] = image.getpalette()
+            header['compressed'] = self.compress
+            if self.compress:
+                payload = zlib.compress(payload, 1)
+            spill_path = self._spill_path(key)
+            with open(spill_path, 'wb') as f:
+                f.write(json.dumps(header).encode('utf-8') + b'\n')
+                f.write(payload)
+            size = os.path.getsize(spill_path)
+            self._spilled[key] = size
+            self.spill_bytes += size
+            while self.spill_bytes > self.max_spill_bytes and self._spilled:
+                old_key, old_size = self._spilled.popitem(last=False)
+                self.spill_bytes -= old_size
+                try:
+                    os.remove(self._spill_path(old_key))
+                except OSError:
+                    pass
+        except Exception:
+            # Не удалось выгрузить (нет места, нет прав) - растр просто вытесняется,
+            # недописанный файл удаляем
+            try:
+                os.remove(self._spill_path(key))
+            except OSError:
+                pass
+    
+    def _load_spilled(self, key):
+        if key not in self._spilled:
+            return None
+        size = self._spilled.pop(key)
+        self.spill_bytes -= size
+        spill_path = self._spill_path(key)
+        try:
+            with open(spill_path, 'rb') as f:
+                header = json.loads(f.readline())
+                payload = f.read()
+            if header['compressed']:
+                payload = zlib.decompress(payload)
+            if header['kind'] == 'array':
+                return np.frombuffer(payload, dtype=header['dtype']).reshape(header['shape']).copy()
+            image = PILImage.frombytes(header['mode'], tuple(header['size']), payload)
+            if 'palette' in header:
+                image.putpalette(header['palette'])
+            return image
+        except Exception:
+            return None
+        finally:
+            try:
+                os.remove(spill_path)
+            except OSError:
+                pass
+    
+    def _clear_spilled(self):
+        for key in self._spilled:
+            try:
+                os.remove(self._spill_path(key))
+            except OSError:
+                pass
+        self._spilled.clear()
+        self.spill_bytes = 0
+
+def _load_cv2_image(path):
+    """Декодирует изображение OpenCV без EXIF-поворота, как в заголовке"""
+    flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+    if isinstance(path, ArchiveMember):
+        return cv2.imdecode(np.frombuffer(path.read(), dtype=np.uint8), flags)
+    return cv2.imread(path, flags)
+
+def _load_pil_image(path):
+    """Полностью декодирует изображение PIL (load() сам закрывает файл)"""
+    img = PILImage.open(_pil_source(path))
+    img.load()
+    return img
+
+# Общий кэш декодированных изображений для повторных склеиваний
+MERGE_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'ami_file_cache')
+MERGE_CACHE = DecodedImageCache()
+
+class MergeLayout:
+    HORIZONTAL = "horizontal"
+    VERTICAL = "vertical"
+    GRID = "grid"
+    CONTACT_SHEET = "contact_sheet"
+
+def _vips_open(source):
+    if isinstance(source, ArchiveMember):
+        return pyvips.Image.new_from_buffer(source.read(), "")
+    return pyvips.Image.new_from_file(source)
+
+def _wand_open(source, **kwargs):
+    if isinstance(source, ArchiveMember):
+        return WandImage(blob=source.read(), **kwargs)
+    return WandImage(filename=source, **kwargs)
+
+def read_image_size(path):
+    """Возвращает (ширина, высота), читая только заголовок файла"""
+    if HAVE_PIL:
+        try:
+            with PILImage.open(_pil_source(path)) as img:
+                return img.size
+        except Exception:
+            pass
+    if HAVE_VIPS:
+        try:
+            image = _vips_open(path)
+            return image.width, image.height
+        except Exception:
+            pass
+    if HAVE_WAND:
+        try:
+            with _wand_open(path, ping=True) as img:
+                return img.width, img.height
+        except Exception:
+            pass
+    if HAVE_CV2:
+        # OpenCV не умеет читать только заголовок
+        img = _load_cv2_image(path)
+        if img is not None:
+            return img.shape[1], img.shape[0]
+    raise ValueError(f"Cannot read image size: {path}")
+
+def _fit_size(width, height, box_width, box_height):
+    """Вписывает размер в прямоугольник с сохранением пропорций"""
+    scale = min(box_width / width, box_height / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def plan_merge_layout(sizes, layout, columns=0, tile_size=0, scale_to_fit=False, spacing=0):
+    """Рассчитывает размер холста и позиции (x, y, w, h) всех изображений по их размерам"""
+    count = len(sizes)
+    if count == 0:
+        raise ValueError("No images to lay out")
+    placements = []
+    
+    if layout == MergeLayout.GRID:
+        columns = columns or math.ceil(math.sqrt(count))
+        rows = math.ceil(count / columns)
+        if tile_size:
+            # Ячейка задаётся шириной, высота по средним пропорциям
+            avg_ratio = sum(h / w for w, h in sizes) / count
+            cell_width, cell_height = tile_size, max(1, round(tile_size * avg_ratio))
+        else:
+            cell_width = max(w for w, _ in sizes)
+            cell_height = max(h for _, h in sizes)
+        
+        for i, (width, height) in enumerate(sizes):
+            if scale_to_fit or width > cell_width or height > cell_height:
+                width, height = _fit_size(width, height, cell_width, cell_height)
+            col, row = i % columns, i // columns
+            x = col * (cell_width + spacing) + (cell_width - width) // 2
+            y = row * (cell_height + spacing) + (cell_height - height) // 2
+            placements.append((x, y, width, height))
+        
+        canvas_width = columns * cell_width + (columns - 1) * spacing
+        canvas_height = rows * cell_height + (rows - 1) * spacing
+        return (canvas_width, canvas_height), placements
+    
+    if layout == MergeLayout.CONTACT_SHEET:
+        # Плотная упаковка рядами одинаковой высоты, выровненными по ширине листа
+        row_height = tile_size or sorted(h for _, h in sizes)[count // 2]
+        scaled = [max(1, round(w * row_height / h)) for w, h in sizes]
+        sheet_width = max(max(scaled), round(math.sqrt(sum(scaled) * row_height)))
+        if columns:
+            sheet_width = max(sheet_width, round(sum(scaled) / math.ceil(count / columns)))
+        
+        rows = []
+        current = []
+        current_width = 0
+        for i, width in enumerate(scaled):
+            extended = current_width + (spacing if current else 0) + width
+            if current and extended > sheet_width:
+                # Берём изображение в ряд, если ряд сожмётся меньше, чем растянулся бы без него
+                if extended - sheet_width < sheet_width - current_width:
+                    current.append(i)
+                    rows.append(current)
+                    current, current_width = [], 0
+                    continue
+                rows.append(current)
+                current, extended = [], width
+            current.append(i)
+            current_width = extended
+            if current_width >= sheet_width:
+                rows.append(current)
+                current, current_width = [], 0
+        if current:
+            rows.append(current)
+        
+        placements = [None] * count
+        y = 0
+        for row_index, row in enumerate(rows):
+            gaps = spacing * (len(row) - 1)
+            natural = sum(scaled[i] for i in row)
+            factor = (sheet_width - gaps) / natural
+            # Последний ряд не растягиваем, только сжимаем
+            if row_index == len(rows) - 1:
+                factor = min(factor, 1.0)
+            height = max(1, round(row_height * factor))
+            x = 0
+            for i in row:
+                width = max(1, round(scaled[i] * factor))
+                placements[i] = (x, y, width, height)
+                x += width + spacing
+            y += height + spacing
+        
+        canvas_width = max(x + w for x, _, w, _ in placements)
+        return (canvas_width, y - spacing), placements
+    
+    # Горизонтальная и вертикальная склейка в один ряд
+    if layout == MergeLayout.HORIZONTAL:
+        x = 0
+        for width, height in sizes:
+            placements.append((x, 0, width, height))
+            x += width + spacing
+        return (x - spacing, max(h for _, h in sizes)), placements
+    
+    y = 0
+    for width, height in sizes:
+        placements.append((0, y, width, height))
+        y += height + spacing
+    return (max(w for w, _ in sizes), y - spacing), placements
+
+def _prepare_tile(img, width, height):
+    """Приводит изображение к RGB на белом фоне и нужному размеру"""
+    if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = PILImage.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    if img.size != (width, height):
+        img = img.resize((width, height), PILImage.LANCZOS, reducing_gap=3.0)
+    return img
+
+def composite_layout(images, canvas_size, placements, output_path, output_format='png',
+                     load=None, max_workers=None, profile=None, preferred=None):
+    """Параллельно вставляет изображения в заранее выделенный холст"""
+    errors = []
+    load = load or (lambda path, loader, kind: loader(path))
+    workers = max_workers or min(os.cpu_count() or 1, len(images))
+    
+    # У склеенного холста нет исходных метаданных, так что писать их не нужно
+    for backend in route_backends(None, output_format, metadata=MetadataPolicy.STRIP,
+                                  preferred=preferred, operation='merge'):
+        try:
+            return backend.merge(images, canvas_size, placements, output_path, output_format,
+                                 load=load, workers=workers, profile=profile)
+        except Exception as e:
+            errors.append(f"{backend.label}: {str(e)}")
+    
+    raise Exception("Failed to composite images using any method:\n" + "\n".join(errors))
+
+def merge_images_optimized(images, direction='horizontal', output_path=None, output_format='png',
+                           cache=MERGE_CACHE, layout_options=None, profile=None, backend=None):
+    """Оптимизированная функция слияния с резервными вариантами"""
+    # Повторная склейка берёт источники из кэша при любой раскладке. Сверх
+    # одного декодируемого источника память ограничена бюджетом кэша
+    # (лишнее вытесняется на диск), а не числом изображений
+    def load(path, loader, kind):
+        if cache is None:
+            return loader(path)
+        return cache.get(path, loader, kind)
+    
+    # Геометрия холста считается только по заголовкам, затем каждое изображение
+    # декодируется, вставляется в предвыделенный холст и сразу освобождается.
+    # Wand теперь такой же бэкенд склейки, как остальные, и умеет и сетку
+    sizes = [read_image_size(img) for img in images]
+    canvas_size, placements = plan_merge_layout(sizes, direction, **(layout_options or {}))
+    # В ряд склеиваем по одному изображению, сетку - параллельно
+    workers = None if direction in (MergeLayout.GRID, MergeLayout.CONTACT_SHEET) else 1
+    return composite_layout(
+        images, canvas_size, placements, output_path, output_format,
+        load=load, max_workers=workers, profile=profile, preferred=backend
+    )
+
+# Расширения, которые принимает склейка
+MERGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff',
+                    '.webp', '.svg', '.pdf', '.eps', '.psd', '.heic',
+                    '.avif', '.jpegxl', '.ico', '.ppm', '.rla', '.pcx',
+                    '.pnm', '.xbm', '.tga', '.djvu'}
+
+def collect_merge_images(input_path):
+    """Список изображений для склейки в том порядке, в котором они будут склеены"""
+    if is_archive(input_path) and os.path.isfile(input_path):
+        # Страницы читаются прямо из архива
+        return [ArchiveMember(input_path, name) for name in list_archive_images(input_path)]
+    if os.path.isdir(input_path):
+        return sorted([
+            os.path.join(input_path, f) for f in os.listdir(input_path)
+            if os.path.splitext(f.lower())[1] in MERGE_EXTENSIONS
+        ])
+    return sorted([f for f in input_path.split(";") if os.path.splitext(f.lower())[1] in MERGE_EXTENSIONS])
+
+def chunk_by_extent(sizes, limit, axis=1):
+    """Делит изображения на группы, сумма высот (axis=1) или ширин (axis=0) которых не больше limit.
+    
+    Изображение, которое само больше лимита, образует отдельную группу.
+    """
+    ranges = []
+    start = 0
+    total = 0
+    for index, size in enumerate(sizes):
+        if index > start and total + size[axis] > limit:
+            ranges.append((start, index))
+            start = index
+            total = 0
+        total += size[axis]
+    if start < len(sizes):
+        ranges.append((start, len(sizes)))
+    return ranges
+
+def parse_range_expression(expression, images, direction=MergeLayout.VERTICAL):
+    """Разбирает выражение диапазонов и сразу проверяет его по списку изображений.
+    
+    Элементы через запятую, точку с запятой или перевод строки:
+      7            - одно изображение
+      1-10         - с 1 по 10 включительно
+      11-          - с 11 до конца
+      every 8      - все изображения группами по 8
+      height 20000 - группы не выше 20000 px (при склейке по горизонтали - не шире)
+    Возвращает список (начало, конец): начало с 0, конец не включается.
+    """
+    count = len(images)
+    ranges = []
+    for item in re.split(r'[,;\n]+', expression):
+        item = item.strip().lower()
+        if not item:
+            continue
+        
+        match = re.fullmatch(r'(every|height|width)\s+(\d+)', item)
+        if match:
+            keyword, value = match.group(1), int(match.group(2))
+            if value < 1:
+                raise ValueError(f"Invalid range '{item}'")
+            if keyword == 'every':
+                ranges.extend((start, min(start + value, count)) for start in range(0, count, value))
+            else:
+                # Размеры читаются только из заголовков, параллельно
+                with concurrent.futures.ThreadPoolExecutor() as executor:
+                    sizes = list(executor.map(read_image_size, images))
+                axis = 0 if direction == MergeLayout.HORIZONTAL else 1
+                ranges.extend(chunk_by_extent(sizes, value, axis))
+            continue
+        
+        match = re.fullmatch(r'(\d+)\s*(?:(-)\s*(\d*))?', item)
+        if not match:
+            raise ValueError(f"Invalid range '{item}'")
+        start = int(match.group(1))
+        if match.group(3):
+            end = int(match.group(3))
+        else:
+            end = count if match.group(2) else start
+        if not 1 <= start <= end <= count:
+            raise ValueError(f"Range '{item}' is outside 1-{count}")
+        ranges.append((start - 1, end))
+    
+    if not ranges:
+        raise ValueError("No ranges given")
+    return ranges
+
+def plan_merge_jobs(images, ranges, output_folder, output_format):
+    """Список заданий склейки: (номер, изображения, путь результата)"""
+    return [
+        (number, images[start:end], os.path.join(output_folder, f"{number}.{output_format}"))
+        for number, (start, end) in enumerate(ranges, 1)
+    ]
+
+def run_merge_jobs(jobs, direction, output_format, layout_options=None, profile=None,
+                   max_workers=None, token=None, on_done=None):
+    """Выполняет задания склейки параллельно за один проход.
+    
+    В работе одновременно не больше max_workers заданий, так что пауза и отмена
+    (CancellationToken) срабатывают сразу. on_done(готово, всего) вызывается
+    после каждого задания. Возвращает ошибки как (номер, сообщение).
+    """
+    max_workers = max_workers or min(4, os.cpu_count() or 1)
+    errors = []
+    done = 0
+    remaining = iter(jobs)
+    running = {}
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            while len(running) < max_workers and not (token is not None and (token.cancelled or token.paused)):
+                job = next(remaining, None)
+                if job is None:
+                    break
+                number, range_images, output_path = job
+                future = executor.submit(
+                    merge_images_optimized, range_images, direction=direction, output_path=output_path,
+                    output_format=output_format, layout_options=layout_options, profile=profile
+                )
+                running[future] = job
+            
+            if not running:
+                # Все выданное готово: на паузе ждем здесь, иначе работа закончена
+                if token is not None and token.paused and token.wait_if_paused():
+                    continue
+                break
+            
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                number, _, output_path = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append((number, str(e)))
+                if token is not None and token.aborted:
+                    _remove_partial_output(output_path)
+                done += 1
+                if on_done:
+                    on_done(done, len(jobs))
+    
+    return errors
+
+# Миниатюры для просмотра порядка склейки
+THUMBNAIL_SIZE = 96
+THUMBNAIL_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'ami_file_thumbs')
+
+def thumbnail_cache_path(source, size=THUMBNAIL_SIZE, cache_dir=THUMBNAIL_CACHE_DIR):
+    """Путь миниатюры в дисковом кэше; меняется вместе с временем изменения файла"""
+    key = DecodedImageCache.make_key(source, f"thumb{size}")
+    return os.path.join(cache_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.png')
+
+def make_thumbnail(source, size=THUMBNAIL_SIZE, cache_dir=THUMBNAIL_CACHE_DIR):
+    """Создает PNG-миниатюру в дисковом кэше и возвращает путь к ней.
+    
+    Декодирование с уменьшением при загрузке: pyvips thumbnail, в PIL - draft для JPEG.
+    """
+    path = thumbnail_cache_path(source, size, cache_dir)
+    if os.path.exists(path):
+        return path
+    os.makedirs(cache_dir, exist_ok=True)
+    # Пишем во временный файл, чтобы параллельные запросы не увидели недописанный PNG
+    temp_path = f"{path[:-4]}.{os.getpid()}.{threading.get_ident()}.png"
+    errors = []
+    
+    if HAVE_VIPS:
+        try:
+            if isinstance(source, ArchiveMember):
+                image = pyvips.Image.thumbnail_buffer(source.read(), size)
+            else:
+                image = pyvips.Image.thumbnail(source, size)
+            image.write_to_file(temp_path)
+            os.replace(temp_path, path)
+            return path
+        except Exception as e:
+            errors.append(f"Vips: {str(e)}")
+    
+    if HAVE_PIL:
+        try:
+            with PILImage.open(_pil_source(source)) as img:
+                img.draft('RGB', (size, size))
+                img.thumbnail((size, size))
+                if img.mode not in ('RGB', 'RGBA', 'L', 'P'):
+                    img = img.convert('RGBA')
+                img.save(temp_path, format='PNG')
+            os.replace(temp_path, path)
+            return path
+        except Exception as e:
+            errors.append(f"PIL: {str(e)}")
+    
+    raise Exception("Failed to create thumbnail using any method:\n" + "\n".join(errors))
+
+def collect_result(result, args, errors, reports=None, stats=None):
+    """Раскладывает результат convert_image по ошибкам, отчетам о качестве и счетчику копий"""
+    if isinstance(result, tuple):
+        errors.append(result)
+    elif isinstance(result, dict) and reports is not None:
+        reports.append((args[0], result))
+    elif result == PASSTHROUGH and stats is not None:
+        stats[PASSTHROUGH] += 1
+
+def batch_convert(conversion_args, progress_callback=None, batch_size=10, reports=None, stats=None,
+                  progress=None, token=None):
+    """Обновленная версия с поддержкой расширенного прогресса
+    
+    Отчеты о подобранном качестве (словари) добавляются в reports как (путь, отчет),
+    в счетчик stats попадает число файлов, скопированных без перекодирования.
+    progress (ProgressAggregator) только увеличивается - его опрашивает интерфейс.
+    token (CancellationToken) останавливает выдачу задач; уже запущенные дорабатывают.
+    """
+    errors = []
+    total = len(conversion_args)
+    progress_info = ProgressInfo(total)
+    remaining = iter(conversion_args)
+    running = {}
+    
+    # В работе не больше batch_size задач. Пауза останавливает только выдачу новых:
+    # готовые результаты собираются и попадают в прогресс как обычно
+    workers = min(os.cpu_count() or 1, batch_size, max(total, 1))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while len(running) < batch_size and not (token is not None and (token.cancelled or token.paused)):
+                args = next(remaining, None)
+                if args is None:
+                    break
+                running[executor.submit(convert_image, args)] = args
+            
+            if not running:
+                # Все выданное готово: на паузе ждем здесь, иначе работа закончена
+                if token is not None and token.paused and token.wait_if_paused():
+                    continue
+                break
+            
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                args = running.pop(future)
+                result = future.result()
+                if token is not None and token.aborted:
+                    # Прерванная работа не должна оставлять файлы
+                    _remove_partial_output(args[1])
+                    continue
+                collect_result(result, args, errors, reports, stats)
+                
+                progress_info.complete_file()
+                if progress is not None:
+                    progress.advance(failed=isinstance(result, tuple))
+                if progress_callback:
+                    progress_callback(1.0, progress_info)  # Файл завершен
+    
+    return errors
+
+class ProgressInfo:
+    """Класс для хранения информации о прогрессе"""
+    def __init__(self, total_files):
+        self.total_files = total_files
+        self.processed_files = 0
+        self.current_file = 0
+        self.start_time = time.time()
+        self.file_start_time = time.time()
+        self.avg_file_time = 0
+        
+    def update_file_progress(self, progress):
+        """Обновляет прогресс текущего файла"""
+        self.current_file = progress
+        
+    def complete_file(self):
+        """Отмечает завершение обработки файла"""
+        self.processed_files += 1
+        current_time = time.time()
+        file_time = current_time - self.file_start_time
+        self.avg_file_time = (self.avg_file_time * (self.processed_files - 1) + file_time) / self.processed_files
+        self.file_start_time = current_time
+        
+    def get_eta(self):
+        """Возвращает расчетное время до завершения"""
+        if self.processed_files == 0:
+            return "Calculating..."
+        
+        elapsed_time = time.time() - self.start_time
+        files_left = self.total_files - self.processed_files
+        avg_time_per_file = elapsed_time / self.processed_files
+        return format_duration(files_left * avg_time_per_file)
+
+def format_duration(seconds):
+    """Форматирует оставшееся время: 42s, 3m 5s, 1h 20m"""
+    if seconds is None:
+        return "Calculating..."
+    if seconds < 60:
+        return f"{int(seconds)}s"
+    elif seconds < 3600:
+        return f"{int(seconds/60)}m {int(seconds%60)}s"
+    else:
+        hours = int(seconds/3600)
+        minutes = int((seconds%3600)/60)
+        return f"{hours}h {minutes}m"
+
+# Окно опрашивает сводный прогресс с этим периодом (10 раз в секунду)
+PROGRESS_POLL_MS = 100
+# Сколько секунд окно ждет завершения файлов в работе при закрытии
+CLOSE_TIMEOUT = 30
+
+ProgressSnapshot = collections.namedtuple('ProgressSnapshot', ['total', 'done', 'failed', 'elapsed', 'rate', 'eta'])
+
+class ProgressAggregator:
+    """Сводный прогресс, который пишут воркеры и читают интерфейс или консоль.
+    
+    Каждый поток увеличивает только свой счетчик, поэтому блокировки не нужны:
+    читатель суммирует счетчики с той частотой, с какой ему удобно.
+    """
+    def __init__(self, total=0):
+        self._totals = collections.defaultdict(int)
+        self._done = collections.defaultdict(int)
+        self._failed = collections.defaultdict(int)
+        self.start_time = time.monotonic()
+        self.finished = False
+        self.add_total(total)
+    
+    def add_total(self, count):
+        """Добавляет задачи, число которых стало известно по ходу (например, элементы архива)"""
+        self._totals[threading.get_ident()] += count
+    
+    def advance(self, count=1, failed=False):
+        ident = threading.get_ident()
+        self._done[ident] += count
+        if failed:
+            self._failed[ident] += count
+    
+    def finish(self):
+        self.finished = True
+    
+    def snapshot(self):
+        # list() копирует значения за один вызов, пока другие потоки добавляют ключи
+        total = sum(list(self._totals.values()))
+        done = sum(list(self._done.values()))
+        failed = sum(list(self._failed.values()))
+        elapsed = time.monotonic() - self.start_time
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (total - done) / rate if rate > 0 else None
+        return ProgressSnapshot(total, done, failed, elapsed, rate, eta)
+
+class CancellationToken:
+    """Общий флаг отмены и паузы для пакетной работы.
+    
+    Планировщик проверяет токен перед выдачей каждой задачи: на паузе новые
+    задачи не выдаются, после отмены - не выдаются вовсе. При abort результаты
+    задач, которые были в работе, удаляются вместо сохранения.
+    """
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+        self.aborted = False
+    
+    def cancel(self, abort=False):
+        self.aborted = self.aborted or abort
+        self._cancelled.set()
+        # Будим планировщик, если он ждет на паузе
+        self._running.set()
+    
+    def pause(self):
+        if not self.cancelled:
+            self._running.clear()
+    
+    def resume(self):
+        self._running.set()
+    
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+    
+    @property
+    def paused(self):
+        return not self._running.is_set()
+    
+    def wait_if_paused(self):
+        """Блокирует на паузе; возвращает False, если работа отменена"""
+        self._running.wait()
+        return not self.cancelled
+
+def _remove_partial_output(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class ConsoleProgressReporter:
+    """Печатает сводный прогресс в консоль с фиксированной частотой"""
+    def __init__(self, progress, interval=0.5, stream=None):
+        self.progress = progress
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self._stop_event = threading.Event()
+        self._thread = None
+        # В терминале строка перерисовывается, в логе - дописывается
+        self._inline = hasattr(self.stream, 'isatty') and self.stream.isatty()
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._print()
+        if self._inline:
+            self.stream.write("\n")
+        self.stream.flush()
+    
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._print()
+    
+    def _print(self):
+        snap = self.progress.snapshot()
+        line = (f"{snap.done}/{snap.total} files, {snap.failed} failed, "
+                f"{snap.rate:.1f} files/s, ETA {format_duration(snap.eta)}")
+        if self._inline:
+            self.stream.write("\r" + line.ljust(72))
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+# Расширения изображений, с которыми работает программа
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff',
+                    '.webp', '.svg', '.pdf', '.eps', '.psd', '.heic',
+                    '.avif', '.jpegxl', '.ico', '.ppm', '.rla', '.pcx',
+                    '.pnm', '.xbm', '.tga', '.djvu'}
+
+class JobPriority:
+    INTERACTIVE = "interactive"
+    BULK = "bulk"
+
+# Доли воркеров при конкуренции: интерактивное задание получает 16 задач из 17,
+# но массовое задание не останавливается полностью
+PRIORITY_WEIGHTS = {JobPriority.INTERACTIVE: 16, JobPriority.BULK: 1}
+
+class _FairJob:
+    __slots__ = ('priority', 'weight', 'cap', 'queue', 'in_flight', 'virtual_time')
+    
+    def __init__(self, priority, weight, cap, virtual_time):
+        self.priority = priority
+        self.weight = weight
+        self.cap = cap
+        self.queue = collections.deque()
+        self.in_flight = 0
+        self.virtual_time = virtual_time
+
+class FairScheduler:
+    """Очереди задач по заданиям со взвешенным справедливым разделением воркеров.
+    
+    У каждого задания своя очередь, вес по приоритету и необязательный лимит
+    одновременных задач. Выдаётся задача задания с наименьшим виртуальным
+    временем (start-time fair queuing), выдача сдвигает его на cost / вес.
+    Новое задание начинает с текущего виртуального времени: интерактивная
+    задача сразу идёт вперёд, а массовое задание продолжает получать свою долю.
+    """
+    def __init__(self, weights=None, max_queued=None):
+        self.weights = {**PRIORITY_WEIGHTS, **(weights or {})}
+        self.max_queued = max_queued
+        self._jobs = {}
+        self._virtual_time = 0.0
+        self._queued = 0
+        self._condition = threading.Condition()
+    
+    def __len__(self):
+        return self._queued
+    
+    def put(self, item, job='default', priority=JobPriority.INTERACTIVE, cap=None, cost=1.0):
+        """Ставит задачу в очередь задания; False, если очередь задания заполнена"""
+        if cap is not None and cap < 1:
+            raise ValueError("cap must be at least 1")
+        with self._condition:
+            state = self._jobs.get(job)
+            if state is None:
+                state = self._jobs[job] = _FairJob(priority, self.weights.get(priority, 1), cap,
+                                                   self._virtual_time)
+            elif cap is not None:
+                state.cap = cap
+            if not state.queue:
+                # Простаивавшее задание не копит кредит за время простоя
+                state.virtual_time = max(state.virtual_time, self._virtual_time)
+            if self.max_queued and len(state.queue) >= self.max_queued:
+                return False
+            state.queue.append((item, cost))
+            self._queued += 1
+            self._condition.notify()
+            return True
+    
+    def _pop(self):
+        chosen = None
+        for key, state in self._jobs.items():
+            if not state.queue or (state.cap is not None and state.in_flight >= state.cap):
+                continue
+            if chosen is None or state.virtual_time < self._jobs[chosen].virtual_time:
+                chosen = key
+        if chosen is None:
+            return None
+        state = self._jobs[chosen]
+        item, cost = state.queue.popleft()
+        self._queued -= 1
+        self._virtual_time = max(self._virtual_time, state.virtual_time)
+        state.virtual_time += cost / state.weight
+        state.in_flight += 1
+        return chosen, item
+    
+    def get_nowait(self):
+        """(задание, задача) или None, если выдавать нечего"""
+        with self._condition:
+            return self._pop()
+    
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                entry = self._pop()
+                if entry is not None:
+                    return entry
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+    
+    def task_done(self, job):
+        """Освобождает слот задания; опустевшее задание забывается"""
+        with self._condition:
+            state = self._jobs.get(job)
+            if state is None:
+                return
+            state.in_flight -= 1
+            if not state.queue and state.in_flight <= 0:
+                del self._jobs[job]
+            # Освободившийся слот мог снять ограничение cap
+            self._condition.notify_all()
+    
+    def snapshot(self):
+        """{задание: (приоритет, в очереди, в работе)} для метрик"""
+        with self._condition:
+            return {key: (state.priority, len(state.queue), state.in_flight)
+                    for key, state in self._jobs.items()}
+
+class ConversionPool:
+    """Постоянный пул воркеров для конвертации потока файлов без пересоздания.
+    
+    Задачи разных заданий делят потоки через FairScheduler, так что новый
+    файл не ждёт, пока закончится массовая обработка.
+    """
+    def __init__(self, max_workers=None, scheduler=None):
+        # Пустой планировщик ложен (__len__), поэтому сравниваем с None
+        self.scheduler = scheduler if scheduler is not None else FairScheduler()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._work, name=f'ami-convert-{i}', daemon=True)
+            for i in range(max_workers or os.cpu_count() or 1)
+        ]
+        for thread in self._threads:
+            thread.start()
+    
+    def submit(self, args, job='default', priority=JobPriority.INTERACTIVE, cap=None):
+        """Ставит задачу в очередь; если очередь задания заполнена, future сразу получает queue.Full"""
+        future = concurrent.futures.Future()
+        if not self.scheduler.put((future, args), job, priority, cap):
+            future.set_exception(queue.Full(f"Queue of job '{job}' is full"))
+        return future
+    
+    def _work(self):
+        while True:
+            entry = self.scheduler.get(timeout=0.25)
+            if entry is None:
+                # Потоки выходят только когда очередь пуста: shutdown дорабатывает всё принятое
+                if self._closed:
+                    return
+                continue
+            job, (future, args) = entry
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(convert_image(args))
+                    except Exception as e:
+                        future.set_exception(e)
+            finally:
+                self.scheduler.task_done(job)
+    
+    def shutdown(self, wait=True):
+        self._closed = True
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+class FolderWatcher:
+    """Следит за папкой и сразу конвертирует новые или изменённые файлы"""
+    IGNORED_SUFFIXES = ('.part', '.tmp', '.crdownload', '.download', '.partial')
+    
+    def __init__(self, input_folder, output_folder, output_format, pool=None,
+                 settle_time=0.5, poll_interval=0.25, use_polling=False,
+                 process_existing=False, page_mode=PageMode.AUTO, dpi=150, options=None, log=print):
+        self.input_folder = os.path.abspath(input_folder)
+        self.output_folder = output_folder
+        self.output_format = output_format
+        self.pool = pool or ConversionPool()
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.use_polling = use_polling or not HAVE_WATCHDOG
+        self.page_mode = page_mode
+        self.dpi = dpi
+        self.options = options or {}
+        self.log = log
+        self._pending = {}   # путь -> (подпись файла, время последнего изменения)
+        self._done = {}      # путь -> подпись уже сконвертированной версии
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._observer = None
+        self._thread = None
+        # Файлы, лежавшие в папке до запуска, идут массовым заданием и не задерживают новые
+        self._backlog = set()
+        
+        if process_existing:
+            self._backlog = set(self._list_images())
+        else:
+            for path in self._list_images():
+                signature = self._signature(path)
+                if signature:
+                    self._done[path] = signature
+    
+    def _list_images(self):
+        try:
+            entries = list(os.scandir(self.input_folder))
+        except OSError:
+            return []
+        return [entry.path for entry in entries if entry.is_file() and self._is_candidate(entry.path)]
+    
+    def _is_candidate(self, path):
+        name = os.path.basename(path).lower()
+        if name.startswith(('.', '~')) or name.endswith(self.IGNORED_SUFFIXES):
+            return False
+        return os.path.splitext(name)[1] in IMAGE_EXTENSIONS
+    
+    @staticmethod
+    def _signature(path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+    
+    def notify(self, path):
+        """Отмечает файл как изменённый; конвертация начнётся, когда запись закончится"""
+        path = os.path.abspath(path)
+        if os.path.dirname(path) != self.input_folder or not self._is_candidate(path):
+            return
+        signature = self._signature(path)
+        if signature is None or self._done.get(path) == signature:
+            return
+        with self._lock:
+            previous = self._pending.get(path)
+            if previous is None or previous[0] != signature:
+                self._pending[path] = (signature, time.monotonic())
+    
+    def start(self):
+        """Запускает наблюдение в фоне"""
+        # Уже лежащие файлы событий не дадут - ставим их в очередь сами (в обоих режимах)
+        for path in sorted(self._backlog):
+            self.notify(path)
+        if not self.use_polling:
+            watcher = self
+            
+            class Handler(FileSystemEventHandler):
+                def on_created(self, event):
+                    if not event.is_directory:
+                        watcher.notify(event.src_path)
+                
+                def on_modified(self, event):
+                    if not event.is_directory:
+                        watcher.notify(event.src_path)
+                
+                def on_moved(self, event):
+                    if not event.is_directory:
+                        watcher.notify(event.dest_path)
+            
+            self._observer = Observer()
+            self._observer.schedule(Handler(), self.input_folder, recursive=False)
+            self._observer.start()
+        
+        self._thread = threading.Thread(target=self._run, name='ami-watch', daemon=True)
+        self._thread.start()
+        mode = "polling" if self.use_polling else "events"
+        self.log(f"Watching {self.input_folder} ({mode}) -> {self.output_folder} [{self.output_format}]")
+    
+    def stop(self, wait=True):
+        """Останавливает наблюдение и дожидается активных конвертаций"""
+        self._stop.set()
+        if self._observer:
+            self._observer.stop()
+            self._observer.join()
+        if self._thread:
+            self._thread.join()
+        self.pool.shutdown(wait=wait)
+    
+    def run_forever(self):
+        """Блокирует до Ctrl+C"""
+        self.start()
+        try:
+            while not self._stop.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+    
+    def _run(self):
+        while not self._stop.is_set():
+            if self.use_polling:
+                for path in self._list_images():
+                    self.notify(path)
+            self._dispatch_settled()
+            self._stop.wait(self.poll_interval)
+    
+    def _dispatch_settled(self):
+        """Отправляет в пул файлы, размер и время изменения которых перестали меняться"""
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, (signature, changed_at) in list(self._pending.items()):
+                current = self._signature(path)
+                if current is None:
+                    del self._pending[path]
+                elif current != signature:
+                    self._pending[path] = (current, now)
+                elif now - changed_at >= self.settle_time:
+                    del self._pending[path]
+                    ready.append((path, signature))
+        
+        for path, signature in ready:
+            try:
+                # Файл, который ещё держит записывающий процесс, откладываем
+                with open(path, 'rb'):
+                    pass
+            except OSError:
+                with self._lock:
+                    self._pending[path] = (signature, now)
+                continue
+            self._done[path] = signature
+            self._convert(path)
+    
+    def _convert(self, input_path):
+        output_path = os.path.join(
+            self.output_folder,
+            f"{os.path.splitext(os.path.basename(input_path))[0]}.{self.output_format}"
+        )
+        needs_alpha_removal = self.output_format in ['jpg', 'jpeg', 'bmp']
+        tasks, assemblies = expand_multipage_tasks(
+            [(input_path, output_path, self.output_format, needs_alpha_removal, self.options)],
+            page_mode=self.page_mode,
+            dpi=self.dpi
+        )
+        started = time.monotonic()
+        remaining = [len(tasks)]
+        errors = []
+        lock = threading.Lock()
+        
+        def on_done(future):
+            try:
+                result = future.result()
+                if isinstance(result, tuple):
+                    errors.append(result)
+                elif isinstance(result, dict):
+                    self.log(format_quality_report(input_path, result))
+                elif result == PASSTHROUGH:
+                    self.log(f"Copied {os.path.basename(input_path)} without re-encoding")
+            except Exception as e:
+                errors.append((input_path, str(e)))
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            errors.extend(assemble_multipage_outputs(assemblies))
+            elapsed = time.monotonic() - started
+            if errors:
+                for path, error in errors:
+                    self.log(f"Failed {path}: {error}")
+            else:
+                self.log(f"Converted {os.path.basename(input_path)} in {elapsed:.2f}s")
+        
+        priority = JobPriority.BULK if input_path in self._backlog else JobPriority.INTERACTIVE
+        self._backlog.discard(input_path)
+        for task in tasks:
+            self.pool.submit(task, job=priority, priority=priority).add_done_callback(on_done)
+
+# MIME-типы для ответов HTTP-сервиса
+CONTENT_TYPES = {
+    'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'gif': 'image/gif',
+    'bmp': 'image/bmp', 'tiff': 'image/tiff', 'webp': 'image/webp', 'ico': 'image/x-icon',
+    'svg': 'image/svg+xml', 'pdf': 'application/pdf', 'eps': 'application/postscript',
+    'heic': 'image/heic', 'heif': 'image/heif', 'avif': 'image/avif', 'jpegxl': 'image/jxl',
+    'psd': 'image/vnd.adobe.photoshop', 'tga': 'image/x-tga', 'ppm': 'image/x-portable-pixmap',
+}
+
+def sniff_image_format(data):
+    """Определяет формат по сигнатуре первых байт"""
+    head = data[:32]
+    if head.startswith(b'\x89PNG'):
+        return 'png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'gif'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'webp'
+    if head.startswith((b'II*\x00', b'MM\x00*')):
+        return 'tiff'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    if head.startswith(b'%PDF'):
+        return 'pdf'
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in (b'avif', b'avis'):
+            return 'avif'
+        if brand in (b'heic', b'heix', b'mif1', b'msf1'):
+            return 'heic'
+    if head.startswith(b'\x00\x00\x01\x00'):
+        return 'ico'
+    return None
+
+def _service_convert_job(job):
+    """Выполняет одну задачу сервиса в процессе-воркере"""
+    try:
+        kind, source, output_path, output_format, options = job
+        needs_alpha_removal = output_format in ['jpg', 'jpeg', 'bmp']
+        
+        if kind == 'path' and output_path:
+            result = convert_image((source, output_path, output_format, needs_alpha_removal, options))
+            if isinstance(result, tuple):
+                return ('error', result[1])
+            return ('ok', json.dumps({'output': output_path}).encode('utf-8'))
+        
+        # Без временных файлов: декодирование и кодирование в памяти
+        if kind == 'path':
+            with open(source, 'rb') as f:
+                source = f.read()
+        return ('ok', convert_bytes(source, to=output_format, alpha_removal=needs_alpha_removal, **options))
+    except Exception as e:
+        return ('error', str(e))
+
+def _service_convert_batch(jobs):
+    """Микропакет задач за один вызов воркера"""
+    return [_service_convert_job(job) for job in jobs]
+
+def _service_warmup():
+    return os.getpid()
+
+class ServiceMetrics:
+    """Счётчики сервиса в текстовом формате Prometheus"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self):
+        self.requests = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.batches = 0
+        self.batch_items = 0
+        self.latency_buckets = [0] * len(self.BUCKETS)
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.started = time.time()
+    
+    def observe(self, code, latency, bytes_in, bytes_out):
+        self.requests[code] += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.latency_count += 1
+        self.latency_sum += latency
+        for i, bound in enumerate(self.BUCKETS):
+            if latency <= bound:
+                self.latency_buckets[i] += 1
+    
+    def render(self, queue_depth, in_flight, jobs=None):
+        lines = [
+            "# HELP ami_requests_total Conversion requests by HTTP status.",
+            "# TYPE ami_requests_total counter",
+        ]
+        for code, count in sorted(self.requests.items()):
+            lines.append(f'ami_requests_total{{code="{code}"}} {count}')
+        lines += [
+            "# HELP ami_request_duration_seconds Conversion request latency.",
+            "# TYPE ami_request_duration_seconds histogram",
+        ]
+        for bound, count in zip(self.BUCKETS, self.latency_buckets):
+            lines.append(f'ami_request_duration_seconds_bucket{{le="{bound}"}} {count}')
+        lines += [
+            f'ami_request_duration_seconds_bucket{{le="+Inf"}} {self.latency_count}',
+            f"ami_request_duration_seconds_sum {self.latency_sum:.6f}",
+            f"ami_request_duration_seconds_count {self.latency_count}",
+            "# TYPE ami_bytes_in_total counter",
+            f"ami_bytes_in_total {self.bytes_in}",
+            "# TYPE ami_bytes_out_total counter",
+            f"ami_bytes_out_total {self.bytes_out}",
+            "# TYPE ami_batches_total counter",
+            f"ami_batches_total {self.batches}",
+            "# TYPE ami_batch_items_total counter",
+            f"ami_batch_items_total {self.batch_items}",
+            "# TYPE ami_queue_depth gauge",
+            f"ami_queue_depth {queue_depth}",
+            "# TYPE ami_batches_in_flight gauge",
+            f"ami_batches_in_flight {in_flight}",
+            "# TYPE ami_job_queue_depth gauge",
+            "# TYPE ami_job_in_flight gauge",
+        ]
+        for job, (priority, queued, running) in sorted((jobs or {}).items()):
+            escaped = job.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            label = f'job="{escaped}",priority="{priority}"'
+            lines.append(f"ami_job_queue_depth{{{label}}} {queued}")
+            lines.append(f"ami_job_in_flight{{{label}}} {running}")
+        lines += [
+            "# TYPE ami_uptime_seconds gauge",
+            f"ami_uptime_seconds {time.time() - self.started:.1f}",
+        ]
+        return "\n".join(lines) + "\n"
+
+class ConversionService:
+    """Локальный HTTP-сервис конвертации с общим пулом процессов"""
+    REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 422: 'Unprocessable Entity', 503: 'Service Unavailable'}
+    
+    def __init__(self, host='127.0.0.1', port=8765, workers=None, queue_size=64,
+                 batch_size=8, batch_window=0.005, small_request=256 * 1024,
+                 max_body=256 * 1024 * 1024, bulk_cap=None, path_root=None):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count()
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.small_request = small_request
+        self.max_body = max_body
+        self.metrics = ServiceMetrics()
+        self.executor = None
+        self.scheduler = None
+        self.server = None
+        self._slots = None
+        self._wakeup = None
+        self._dispatcher = None
+        self._in_flight = 0
+        # Массовые задания по умолчанию оставляют свободный слот интерактивным запросам
+        self.bulk_cap = bulk_cap or max(1, self.workers * 2 - 1)
+        # path=/output= читают и пишут локальные файлы, поэтому выключены,
+        # пока не задана папка, за пределы которой они не выходят
+        self.path_root = os.path.realpath(path_root) if path_root else None
+    
+    def _local_path(self, path):
+        """Реальный путь внутри path_root или None, если путь выходит за её пределы"""
+        resolved = os.path.realpath(path)
+        if os.path.commonpath([resolved, self.path_root]) != self.path_root:
+            return None
+        return resolved
+    
+    async def start(self):
+        """Прогревает пул процессов и начинает принимать соединения"""
+        loop = asyncio.get_running_loop()
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        await asyncio.gather(*[
+            loop.run_in_executor(self.executor, _service_warmup) for _ in range(self.workers)
+        ])
+        # Очередь на каждое задание ограничена queue_size: массовое задание
+        # не может занять очередь интерактивных запросов
+        self.scheduler = FairScheduler(max_queued=self.queue_size)
+        self._wakeup = asyncio.Event()
+        # Не больше двух пакетов на воркер: остальное ждёт в очередях заданий
+        self._slots = asyncio.Semaphore(self.workers * 2)
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        self.server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        print(f"Ami File service listening on http://{self.host}:{self.port}")
+    
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        if self._dispatcher:
+            self._dispatcher.cancel()
+        if self.executor:
+            self.executor.shutdown(wait=True)
+    
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+    
+    def _is_small(self, entry):
+        return entry[1][2] <= self.small_request
+    
+    async def _next_entry(self, timeout=None):
+        """Следующая задача по решению планировщика; None по истечении timeout"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            entry = self.scheduler.get_nowait()
+            if entry is not None:
+                return entry
+            self._wakeup.clear()
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+    
+    async def _dispatch(self):
+        """Собирает мелкие запросы в микропакеты и отправляет их в пул.
+        
+        Слот пула занимается до выбора задачи, чтобы планировщик решал,
+        чья задача пойдёт следующей, в момент, когда воркер действительно свободен.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            first = await self._next_entry()
+            if not self._is_small(first):
+                self._start_batch([first])
+                continue
+            small = [first]
+            deadline = loop.time() + self.batch_window
+            while len(small) < self.batch_size:
+                entry = await self._next_entry(max(0.0, deadline - loop.time()))
+                if entry is None:
+                    break
+                if self._is_small(entry):
+                    small.append(entry)
+                    continue
+                # Крупный запрос идёт отдельным пакетом в свой слот
+                self._start_batch(small)
+                small = None
+                await self._slots.acquire()
+                self._start_batch([entry])
+                break
+            if small:
+                self._start_batch(small)
+    
+    def _start_batch(self, batch):
+        self._in_flight += 1
+        asyncio.create_task(self._run_batch(batch))
+    
+    async def _run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            jobs = [job for _, (job, _, _) in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, _service_convert_batch, jobs)
+            except Exception as e:
+                results = [('error', str(e))] * len(batch)
+            self.metrics.batches += 1
+            self.metrics.batch_items += len(batch)
+            for (_, (_, future, _)), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            for job_key, _ in batch:
+                self.scheduler.task_done(job_key)
+            self._in_flight -= 1
+            self._slots.release()
+            # Освободился лимит задания - задачи, ждавшие его, снова можно выдавать
+            self._wakeup.set()
+    
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                
+                length = int(headers.get('content-length', 0))
+                if length > self.max_body:
+                    await self._respond(writer, 413, 'text/plain', b'Payload too large\n', False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                
+                status, content_type, payload = await self._route(method, target, body)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, content_type, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+    
+    async def _respond(self, writer, status, content_type, payload, keep_alive):
+        head = (
+            f"HTTP/1.1 {status} {self.REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        )
+        if status == 503:
+            head += "Retry-After: 1\r\n"
+        writer.write(head.encode('latin-1') + b"\r\n" + payload)
+        await writer.drain()
+    
+    async def _route(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        
+        if url.path == '/metrics' and method == 'GET':
+            text = self.metrics.render(len(self.scheduler), self._in_flight, self.scheduler.snapshot())
+            return 200, 'text/plain; version=0.0.4', text.encode('utf-8')
+        if url.path == '/health' and method == 'GET':
+            return 200, 'text/plain', b'ok\n'
+        if url.path != '/convert':
+            return 404, 'text/plain', b'Not found\n'
+        if method != 'POST':
+            return 405, 'text/plain', b'Use POST\n'
+        
+        started = time.perf_counter()
+        status, content_type, payload = await self._convert(query, body)
+        self.metrics.observe(status, time.perf_counter() - started, len(body), len(payload))
+        return status, content_type, payload
+    
+    async def _convert(self, query, body):
+        output_format = query.get('to', '').lower()
+        if not output_format or output_format == 'dzi':
+            return 400, 'text/plain', b'Missing or unsupported "to" format\n'
+        
+        options = {'profile': query.get('profile'), 'metadata': query.get('metadata', MetadataPolicy.KEEP)}
+        if options['profile'] is not None and options['profile'] not in ENCODER_PROFILES:
+            return 400, 'text/plain', b'Unknown encoder profile\n'
+        if options['metadata'] not in METADATA_POLICIES:
+            return 400, 'text/plain', b'Unknown metadata policy\n'
+        try:
+            if query.get('target_kb'):
+                options['target_size'] = int(float(query['target_kb']) * 1024)
+            for metric in QUALITY_METRICS:
+                if query.get(f'min_{metric}'):
+                    options.update(quality_metric=metric, quality_threshold=float(query[f'min_{metric}']))
+        except ValueError:
+            return 400, 'text/plain', b'Invalid target_kb, min_ssim or min_psnr\n'
+        try:
+            if query.get('transform'):
+                options['transforms'] = parse_transforms(query['transform'])
+        except ValueError as e:
+            return 400, 'text/plain', f"{e}\n".encode('utf-8')
+        
+        if 'path' in query or 'output' in query:
+            if self.path_root is None:
+                return 403, 'text/plain', b'Local paths are disabled, start the service with --path-root\n'
+            if 'path' not in query:
+                return 400, 'text/plain', b'"output" needs a "path" parameter\n'
+            source = self._local_path(query['path'])
+            output_path = self._local_path(query['output']) if query.get('output') else None
+            if source is None or (query.get('output') and output_path is None):
+                return 403, 'text/plain', b'Path is outside the allowed folder\n'
+            job = ('path', source, output_path, output_format, options)
+        elif body:
+            job = ('bytes', body, None, output_format, options)
+        else:
+            return 400, 'text/plain', b'Send image bytes or a "path" parameter\n'
+        
+        # Мелкие запросы по умолчанию интерактивные, крупные - массовые;
+        # запросы с одним job= делят одну очередь и одну долю воркеров
+        priority = query.get('priority') or (
+            JobPriority.INTERACTIVE if len(body) <= self.small_request else JobPriority.BULK
+        )
+        if priority not in PRIORITY_WEIGHTS:
+            return 400, 'text/plain', b'Unknown priority\n'
+        try:
+            cap = int(query['max_concurrency']) if query.get('max_concurrency') else None
+        except ValueError:
+            cap = 0
+        if cap is not None and cap < 1:
+            return 400, 'text/plain', b'Invalid max_concurrency\n'
+        # Лимит меняет состояние всего задания, поэтому задается только для своего job=,
+        # а не для общих очередей interactive и bulk
+        if cap is not None and not query.get('job'):
+            return 400, 'text/plain', b'max_concurrency needs a job= name\n'
+        if cap is None and priority == JobPriority.BULK:
+            cap = self.bulk_cap
+        
+        future = asyncio.get_running_loop().create_future()
+        if not self.scheduler.put((job, future, len(body)), query.get('job') or priority, priority, cap):
+            return 503, 'text/plain', b'Queue is full, retry later\n'
+        self._wakeup.set()
+        
+        state, payload = await future
+        if state != 'ok':
+            return 422, 'text/plain', payload.encode('utf-8')
+        if job[0] == 'path' and job[2]:
+            return 200, 'application/json', payload
+        return 200, CONTENT_TYPES.get(output_format, 'application/octet-stream'), payload
+
+def _distributed_convert(args):
+    """Задача узла: конвертирует во временный файл рядом и атомарно переименовывает.
+    
+    Задачу, отобранную у медленного узла, могут выполнить дважды - временный
+    файл не даёт двум копиям перезаписать друг друга.
+    """
+    input_path, output_path, output_format = args[0], args[1], args[2]
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    if output_format.lower() == 'dzi':
+        # Пирамида - это папка тайлов, её имя нельзя подменить временным
+        return _result_to_json(convert_image(tuple(args)))
+    root, ext = os.path.splitext(output_path)
+    temp_path = f"{root}.{uuid.uuid4().hex[:8]}.part{ext}"
+    try:
+        result = convert_image((input_path, temp_path) + tuple(args[2:]))
+    except Exception as e:
+        result = (input_path, str(e))
+    if isinstance(result, tuple):
+        _remove_partial_output(temp_path)
+    else:
+        os.replace(temp_path, output_path)
+    return _result_to_json(result)
+
+def _result_to_json(result):
+    return list(result) if isinstance(result, tuple) else result
+
+def _result_from_json(result):
+    return tuple(result) if isinstance(result, list) else result
+
+class DistributedCoordinator:
+    """Раздаёт задачи convert_image узлам на других машинах по HTTP.
+    
+    Узлы сами забирают задачи небольшими арендами (POST /lease) и сообщают
+    начатые и готовые задачи (POST /heartbeat, POST /complete). Если узел
+    молчит дольше heartbeat_timeout, его задачи возвращаются в очередь.
+    Когда очередь пуста, свободный узел забирает половину ещё не начатых задач
+    самого загруженного. Пути должны быть одинаково видны всем узлам (общая папка).
+    """
+    def __init__(self, conversion_args, host='127.0.0.1', port=8770, secret=None,
+                 lease_size=8, heartbeat_timeout=15.0, max_attempts=3,
+                 progress=None, reports=None, stats=None, token=None):
+        self.tasks = [list(args) for args in conversion_args]
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.lease_size = lease_size
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.progress = progress
+        self.reports = reports
+        self.stats = stats
+        self.token = token
+        self.errors = []
+        self.pending = collections.deque(range(len(self.tasks)))
+        self.owner = {}
+        self.started = set()
+        self.attempts = collections.Counter()
+        self.done = set()
+        self.workers = {}
+        self.revoked = collections.defaultdict(set)
+        self.lock = threading.Lock()
+        self.server = None
+    
+    @property
+    def finished(self):
+        if len(self.done) == len(self.tasks):
+            return True
+        # После отмены ждём только уже выданные задачи
+        return self.token is not None and self.token.cancelled and not self.owner
+    
+    def _reap(self):
+        """Возвращает в очередь задачи узлов, переставших присылать пульс"""
+        now = time.monotonic()
+        for worker, seen in list(self.workers.items()):
+            if now - seen <= self.heartbeat_timeout:
+                continue
+            del self.workers[worker]
+            self.revoked.pop(worker, None)
+            lost = [task_id for task_id, owner in self.owner.items() if owner == worker]
+            for task_id in lost:
+                del self.owner[task_id]
+                self.started.discard(task_id)
+                if self.attempts[task_id] >= self.max_attempts:
+                    self._record(task_id, (self.tasks[task_id][0],
+                                           f"Lost with {self.attempts[task_id]} workers"))
+                else:
+                    self.pending.appendleft(task_id)
+            if lost:
+                print(f"Worker {worker} lost, {len(lost)} tasks requeued", file=sys.stderr)
+    
+    def _steal(self, thief, count):
+        """Забирает половину не начатых задач у самого загруженного узла"""
+        queued = collections.defaultdict(list)
+        for task_id, owner in self.owner.items():
+            if task_id not in self.started:
+                queued[owner].append(task_id)
+        # Крадёт только простаивающий узел, иначе узлы перекидывали бы задачи друг другу
+        if queued.pop(thief, None) or not queued:
+            return []
+        victim = max(queued, key=lambda worker: len(queued[worker]))
+        # С конца очереди жертвы: эти задачи она возьмёт в работу последними
+        stolen = sorted(queued[victim])[-min(count, max(1, len(queued[victim]) // 2)):]
+        self.revoked[victim].update(stolen)
+        return stolen
+    
+    def _record(self, task_id, result):
+        if task_id in self.done:
+            return
+        self.done.add(task_id)
+        self.owner.pop(task_id, None)
+        collect_result(result, self.tasks[task_id], self.errors, self.reports, self.stats)
+        if self.progress is not None:
+            self.progress.advance(failed=isinstance(result, tuple))
+    
+    def _checkin(self, request):
+        worker = str(request['worker'])
+        self.workers[worker] = time.monotonic()
+        for task_id in request.get('started', []):
+            if self.owner.get(task_id) == worker:
+                self.started.add(task_id)
+        for task_id, result in request.get('results', []):
+            if 0 <= task_id < len(self.tasks):
+                self._record(task_id, _result_from_json(result))
+        return worker
+    
+    def _reply(self, worker, **fields):
+        revoked = sorted(self.revoked.pop(worker, ()))
+        return {'revoked': revoked, 'done': self.finished, **fields}
+    
+    def handle(self, path, request):
+        with self.lock:
+            worker = self._checkin(request)
+            self._reap()
+            if path == '/lease':
+                if self.token is not None and (self.token.cancelled or self.token.paused):
+                    return self._reply(worker, tasks=[])
+                count = max(1, min(int(request.get('count', self.lease_size)), self.lease_size))
+                leased = []
+                while self.pending and len(leased) < count:
+                    task_id = self.pending.popleft()
+                    if task_id not in self.done and task_id not in self.owner:
+                        leased.append(task_id)
+                        # Попыткой считается только выдача из очереди, не перехват
+                        self.attempts[task_id] += 1
+                if not leased:
+                    leased = self._steal(worker, count)
+                for task_id in leased:
+                    self.owner[task_id] = worker
+                return self._reply(worker, tasks=[[task_id, self.tasks[task_id]] for task_id in leased])
+            return self._reply(worker)
+    
+    def status(self):
+        with self.lock:
+            return {
+                'total': len(self.tasks), 'done': len(self.done), 'failed': len(self.errors),
+                'leased': len(self.owner), 'pending': len(self.tasks) - len(self.done) - len(self.owner),
+                'workers': sorted(self.workers),
+            }
+    
+    def start(self):
+        coordinator = self
+        
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def _authorized(self):
+                if not coordinator.secret:
+                    return True
+                return hmac.compare_digest(self.headers.get('X-Ami-Secret', ''), coordinator.secret)
+            
+            def do_GET(self):
+                if not self._authorized():
+                    return self._send(403, {'error': 'forbidden'})
+                if self.path == '/status':
+                    return self._send(200, coordinator.status())
+                self._send(404, {'error': 'not found'})
+            
+            def do_POST(self):
+                if not self._authorized():
+                    return self._send(403, {'error': 'forbidden'})
+                if self.path not in ('/lease', '/heartbeat', '/complete'):
+                    return self._send(404, {'error': 'not found'})
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    request = json.loads(self.rfile.read(length) or b'{}')
+                    self._send(200, coordinator.handle(self.path, request))
+                except (ValueError, KeyError, TypeError) as e:
+                    self._send(400, {'error': str(e)})
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+    
+    def wait(self, linger=2.0):
+        """Ждёт завершения всех задач и возвращает ошибки в формате batch_convert"""
+        try:
+            while True:
+                with self.lock:
+                    # Узлы могут пропасть все сразу - тогда пульсов нет и некому вызвать _reap
+                    self._reap()
+                    if self.finished:
+                        break
+                time.sleep(0.5)
+            # Даём узлам забрать ответ done и завершиться
+            time.sleep(linger)
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+        return self.errors
+    
+    def run(self):
+        self.start()
+        return self.wait()
+
+class DistributedWorker:
+    """Узел распределённой конвертации: берёт задачи у координатора и выполняет их в своём пуле процессов"""
+    def __init__(self, url, workers=None, secret=None, name=None, heartbeat_interval=5.0,
+                 flush_interval=1.0):
+        self.url = url.rstrip('/')
+        self.workers = workers or os.cpu_count() or 1
+        self.secret = secret
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self.heartbeat_interval = heartbeat_interval
+        self.flush_interval = flush_interval
+        # Небольшой запас задач, чтобы процессы не простаивали между арендами
+        self.prefetch = self.workers * 2
+        self.queue = collections.deque()
+        self.started = []
+        self.results = []
+        self.completed = 0
+        self._last_contact = 0.0
+        self._next_lease = 0.0
+    
+    def _call(self, path, **payload):
+        payload.update(worker=self.name, started=self.started, results=self.results)
+        request = urllib.request.Request(
+            self.url + path, data=json.dumps(payload).encode('utf-8'), method='POST',
+            headers={'Content-Type': 'application/json', 'X-Ami-Secret': self.secret or ''}
+        )
+        with urllib.request.urlopen(request, timeout=30) as response:
+            reply = json.loads(response.read())
+        # Отправленное больше не повторяем
+        self.started, self.results = [], []
+        self._last_contact = time.monotonic()
+        revoked = set(reply.get('revoked', ()))
+        if revoked:
+            self.queue = collections.deque(item for item in self.queue if item[0] not in revoked)
+        return reply
+    
+    def run(self, max_retries=10):
+        """Работает, пока координатор не ответит, что задач больше нет"""
+        retries = 0
+        done = False
+        running = {}
+        last_flush = time.monotonic()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                try:
+                    if (not done and len(self.queue) + len(running) < self.prefetch
+                            and time.monotonic() >= self._next_lease):
+                        reply = self._call('/lease', count=self.prefetch - len(self.queue) - len(running))
+                        self.queue.extend(reply['tasks'])
+                        done = reply['done']
+                        # Пустая аренда: свободных задач нет, следующую просим не сразу
+                        self._next_lease = 0.0 if reply['tasks'] else time.monotonic() + 1.0
+                    elif self.results and (not running or time.monotonic() - last_flush >= self.flush_interval):
+                        done = self._call('/complete')['done']
+                        last_flush = time.monotonic()
+                    elif time.monotonic() - self._last_contact >= self.heartbeat_interval:
+                        done = self._call('/heartbeat')['done']
+                    retries = 0
+                except OSError as e:
+                    # Координатор недоступен: после done это нормальное завершение
+                    retries += 1
+                    if done or retries > max_retries:
+                        if not done:
+                            print(f"Coordinator unreachable: {e}", file=sys.stderr)
+                        break
+                    time.sleep(min(2 ** retries * 0.1, 5.0))
+                    continue
+                
+                while self.queue and len(running) < self.workers:
+                    task_id, args = self.queue.popleft()
+                    self.started.append(task_id)
+                    running[executor.submit(_distributed_convert, args)] = (task_id, args)
+                
+                if not running:
+                    if done and not self.queue and not self.results:
+                        break
+                    if not self.queue and not self.results:
+                        # Задач нет, но координатор ещё ждёт чужие - не опрашиваем слишком часто
+                        time.sleep(0.5)
+                    continue
+                finished, _ = concurrent.futures.wait(
+                    running, timeout=0.2, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    task_id, args = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = [args[0], str(e)]
+                    self.results.append([task_id, result])
+                    self.completed += 1
+        return self.completed
+
+# Переводы интерфейса: словарь каждого языка строится только при первом
+# обращении к этому языку, а не при импорте модуля
+def _translations_en():
+    return {
+        # Settings tab
+        "settings": "Settings",
+        "appearance": "Appearance",
+        "language": "Language",
+        "theme_light": "Light",
+        "theme_dark": "Dark",
+        "save_settings": "Save Settings",
+        "settings_saved": "Settings saved successfully!",
+        # Convert tab
+        "convert": "Convert",
+        "select_files": "Select files or folder",
+        "browse": "Browse",
+        "conversion_format": "Conversion format",
+        "convert_btn": "Convert",
+        "success": "Success",
+        "error": "Error",
+        "select_folder": "Select folder? (No - select files)",
+        "select_images": "Select images",
+        "select_save_folder": "Select folder to save",
+        "no_images": "No images to convert!",
+        "conversion_complete": "Conversion complete!",
+        "conversion_error": "Conversion error for {}: {}",
+        # Merge tab
+        "merge": "Merge",
+        "merge_direction": "Merge direction",
+        "horizontal": "Horizontal",
+        "vertical": "Vertical",
+        "add_range": "Add Range",
+        "image": "Image",
+        "to": "to",
+        "delete": "Delete",
+        "merge_btn": "Merge",
+        "no_merge_images": "No images to merge!",
+        "invalid_range": "Invalid range for image {}!",
+        "no_range_images": "No images in range {}!",
+        "loading_error": "Error loading images: {}",
+        "saving_error": "Error saving image {}: {}",
+        "merge_complete": "Merge complete!",
+        # About section
+        "about": "About",
+        "version": "Version",
+        "github": "GitHub Repository",
+        "github_link": "Open in browser",
+        "visible_formats": "Visible Formats",
+        "merge_output_format": "Merge Output Format",
+        # Progress bar translations
+        "progress_current": "Current file: ",
+        "progress_time": "Time per file: ",
+        "progress_overall": "Overall progress: ",
+        "progress_eta": "Estimated time remaining: ",
+        "calculating": "Calculating...",
+        
+        # Library descriptions
+        "recommended": "Recommended",
+        "basic_formats": "Basic formats",
+        "fast_standard": "Fast for standard formats",
+        "fast_large": "Fast for large images",
+        
+        # Multi-page documents
+        "multipage": "Multi-page documents",
+        "page_mode_auto": "Auto",
+        "page_mode_pages": "Page files",
+        "page_mode_container": "Single document",
+        "page_mode_single": "Whole file (no split)",
+        "page_dpi": "Render DPI",
+        
+        # Merge cache
+        "merge_cache": "Merge cache",
+        "merge_cache_size": "Memory budget (MB)",
+        "merge_cache_spill": "Spill decoded images to disk",
+        
+        # Merge layouts
+        "grid": "Grid",
+        "contact_sheet": "Contact sheet",
+        "merge_layout": "Grid and contact sheet",
+        "merge_columns": "Columns (0 = auto)",
+        "merge_tile_size": "Tile size, px (0 = auto)",
+        "merge_scale_to_fit": "Scale images to fit cells",
+        
+        # Archives
+        "archive_output": "Write archive inputs (ZIP/CBZ/TAR) into a new archive",
+        
+        # Encoder profiles
+        "encoder_profile": "Encoder profile",
+        "profile_fastest": "Fastest",
+        "profile_balanced": "Balanced",
+        "profile_smallest": "Smallest files",
+        "target_size": "Target file size, KB (0 = off)",
+        "quality_metric": "Pick lowest quality meeting",
+        "quality_threshold": "Minimum SSIM (0-1) or PSNR (dB)",
+        "off": "Off",
+        "metadata_policy": "Metadata",
+        "metadata_keep": "Keep all metadata",
+        "metadata_strip": "Strip all metadata",
+        "metadata_icc": "Keep color profile only",
+        "metadata_orient_strip": "Auto-rotate and strip",
+        "passthrough_hardlink": "Hardlink files that need no conversion",
+        "passthrough_count": "Copied without re-encoding: {}",
+        "animation": "Animation",
+        "dedupe_frames": "Merge identical frames",
+        "reuse_palette": "Reuse the source GIF palette",
+        "pause": "Pause",
+        "resume": "Resume",
+        "cancel": "Cancel",
+        "job_cancelled": "Cancelled: unfinished files were skipped",
+        "preview": "Preview",
+        "merge_order": "Merge order",
+        "range_expression": "Ranges, e.g. 1-10, 11-20 or every 8 or height 20000",
+        "invalid_ranges": "Invalid ranges: {}",
+        "transforms": "Transforms, applied in order",
+        "transforms_hint": "e.g. auto_orient; resize 1600x1600 area; rotate 90",
+        "invalid_transforms": "Invalid transforms: {}",
+        "profile_default": "Library defaults",
+    }
+
+def _translations_ru():
+    return {
+        # Settings tab
+        "settings": "Настройки",
+        "appearance": "Внешний вид",
+        "language": "Язык",
+        "theme_light": "Светлая",
+        "theme_dark": "Тёмная",
+        "save_settings": "Сохранить настройки",
+        "settings_saved": "Настройки успешно сохранены!",
+        # Convert tab
+        "convert": "Конвертация",
+        "select_files": "Выберите папку или файлы",
+        "browse": "Обзор",
+        "conversion_format": "Формат конвертации",
+        "convert_btn": "Конвертировать",
+        "success": "Успех",
+        "error": "Ошибка",
+        "select_folder": "Выбрать папку? (Нет - выбрать файлы)",
+        "select_images": "Выберите изображения",
+        "select_save_folder": "Выберите папку для сохранения",
+        "no_images": "Нет изображений для конвертации!",
+        "conversion_complete": "Конвертация завершена!",
+        "conversion_error": "Ошибка конвертации {}: {}",
+        # Merge tab
+        "merge": "Склеивание",
+        "merge_direction": "Направление склеивания",
+        "horizontal": "Горизонтально",
+        "vertical": "Вертикально",
+        "add_range": "Добавить диапазон",
+        "image": "Изображение",
+        "to": "до",
+        "delete": "Удалить",
+        "merge_btn": "Склеить",
+        "no_merge_images": "Нет изображений для склеивания!",
+        "invalid_range": "Некорректный диапазон для изображения {}!",
+        "no_range_images": "Нет изображений в диапазоне {}!",
+        "loading_error": "Ошибка загрузки изображений: {}",
+        "saving_error": "Ошибка сохранения изображения {}: {}",
+        "merge_complete": "Склеивание завершено!",
+        # About section
+        "about": "О программе",
+        "version": "Версия",
+        "github": "Репозиторий GitHub",
+        "github_link": "Открыть в браузере",
+        "visible_formats": "Видимые форматы",
+        "merge_output_format": "Формат склеивания",
+        # Progress bar translations
+        "progress_current": "Текущий файл: ",
+        "progress_time": "Время на файл: ",
+        "progress_overall": "Общий прогресс: ",
+        "progress_eta": "Осталось времени: ",
+        "calculating": "Вычисление...",
+        
+        # Library descriptions
+        "recommended": "Рекомендуется",
+        "basic_formats": "Базовые форматы",
+        "fast_standard": "Быстрая для стандартных форматов",
+        "fast_large": "Быстрая для больших изображений",
+        
+        # Multi-page documents
+        "multipage": "Многостраничные документы",
+        "page_mode_auto": "Авто",
+        "page_mode_pages": "Файл на страницу",
+        "page_mode_container": "Один документ",
+        "page_mode_single": "Целиком (без разделения)",
+        "page_dpi": "DPI рендеринга",
+        
+        # Merge cache
+        "merge_cache": "Кэш склеивания",
+        "merge_cache_size": "Лимит памяти (МБ)",
+        "merge_cache_spill": "Выгружать декодированные изображения на диск",
+        
+        # Merge layouts
+        "grid": "Сетка",
+        "contact_sheet": "Контактный лист",
+        "merge_layout": "Сетка и контактный лист",
+        "merge_columns": "Столбцы (0 = авто)",
+        "merge_tile_size": "Размер плитки, px (0 = авто)",
+        "merge_scale_to_fit": "Масштабировать под ячейки",
+        
+        # Archives
+        "archive_output": "Сохранять архивы (ZIP/CBZ/TAR) в новый архив",
+        
+        # Encoder profiles
+        "encoder_profile": "Профиль кодирования",
+        "profile_fastest": "Быстрее всего",
+        "profile_balanced": "Сбалансированный",
+        "profile_smallest": "Минимальный размер",
+        "target_size": "Целевой размер файла, КБ (0 = выкл.)",
+        "quality_metric": "Подбирать наименьшее качество по метрике",
+        "quality_threshold": "Минимальный SSIM (0-1) или PSNR (дБ)",
+        "off": "Выкл.",
+        "metadata_policy": "Метаданные",
+        "metadata_keep": "Сохранять все метаданные",
+        "metadata_strip": "Удалять все метаданные",
+        "metadata_icc": "Оставлять только цветовой профиль",
+        "metadata_orient_strip": "Повернуть по EXIF и удалить",
+        "passthrough_hardlink": "Жесткие ссылки для файлов без изменений",
+        "passthrough_count": "Скопировано без перекодирования: {}",
+        "animation": "Анимация",
+        "dedupe_frames": "Объединять одинаковые кадры",
+        "reuse_palette": "Использовать палитру исходного GIF",
+        "pause": "Пауза",
+        "resume": "Продолжить",
+        "cancel": "Отмена",
+        "job_cancelled": "Отменено: необработанные файлы пропущены",
+        "preview": "Просмотр",
+        "merge_order": "Порядок склейки",
+        "range_expression": "Диапазоны, например 1-10, 11-20 или every 8 или height 20000",
+        "invalid_ranges": "Неверные диапазоны: {}",
+        "transforms": "Преобразования, по порядку",
+        "transforms_hint": "например, auto_orient; resize 1600x1600 area; rotate 90",
+        "invalid_transforms": "Неверные преобразования: {}",
+        "profile_default": "Настройки библиотеки по умолчанию",
+    }
+
+def _translations_zh():
+    return {
+        # Settings tab
+        "settings": "设置",
+        "appearance": "外观",
+        "language": "语言",
+        "theme_light": "浅色",
+        "theme_dark": "深色",
+        "save_settings": "保存设置",
+        "settings_saved": "设置保存成功！",
+        # Convert tab
+        "convert": "转换",
+        "select_files": "选择文件或文件夹",
+        "browse": "浏览",
+        "conversion_format": "转换格式",
+        "convert_btn": "转换",
+        "success": "成功",
+        "error": "错误",
+        "select_folder": "选择文件夹？（否 - 选择文件）",
+        "select_images": "选择图片",
+        "select_save_folder": "选择保存文件夹",
+        "no_images": "没有图片可转换！",
+        "conversion_complete": "转换完成！",
+        "conversion_error": "{} 转换错误：{}",
+        # Merge tab
+        "merge": "合并",
+        "merge_direction": "合并方向",
+        "horizontal": "水平",
+        "vertical": "垂直",
+        "add_range": "添加范围",
+        "image": "图片",
+        "to": "到",
+        "delete": "删除",
+        "merge_btn": "合并",
+        "no_merge_images": "没有图片可合并！",
+        "invalid_range": "图片 {} 的范围无效！",
+        "no_range_images": "范围 {} 中没有图片！",
+        "loading_error": "加载图片错误：{}",
+        "saving_error": "保存图片 {} 错误：{}",
+        "merge_complete": "合并完成！",
+        # About section
+        "about": "关于",
+        "version": "版本",
+        "github": "GitHub 仓库",
+        "github_link": "在浏览器中打开",
+        "visible_formats": "可见格式",
+        "merge_output_format": "合并输出格式",
+        # Progress bar translations
+        "progress_current": "当前文件: ",
+        "progress_time": "每个文件的时间: ",
+        "progress_overall": "总体进度: ",
+        "progress_eta": "预计剩余时间: ",
+        "calculating": "计算中...",
+        
+        # Library descriptions
+        "recommended": "推荐",
+        "basic_formats": "基本格式",
+        "fast_standard": "标准格式快速",
+        "fast_large": "大图像快速",
+        
+        # Multi-page documents
+        "multipage": "多页文档",
+        "page_mode_auto": "自动",
+        "page_mode_pages": "每页一个文件",
+        "page_mode_container": "单个文档",
+        "page_mode_single": "整个文件（不拆分）",
+        "page_dpi": "渲染 DPI",
+        
+        # Merge cache
+        "merge_cache": "合并缓存",
+        "merge_cache_size": "内存预算 (MB)",
+        "merge_cache_spill": "将解码图像溢出到磁盘",
+        
+        # Merge layouts
+        "grid": "网格",
+        "contact_sheet": "联系表",
+        "merge_layout": "网格和联系表",
+        "merge_columns": "列数（0 = 自动）",
+        "merge_tile_size": "图块大小，像素（0 = 自动）",
+        "merge_scale_to_fit": "缩放图像以适应单元格",
+        
+        # Archives
+        "archive_output": "将归档输入（ZIP/CBZ/TAR）写入新归档",
+        
+        # Encoder profiles
+        "encoder_profile": "编码配置",
+        "profile_fastest": "最快",
+        "profile_balanced": "平衡",
+        "profile_smallest": "最小文件",
+        "target_size": "目标文件大小，KB（0 = 关闭）",
+        "quality_metric": "按指标选择最低质量",
+        "quality_threshold": "最低 SSIM（0-1）或 PSNR（dB）",
+        "off": "关闭",
+        "metadata_policy": "元数据",
+        "metadata_keep": "保留所有元数据",
+        "metadata_strip": "删除所有元数据",
+        "metadata_icc": "仅保留颜色配置文件",
+        "metadata_orient_strip": "自动旋转并删除",
+        "passthrough_hardlink": "对无需转换的文件使用硬链接",
+        "passthrough_count": "未重新编码直接复制：{}",
+        "animation": "动画",
+        "dedupe_frames": "合并相同的帧",
+        "reuse_palette": "重用源 GIF 调色板",
+        "pause": "暂停",
+        "resume": "继续",
+        "cancel": "取消",
+        "job_cancelled": "已取消：未完成的文件已跳过",
+        "preview": "预览",
+        "merge_order": "合并顺序",
+        "range_expression": "范围，例如 1-10, 11-20 或 every 8 或 height 20000",
+        "invalid_ranges": "范围无效：{}",
+        "transforms": "图像变换（按顺序执行）",
+        "transforms_hint": "例如：auto_orient; resize 1600x1600 area; rotate 90",
+        "invalid_transforms": "变换无效：{}",
+        "profile_default": "库默认设置",
+    }
+
+def _translations_ja():
+    return {
+        # Settings tab
+        "settings": "設定",
+        "appearance": "外観",
+        "language": "言語",
+        "theme_light": "ライト",
+        "theme_dark": "ダーク",
+        "save_settings": "設定を保存",
+        "settings_saved": "設定が保存されました！",
+        # Convert tab
+        "convert": "変換",
+        "select_files": "ファイルまたはフォルダを選択",
+        "browse": "参照",
+        "conversion_format": "変換形式",
+        "convert_btn": "変換",
+        "success": "成功",
+        "error": "エラー",
+        "select_folder": "フォルダを選択？（いいえ - ファイルを選択）",
+        "select_images": "画像を選択",
+        "select_save_folder": "保存フォルダを選択",
+        "no_images": "変換する画像がありません！",
+        "conversion_complete": "変換が完了しました！",
+        "conversion_error": "{} の変換エラー：{}",
+        # Merge tab
+        "merge": "結合",
+        "merge_direction": "結合方向",
+        "horizontal": "水平",
+        "vertical": "垂直",
+        "add_range": "範囲を追加",
+        "image": "画像",
+        "to": "から",
+        "delete": "削除",
+        "merge_btn": "結合",
+        "no_merge_images": "結合する画像がありません！",
+        "invalid_range": "画像 {} の範囲が無効です！",
+        "no_range_images": "範囲 {} に画像がありません！",
+        "loading_error": "画像の読み込みエラー：{}",
+        "saving_error": "画像 {} の保存エラー：{}",
+        "merge_complete": "結合が完了しました！",
+        # About section
+        "about": "について",
+        "version": "バージョン",
+        "github": "GitHub リポジトリ",
+        "github_link": "ブラウザで開く",
+        "visible_formats": "表示形式",
+        "merge_output_format": "結合出力形式",
+        # Progress bar translations
+        "progress_current": "現在のファイル: ",
+        "progress_time": "ファイルごとの時間: ",
+        "progress_overall": "全体の進捗: ",
+        "progress_eta": "残り時間の見積もり: ",
+        "calculating": "計算中...",
+        
+        # Library descriptions
+        "recommended": "推奨",
+        "basic_formats": "基本フォーマット",
+        "fast_standard": "標準フォーマットの高速",
+        "fast_large": "大きな画像の高速",
+        
+        # Multi-page documents
+        "multipage": "複数ページの文書",
+        "page_mode_auto": "自動",
+        "page_mode_pages": "ページごとのファイル",
+        "page_mode_container": "単一の文書",
+        "page_mode_single": "ファイル全体（分割なし）",
+        "page_dpi": "レンダリング DPI",
+        
+        # Merge cache
+        "merge_cache": "結合キャッシュ",
+        "merge_cache_size": "メモリ上限 (MB)",
+        "merge_cache_spill": "デコード済み画像をディスクに退避",
+        
+        # Merge layouts
+        "grid": "グリッド",
+        "contact_sheet": "コンタクトシート",
+        "merge_layout": "グリッドとコンタクトシート",
+        "merge_columns": "列数（0 = 自動）",
+        "merge_tile_size": "タイルサイズ、px（0 = 自動）",
+        "merge_scale_to_fit": "セルに合わせて拡大縮小",
+        
+        # Archives
+        "archive_output": "アーカイブ入力（ZIP/CBZ/TAR）を新しいアーカイブに書き込む",
+        
+        # Encoder profiles
+        "encoder_profile": "エンコードプロファイル",
+        "profile_fastest": "最速",
+        "profile_balanced": "バランス",
+        "profile_smallest": "最小サイズ",
+        "target_size": "目標ファイルサイズ、KB（0 = オフ）",
+        "quality_metric": "指標を満たす最低品質を選択",
+        "quality_threshold": "最小 SSIM（0-1）または PSNR（dB）",
+        "off": "オフ",
+        "metadata_policy": "メタデータ",
+        "metadata_keep": "すべてのメタデータを保持",
+        "metadata_strip": "すべてのメタデータを削除",
+        "metadata_icc": "カラープロファイルのみ保持",
+        "metadata_orient_strip": "自動回転して削除",
+        "passthrough_hardlink": "変換不要なファイルはハードリンクする",
+        "passthrough_count": "再エンコードせずにコピー：{}",
+        "animation": "アニメーション",
+        "dedupe_frames": "同一フレームを統合",
+        "reuse_palette": "元の GIF パレットを再利用",
+        "pause": "一時停止",
+        "resume": "再開",
+        "cancel": "キャンセル",
+        "job_cancelled": "キャンセルしました：未処理のファイルはスキップされました",
+        "preview": "プレビュー",
+        "merge_order": "結合順",
+        "range_expression": "範囲（例：1-10, 11-20、every 8、height 20000）",
+        "invalid_ranges": "無効な範囲：{}",
+        "transforms": "変換（順に適用）",
+        "transforms_hint": "例：auto_orient; resize 1600x1600 area; rotate 90",
+        "invalid_transforms": "無効な変換：{}",
+        "profile_default": "ライブラリの既定値",
+    }
+
+def _translations_ko():
+    return {
+        # Settings tab
+        "settings": "설정",
+        "appearance": "외관",
+        "language": "언어",
+        "theme_light": "라이트",
+        "theme_dark": "다크",
+        "save_settings": "설정 저장",
+        "settings_saved": "설정이 저장되었습니다!",
+        # Convert tab
+        "convert": "변환",
+        "select_files": "파일 또는 폴더 선택",
+        "browse": "찾아보기",
+        "conversion_format": "변환 형식",
+        "convert_btn": "변환",
+        "success": "성공",
+        "error": "오류",
+        "select_folder": "폴더를 선택하시겠습니까? (아니오 - 파일 선택)",
+        "select_images": "이미지 선택",
+        "select_save_folder": "저장 폴더 선택",
+        "no_images": "변환할 이미지가 없습니다!",
+        "conversion_complete": "변환이 완료되었습니다!",
+        "conversion_error": "{} 변환 오류: {}",
+        # Merge tab
+        "merge": "병합",
+        "merge_direction": "병합 방향",
+        "horizontal": "가로",
+        "vertical": "세로",
+        "add_range": "범위 추가",
+        "image": "이미지",
+        "to": "에서",
+        "delete": "삭제",
+        "merge_btn": "병합",
+        "no_merge_images": "병합할 이미지가 없습니다!",
+        "invalid_range": "이미지 {}의 범위가 잘못되었습니다!",
+        "no_range_images": "범위 {}에 이미지가 없습니다!",
+        "loading_error": "이미지 로딩 오류: {}",
+        "saving_error": "이미지 {} 저장 오류: {}",
+        "merge_complete": "병합이 완료되었습니다!",
+        # About section
+        "about": "정보",
+        "version": "버전",
+        "github": "GitHub 저장소",
+        "github_link": "브라우저에서 열기",
+        "visible_formats": "표시 형식",
+        "merge_output_format": "병합 출력 형식",
+        # Progress bar translations
+        "progress_current": "현재 파일: ",
+        "progress_time": "파일당 시간: ",
+        "progress_overall": "전체 진행 상황: ",
+        "progress_eta": "예상 남은 시간: ",
+        "calculating": "계산 중...",
+        
+        # Library descriptions
+        "recommended": "추천",
+        "basic_formats": "기본 형식",
+        "fast_standard": "표준 형식에 빠름",
+        "fast_large": "큰 이미지에 빠름",
+        
+        # Multi-page documents
+        "multipage": "다중 페이지 문서",
+        "page_mode_auto": "자동",
+        "page_mode_pages": "페이지별 파일",
+        "page_mode_container": "단일 문서",
+        "page_mode_single": "전체 파일 (분할 안 함)",
+        "page_dpi": "렌더링 DPI",
+        
+        # Merge cache
+        "merge_cache": "병합 캐시",
+        "merge_cache_size": "메모리 한도 (MB)",
+        "merge_cache_spill": "디코딩된 이미지를 디스크로 내보내기",
+        
+        # Merge layouts
+        "grid": "격자",
+        "contact_sheet": "밀착 인화",
+        "merge_layout": "격자 및 밀착 인화",
+        "merge_columns": "열 수 (0 = 자동)",
+        "merge_tile_size": "타일 크기, px (0 = 자동)",
+        "merge_scale_to_fit": "셀에 맞게 크기 조정",
+        
+        # Archives
+        "archive_output": "아카이브 입력(ZIP/CBZ/TAR)을 새 아카이브로 저장",
+        
+        # Encoder profiles
+        "encoder_profile": "인코더 프로필",
+        "profile_fastest": "가장 빠름",
+        "profile_balanced": "균형",
+        "profile_smallest": "가장 작은 파일",
+        "target_size": "목표 파일 크기, KB (0 = 끔)",
+        "quality_metric": "지표를 만족하는 최저 품질 선택",
+        "quality_threshold": "최소 SSIM (0-1) 또는 PSNR (dB)",
+        "off": "끔",
+        "metadata_policy": "메타데이터",
+        "metadata_keep": "모든 메타데이터 유지",
+        "metadata_strip": "모든 메타데이터 제거",
+        "metadata_icc": "색상 프로필만 유지",
+        "metadata_orient_strip": "자동 회전 후 제거",
+        "passthrough_hardlink": "변환이 필요 없는 파일은 하드 링크",
+        "passthrough_count": "재인코딩 없이 복사됨: {}",
+        "animation": "애니메이션",
+        "dedupe_frames": "동일한 프레임 병합",
+        "reuse_palette": "원본 GIF 팔레트 재사용",
+        "pause": "일시 정지",
+        "resume": "계속",
+        "cancel": "취소",
+        "job_cancelled": "취소됨: 처리되지 않은 파일은 건너뛰었습니다",
+        "preview": "미리 보기",
+        "merge_order": "병합 순서",
+        "range_expression": "범위, 예: 1-10, 11-20 또는 every 8 또는 height 20000",
+        "invalid_ranges": "잘못된 범위: {}",
+        "transforms": "변환 (순서대로 적용)",
+        "transforms_hint": "예: auto_orient; resize 1600x1600 area; rotate 90",
+        "invalid_transforms": "잘못된 변환: {}",
+        "profile_default": "라이브러리 기본값",
+    }
+
+def _translations_es():
+    return {
+        # Settings tab
+        "settings": "Configuración",
+        "appearance": "Apariencia",
+        "language": "Idioma",
+        "theme_light": "Claro",
+        "theme_dark": "Oscuro",
+        "save_settings": "Guardar Configuración",
+        "settings_saved": "¡Configuración guardada exitosamente!",
+        # Convert tab
+        "convert": "Convertir",
+        "select_files": "Seleccionar archivos o carpeta",
+        "browse": "Explorar",
+        "conversion_format": "Formato de conversión",
+        "convert_btn": "Convertir",
+        "success": "Éxito",
+        "error": "Error",
+        "select_folder": "¿Seleccionar carpeta? (No - seleccionar archivos)",
+        "select_images": "Seleccionar imágenes",
+        "select_save_folder": "Seleccionar carpeta para guardar",
+        "no_images": "¡No hay imágenes para convertir!",
+        "conversion_complete": "¡Conversión completada!",
+        "conversion_error": "Error de conversión para {}: {}",
+        # Merge tab
+        "merge": "Fusionar",
+        "merge_direction": "Dirección de fusión",
+        "horizontal": "Horizontal",
+        "vertical": "Vertical",
+        "add_range": "Añadir Rango",
+        "image": "Imagen",
+        "to": "hasta",
+        "delete": "Eliminar",
+        "merge_btn": "Fusionar",
+        "no_merge_images": "¡No hay imágenes para fusionar!",
+        "invalid_range": "¡Rango inválido para la imagen {}!",
+        "no_range_images": "¡No hay imágenes en el rango {}!",
+        "loading_error": "Error al cargar imágenes: {}",
+        "saving_error": "Error al guardar la imagen {}: {}",
+        "merge_complete": "¡Fusión completada!",
+        # About section
+        "about": "Acerca de",
+        "version": "Versión",
+        "github": "Repositorio GitHub",
+        "github_link": "Abrir en navegador",
+        "visible_formats": "Formatos Visibles",
+        "merge_output_format": "Formato de Salida de Fusión",
+        # Progress bar translations
+        "progress_current": "Archivo actual: ",
+        "progress_time": "Tiempo por archivo: ",
+        "progress_overall": "Progreso general: ",
+        "progress_eta": "Tiempo estimado restante: ",
+        "calculating": "Calculando...",
+        
+        # Library descriptions
+        "recommended": "Recomendado",
+        "basic_formats": "Formatos básicos",
+        "fast_standard": "Rápido para formatos estándar",
+        "fast_large": "Rápido para imágenes grandes",
+        
+        # Multi-page documents
+        "multipage": "Documentos de varias páginas",
+        "page_mode_auto": "Automático",
+        "page_mode_pages": "Un archivo por página",
+        "page_mode_container": "Documento único",
+        "page_mode_single": "Archivo completo (sin dividir)",
+        "page_dpi": "DPI de renderizado",
+        
+        # Merge cache
+        "merge_cache": "Caché de fusión",
+        "merge_cache_size": "Límite de memoria (MB)",
+        "merge_cache_spill": "Volcar imágenes decodificadas al disco",
+        
+        # Merge layouts
+        "grid": "Cuadrícula",
+        "contact_sheet": "Hoja de contactos",
+        "merge_layout": "Cuadrícula y hoja de contactos",
+        "merge_columns": "Columnas (0 = auto)",
+        "merge_tile_size": "Tamaño de celda, px (0 = auto)",
+        "merge_scale_to_fit": "Escalar imágenes a las celdas",
+        
+        # Archives
+        "archive_output": "Guardar archivos comprimidos (ZIP/CBZ/TAR) en un nuevo archivo",
+        
+        # Encoder profiles
+        "encoder_profile": "Perfil de codificación",
+        "profile_fastest": "Más rápido",
+        "profile_balanced": "Equilibrado",
+        "profile_smallest": "Archivos más pequeños",
+        "target_size": "Tamaño objetivo, KB (0 = desactivado)",
+        "quality_metric": "Elegir la calidad mínima que cumpla",
+        "quality_threshold": "SSIM mínimo (0-1) o PSNR (dB)",
+        "off": "Desactivado",
+        "metadata_policy": "Metadatos",
+        "metadata_keep": "Conservar todos los metadatos",
+        "metadata_strip": "Eliminar todos los metadatos",
+        "metadata_icc": "Conservar solo el perfil de color",
+        "metadata_orient_strip": "Rotar automáticamente y eliminar",
+        "passthrough_hardlink": "Enlace duro para archivos sin cambios",
+        "passthrough_count": "Copiados sin recodificar: {}",
+        "animation": "Animación",
+        "dedupe_frames": "Fusionar fotogramas idénticos",
+        "reuse_palette": "Reutilizar la paleta del GIF original",
+        "pause": "Pausar",
+        "resume": "Reanudar",
+        "cancel": "Cancelar",
+        "job_cancelled": "Cancelado: se omitieron los archivos pendientes",
+        "preview": "Vista previa",
+        "merge_order": "Orden de unión",
+        "range_expression": "Rangos, p. ej. 1-10, 11-20 o every 8 o height 20000",
+        "invalid_ranges": "Rangos no válidos: {}",
+        "transforms": "Transformaciones, en orden",
+        "transforms_hint": "p. ej. auto_orient; resize 1600x1600 area; rotate 90",
+        "invalid_transforms": "Transformaciones no válidas: {}",
+        "profile_default": "Valores predeterminados de la biblioteca",
+    }
+
+def _translations_fr():
+    return {
+        # Settings tab
+        "settings": "Paramètres",
+        "appearance": "Apparence",
+        "language": "Langue",
+        "theme_light": "Clair",
+        "theme_dark": "Sombre",
+        "save_settings": "Enregistrer les Paramètres",
+        "settings_saved": "Paramètres enregistrés avec succès !",
+        # Convert tab
+        "convert": "Convertir",
+        "select_files": "Sélectionner fichiers ou dossier",
+        "browse": "Parcourir",
+        "conversion_format": "Format de conversion",
+        "convert_btn": "Convertir",
+        "success": "Succès",
+        "error": "Erreur",
+        "select_folder": "Sélectionner un dossier ? (Non - sélectionner des fichiers)",
+        "select_images": "Sélectionner des images",
+        "select_save_folder": "Sélectionner le dossier de sauvegarde",
+        "no_images": "Aucune image à convertir !",
+        "conversion_complete": "Conversion terminée !",
+        "conversion_error": "Erreur de conversion pour {}: {}",
+        # Merge tab
+        "merge": "Fusionner",
+        "merge_direction": "Direction de fusion",
+        "horizontal": "Horizontale",
+        "vertical": "Verticale",
+        "add_range": "Ajouter une Plage",
+        "image": "Image",
+        "to": "à",
+        "delete": "Supprimer",
+        "merge_btn": "Fusionner",
+        "no_merge_images": "Aucune image à fusionner !",
+        "invalid_range": "Plage invalide pour l'image {} !",
+        "no_range_images": "Aucune image dans la plage {} !",
+        "loading_error": "Erreur de chargement des images : {}",
+        "saving_error": "Erreur lors de la sauvegarde de l'image {} : {}",
+        "merge_complete": "Fusion terminée !",
+        # About section
+        "about": "À propos",
+        "version": "Version",
+        "github": "Dépôt GitHub",
+        "github_link": "Ouvrir dans le navigateur",
+        "visible_formats": "Formats Visibles",
+        "merge_output_format": "Format de Sortie de Fusion",
+        # Progress bar translations
+        "progress_current": "Fichier actuel: ",
+        "progress_time": "Temps par fichier: ",
+        "progress_overall": "Progression globale: ",
+        "progress_eta": "Temps restant estimé: ",
+        "calculating": "Calcul...",
+        
+        # Library descriptions
+        "recommended": "Recommandé",
+        "basic_formats": "Formats de base",
+        "fast_standard": "Rapide pour les formats standard",
+        "fast_large": "Rapide pour les grandes images",
+        
+        # Multi-page documents
+        "multipage": "Documents multipages",
+        "page_mode_auto": "Automatique",
+        "page_mode_pages": "Un fichier par page",
+        "page_mode_container": "Document unique",
+        "page_mode_single": "Fichier entier (sans division)",
+        "page_dpi": "DPI de rendu",
+        
+        # Merge cache
+        "merge_cache": "Cache de fusion",
+        "merge_cache_size": "Budget mémoire (Mo)",
+        "merge_cache_spill": "Déverser les images décodées sur le disque",
+        
+        # Merge layouts
+        "grid": "Grille",
+        "contact_sheet": "Planche contact",
+        "merge_layout": "Grille et planche contact",
+        "merge_columns": "Colonnes (0 = auto)",
+        "merge_tile_size": "Taille des vignettes, px (0 = auto)",
+        "merge_scale_to_fit": "Adapter les images aux cellules",
+        
+        # Archives
+        "archive_output": "Écrire les archives (ZIP/CBZ/TAR) dans une nouvelle archive",
+        
+        # Encoder profiles
+        "encoder_profile": "Profil d'encodage",
+        "profile_fastest": "Le plus rapide",
+        "profile_balanced": "Équilibré",
+        "profile_smallest": "Fichiers les plus petits",
+        "target_size": "Taille cible, Ko (0 = désactivé)",
+        "quality_metric": "Choisir la qualité minimale respectant",
+        "quality_threshold": "SSIM minimal (0-1) ou PSNR (dB)",
+        "off": "Désactivé",
+        "metadata_policy": "Métadonnées",
+        "metadata_keep": "Conserver toutes les métadonnées",
+        "metadata_strip": "Supprimer toutes les métadonnées",
+        "metadata_icc": "Conserver uniquement le profil couleur",
+        "metadata_orient_strip": "Pivoter automatiquement et supprimer",
+        "passthrough_hardlink": "Lien physique pour les fichiers inchangés",
+        "passthrough_count": "Copiés sans réencodage : {}",
+        "animation": "Animation",
+        "dedupe_frames": "Fusionner les images identiques",
+        "reuse_palette": "Réutiliser la palette du GIF source",
+        "pause": "Pause",
+        "resume": "Reprendre",
+        "cancel": "Annuler",
+        "job_cancelled": "Annulé : les fichiers restants ont été ignorés",
+        "preview": "Aperçu",
+        "merge_order": "Ordre de fusion",
+        "range_expression": "Plages, ex. 1-10, 11-20 ou every 8 ou height 20000",
+        "invalid_ranges": "Plages invalides : {}",
+        "transforms": "Transformations, dans l'ordre",
+        "transforms_hint": "p. ex. auto_orient; resize 1600x1600 area; rotate 90",
+        "invalid_transforms": "Transformations invalides : {}",
+        "profile_default": "Valeurs par défaut de la bibliothèque",
+    }
 
-class ProgressInfo:
-    """Класс для хранения информации о прогрессе"""
-    def __init__(self, total_files):
-        self.total_files = total_files
-        self.processed_files = 0
-        self.current_file = 0
-        self.start_time = time.time()
-        self.file_start_time = time.time()
-        self.avg_file_time = 0
+def _translations_de():
+    return {
+        # Settings tab
+        "settings": "Einstellungen",
+        "appearance": "Erscheinungsbild",
+        "language": "Sprache",
+        "theme_light": "Hell",
+        "theme_dark": "Dunkel",
+        "save_settings": "Einstellungen Speichern",
+        "settings_saved": "Einstellungen erfolgreich gespeichert!",
+        # Convert tab
+        "convert": "Konvertieren",
+        "select_files": "Dateien oder Ordner auswählen",
+        "browse": "Durchsuchen",
+        "conversion_format": "Konvertierungsformat",
+        "convert_btn": "Konvertieren",
+        "success": "Erfolg",
+        "error": "Fehler",
+        "select_folder": "Ordner auswählen? (Nein - Dateien auswählen)",
+        "select_images": "Bilder auswählen",
+        "select_save_folder": "Speicherordner auswählen",
+        "no_images": "Keine Bilder zum Konvertieren!",
+        "conversion_complete": "Konvertierung abgeschlossen!",
+        "conversion_error": "Konvertierungsfehler für {}: {}",
+        # Merge tab
+        "merge": "Zusammenführen",
+        "merge_direction": "Zusammenführungsrichtung",
+        "horizontal": "Horizontal",
+        "vertical": "Vertikal",
+        "add_range": "Bereich Hinzufügen",
+        "image": "Bild",
+        "to": "bis",
+        "delete": "Löschen",
+        "merge_btn": "Zusammenführen",
+        "no_merge_images": "Keine Bilder zum Zusammenführen!",
+        "invalid_range": "Ungültiger Bereich für Bild {}!",
+        "no_range_images": "Keine Bilder im Bereich {}!",
+        "loading_error": "Fehler beim Laden der Bilder: {}",
+        "saving_error": "Fehler beim Speichern des Bildes {}: {}",
+        "merge_complete": "Zusammenführung abgeschlossen!",
+        # About section
+        "about": "Über",
+        "version": "Version",
+        "github": "GitHub Repository",
+        "github_link": "Im Browser öffnen",
+        "visible_formats": "Sichtbare Formate",
+        "merge_output_format": "Ausgabeformat Zusammenführung",
+        # Progress bar translations
+        "progress_current": "Aktuelle Datei: ",
+        "progress_time": "Zeit pro Datei: ",
+        "progress_overall": "Gesamtfortschritt: ",
+        "progress_eta": "Geschätzte verbleibende Zeit: ",
+        "calculating": "Berechnung...",
         
-    def update_file_progress(self, progress):
-        """Обновляет прогресс текущего файла"""
-        self.current_file = progress
+        # Library descriptions
+        "recommended": "Empfohlen",
+        "basic_formats": "Grundformate",
+        "fast_standard": "Schnell für Standardformate",
+        "fast_large": "Schnell für große Bilder",
         
-    def complete_file(self):
-        """Отмечает завершение обработки файла"""
-        self.processed_files += 1
-        current_time = time.time()
-        file_time = current_time - self.file_start_time
-        self.avg_file_time = (self.avg_file_time * (self.processed_files - 1) + file_time) / self.processed_files
-        self.file_start_time = current_time
+        # Multi-page documents
+        "multipage": "Mehrseitige Dokumente",
+        "page_mode_auto": "Automatisch",
+        "page_mode_pages": "Datei pro Seite",
+        "page_mode_container": "Einzelnes Dokument",
+        "page_mode_single": "Ganze Datei (ohne Aufteilung)",
+        "page_dpi": "Render-DPI",
         
-    def get_eta(self):
-        """Возвращает расчетное время до завершения"""
-        if self.processed_files == 0:
-            return "Calculating..."
+        # Merge cache
+        "merge_cache": "Zusammenführungs-Cache",
+        "merge_cache_size": "Speicherbudget (MB)",
+        "merge_cache_spill": "Dekodierte Bilder auf Festplatte auslagern",
         
-        elapsed_time = time.time() - self.start_time
-        files_left = self.total_files - self.processed_files
-        avg_time_per_file = elapsed_time / self.processed_files
-        eta_seconds = files_left * avg_time_per_file
+        # Merge layouts
+        "grid": "Raster",
+        "contact_sheet": "Kontaktabzug",
+        "merge_layout": "Raster und Kontaktabzug",
+        "merge_columns": "Spalten (0 = auto)",
+        "merge_tile_size": "Kachelgröße, px (0 = auto)",
+        "merge_scale_to_fit": "Bilder an Zellen anpassen",
         
-        if eta_seconds < 60:
-            return f"{int(eta_seconds)}s"
-        elif eta_seconds < 3600:
-            return f"{int(eta_seconds/60)}m {int(eta_seconds%60)}s"
-        else:
-            hours = int(eta_seconds/3600)
-            minutes = int((eta_seconds%3600)/60)
-            return f"{hours}h {minutes}m"
+        # Archives
+        "archive_output": "Archiveingaben (ZIP/CBZ/TAR) in ein neues Archiv schreiben",
+        
+        # Encoder profiles
+        "encoder_profile": "Encoder-Profil",
+        "profile_fastest": "Am schnellsten",
+        "profile_balanced": "Ausgewogen",
+        "profile_smallest": "Kleinste Dateien",
+        "target_size": "Zieldateigröße, KB (0 = aus)",
+        "quality_metric": "Niedrigste Qualität wählen, die erreicht",
+        "quality_threshold": "Minimaler SSIM (0-1) oder PSNR (dB)",
+        "off": "Aus",
+        "metadata_policy": "Metadaten",
+        "metadata_keep": "Alle Metadaten behalten",
+        "metadata_strip": "Alle Metadaten entfernen",
+        "metadata_icc": "Nur Farbprofil behalten",
+        "metadata_orient_strip": "Automatisch drehen und entfernen",
+        "passthrough_hardlink": "Unveränderte Dateien per Hardlink",
+        "passthrough_count": "Ohne Neukodierung kopiert: {}",
+        "animation": "Animation",
+        "dedupe_frames": "Identische Frames zusammenfassen",
+        "reuse_palette": "Palette des Quell-GIFs wiederverwenden",
+        "pause": "Pause",
+        "resume": "Fortsetzen",
+        "cancel": "Abbrechen",
+        "job_cancelled": "Abgebrochen: verbleibende Dateien wurden übersprungen",
+        "preview": "Vorschau",
+        "merge_order": "Zusammenfügereihenfolge",
+        "range_expression": "Bereiche, z. B. 1-10, 11-20 oder every 8 oder height 20000",
+        "invalid_ranges": "Ungültige Bereiche: {}",
+        "transforms": "Transformationen, in Reihenfolge",
+        "transforms_hint": "z. B. auto_orient; resize 1600x1600 area; rotate 90",
+        "invalid_transforms": "Ungültige Transformationen: {}",
+        "profile_default": "Bibliotheksstandard",
+    }
+
+TRANSLATION_LOADERS = {
+    "en": _translations_en,
+    "ru": _translations_ru,
+    "zh": _translations_zh,
+    "ja": _translations_ja,
+    "ko": _translations_ko,
+    "es": _translations_es,
+    "fr": _translations_fr,
+    "de": _translations_de,
+}
+
+DEFAULT_VISIBLE_FORMATS = [
+    "PNG", "JPEG", "GIF", "WEBP", "BMP", "TIFF", "SVG", "PDF",
+    "EPS", "PSD", "HEIC", "AVIF", "JPEGXL", "ICO", "PPM",
+    "RLA", "PCX", "PNM", "XBM", "TGA", "DJVU", "DZI"
+]
+
+DEFAULT_SETTINGS = {
+    'theme': 'dark',
+    'language': 'en',
+    'visible_formats': DEFAULT_VISIBLE_FORMATS,
+    'merge_format': 'png',
+    'processing_lib': ProcessingLibrary.WAND,
+}
+
+def config_dir():
+    """Папка настроек пользователя: %APPDATA%\\AmiFile или $XDG_CONFIG_HOME/ami-file"""
+    if sys.platform == 'win32':
+        base = os.environ.get('APPDATA') or os.path.expanduser('~')
+        return os.path.join(base, 'AmiFile')
+    if sys.platform == 'darwin':
+        return os.path.expanduser('~/Library/Application Support/AmiFile')
+    base = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    return os.path.join(base, 'ami-file')
+
+class SettingsStore:
+    """Единое хранилище настроек: файл читается один раз, запись атомарная.
+
+    Раньше settings.json лежал в текущей папке; если он есть, а файла
+    в папке пользователя ещё нет, настройки переносятся оттуда.
+    """
+    LEGACY_PATH = 'settings.json'
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(config_dir(), 'settings.json')
+        self.data = self._read()
+
+    def _read(self):
+        data = {}
+        for candidate in (self.path, self.LEGACY_PATH):
+            try:
+                with open(candidate, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                break
+            except (OSError, ValueError):
+                continue
+        if not isinstance(data, dict):
+            data = {}
+        for key, value in DEFAULT_SETTINGS.items():
+            data.setdefault(key, list(value) if isinstance(value, list) else value)
+        return data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+
+class LocalizedText(str):
+    """Переведенная строка, которая помнит свой ключ: виджет хранит ее как есть,
+    и apply_language перерисовывает текст по ключу на новом языке"""
+    __slots__ = ('key',)
+
+    def __new__(cls, value, key):
+        text = super().__new__(cls, value)
+        text.key = key
+        return text
 
 class Localization:
-    TRANSLATIONS = {
-        "en": {
-            # Settings tab
-            "settings": "Settings",
-            "appearance": "Appearance",
-            "language": "Language",
-            "theme_light": "Light",
-            "theme_dark": "Dark",
-            "save_settings": "Save Settings",
-            "settings_saved": "Settings saved successfully!",
-            # Convert tab
-            "convert": "Convert",
-            "select_files": "Select files or folder",
-            "browse": "Browse",
-            "conversion_format": "Conversion format",
-            "convert_btn": "Convert",
-            "success": "Success",
-            "error": "Error",
-            "select_folder": "Select folder? (No - select files)",
-            "select_images": "Select images",
-            "select_save_folder": "Select folder to save",
-            "no_images": "No images to convert!",
-            "conversion_complete": "Conversion complete!",
-            "conversion_error": "Conversion error for {}: {}",
-            # Merge tab
-            "merge": "Merge",
-            "merge_direction": "Merge direction",
-            "horizontal": "Horizontal",
-            "vertical": "Vertical",
-            "add_range": "Add Range",
-            "image": "Image",
-            "to": "to",
-            "delete": "Delete",
-            "merge_btn": "Merge",
-            "no_merge_images": "No images to merge!",
-            "invalid_range": "Invalid range for image {}!",
-            "no_range_images": "No images in range {}!",
-            "loading_error": "Error loading images: {}",
-            "saving_error": "Error saving image {}: {}",
-            "merge_complete": "Merge complete!",
-            # About section
-            "about": "About",
-            "version": "Version",
-            "github": "GitHub Repository",
-            "github_link": "Open in browser",
-            "visible_formats": "Visible Formats",
-            "merge_output_format": "Merge Output Format",
-            # Progress bar translations
-            "progress_current": "Current file: ",
-            "progress_time": "Time per file: ",
-            "progress_overall": "Overall progress: ",
-            "progress_eta": "Estimated time remaining: ",
-            "calculating": "Calculating...",
-            
-            # Library descriptions
-            "recommended": "Recommended",
-            "basic_formats": "Basic formats",
-            "fast_standard": "Fast for standard formats",
-            "fast_large": "Fast for large images",
-        },
-        "ru": {
-            # Settings tab
-            "settings": "Настройки",
-            "appearance": "Внешний вид",
-            "language": "Язык",
-            "theme_light": "Светлая",
-            "theme_dark": "Тёмная",
-            "save_settings": "Сохранить настройки",
-            "settings_saved": "Настройки успешно сохранены!",
-            # Convert tab
-            "convert": "Конвертация",
-            "select_files": "Выберите папку или файлы",
-            "browse": "Обзор",
-            "conversion_format": "Формат конвертации",
-            "convert_btn": "Конвертировать",
-            "success": "Успех",
-            "error": "Ошибка",
-            "select_folder": "Выбрать папку? (Нет - выбрать файлы)",
-            "select_images": "Выберите изображения",
-            "select_save_folder": "Выберите папку для сохранения",
-            "no_images": "Нет изображений для конвертации!",
-            "conversion_complete": "Конвертация завершена!",
-            "conversion_error": "Ошибка конвертации {}: {}",
-            # Merge tab
-            "merge": "Склеивание",
-            "merge_direction": "Направление склеивания",
-            "horizontal": "Горизонтально",
-            "vertical": "Вертикально",
-            "add_range": "Добавить диапазон",
-            "image": "Изображение",
-            "to": "до",
-            "delete": "Удалить",
-            "merge_btn": "Склеить",
-            "no_merge_images": "Нет изображений для склеивания!",
-            "invalid_range": "Некорректный диапазон для изображения {}!",
-            "no_range_images": "Нет изображений в диапазоне {}!",
-            "loading_error": "Ошибка загрузки изображений: {}",
-            "saving_error": "Ошибка сохранения изображения {}: {}",
-            "merge_complete": "Склеивание завершено!",
-            # About section
-            "about": "О программе",
-            "version": "Версия",
-            "github": "Репозиторий GitHub",
-            "github_link": "Открыть в браузере",
-            "visible_formats": "Видимые форматы",
-            "merge_output_format": "Формат склеивания",
-            # Progress bar translations
-            "progress_current": "Текущий файл: ",
-            "progress_time": "Время на файл: ",
-            "progress_overall": "Общий прогресс: ",
-            "progress_eta": "Осталось времени: ",
-            "calculating": "Вычисление...",
-            
-            # Library descriptions
-            "recommended": "Рекомендуется",
-            "basic_formats": "Базовые форматы",
-            "fast_standard": "Быстрая для стандартных форматов",
-            "fast_large": "Быстрая для больших изображений",
-        },
-        "zh": {
-            # Settings tab
-            "settings": "设置",
-            "appearance": "外观",
-            "language": "语言",
-            "theme_light": "浅色",
-            "theme_dark": "深色",
-            "save_settings": "保存设置",
-            "settings_saved": "设置保存成功！",
-            # Convert tab
-            "convert": "转换",
-            "select_files": "选择文件或文件夹",
-            "browse": "浏览",
-            "conversion_format": "转换格式",
-            "convert_btn": "转换",
-            "success": "成功",
-            "error": "错误",
-            "select_folder": "选择文件夹？（否 - 选择文件）",
-            "select_images": "选择图片",
-            "select_save_folder": "选择保存文件夹",
-            "no_images": "没有图片可转换！",
-            "conversion_complete": "转换完成！",
-            "conversion_error": "{} 转换错误：{}",
-            # Merge tab
-            "merge": "合并",
-            "merge_direction": "合并方向",
-            "horizontal": "水平",
-            "vertical": "垂直",
-            "add_range": "添加范围",
-            "image": "图片",
-            "to": "到",
-            "delete": "删除",
-            "merge_btn": "合并",
-            "no_merge_images": "没有图片可合并！",
-            "invalid_range": "图片 {} 的范围无效！",
-            "no_range_images": "范围 {} 中没有图片！",
-            "loading_error": "加载图片错误：{}",
-            "saving_error": "保存图片 {} 错误：{}",
-            "merge_complete": "合并完成！",
-            # About section
-            "about": "关于",
-            "version": "版本",
-            "github": "GitHub 仓库",
-            "github_link": "在浏览器中打开",
-            "visible_formats": "可见格式",
-            "merge_output_format": "合并输出格式",
-            # Progress bar translations
-            "progress_current": "当前文件: ",
-            "progress_time": "每个文件的时间: ",
-            "progress_overall": "总体进度: ",
-            "progress_eta": "预计剩余时间: ",
-            "calculating": "计算中...",
-            
-            # Library descriptions
-            "recommended": "推荐",
-            "basic_formats": "基本格式",
-            "fast_standard": "标准格式快速",
-            "fast_large": "大图像快速",
-        },
-        "ja": {
-            # Settings tab
-            "settings": "設定",
-            "appearance": "外観",
-            "language": "言語",
-            "theme_light": "ライト",
-            "theme_dark": "ダーク",
-            "save_settings": "設定を保存",
-            "settings_saved": "設定が保存されました！",
-            # Convert tab
-            "convert": "変換",
-            "select_files": "ファイルまたはフォルダを選択",
-            "browse": "参照",
-            "conversion_format": "変換形式",
-            "convert_btn": "変換",
-            "success": "成功",
-            "error": "エラー",
-            "select_folder": "フォルダを選択？（いいえ - ファイルを選択）",
-            "select_images": "画像を選択",
-            "select_save_folder": "保存フォルダを選択",
-            "no_images": "変換する画像がありません！",
-            "conversion_complete": "変換が完了しました！",
-            "conversion_error": "{} の変換エラー：{}",
-            # Merge tab
-            "merge": "結合",
-            "merge_direction": "結合方向",
-            "horizontal": "水平",
-            "vertical": "垂直",
-            "add_range": "範囲を追加",
-            "image": "画像",
-            "to": "から",
-            "delete": "削除",
-            "merge_btn": "結合",
-            "no_merge_images": "結合する画像がありません！",
-            "invalid_range": "画像 {} の範囲が無効です！",
-            "no_range_images": "範囲 {} に画像がありません！",
-            "loading_error": "画像の読み込みエラー：{}",
-            "saving_error": "画像 {} の保存エラー：{}",
-            "merge_complete": "結合が完了しました！",
-            # About section
-            "about": "について",
-            "version": "バージョン",
-            "github": "GitHub リポジトリ",
-            "github_link": "ブラウザで開く",
-            "visible_formats": "表示形式",
-            "merge_output_format": "結合出力形式",
-            # Progress bar translations
-            "progress_current": "現在のファイル: ",
-            "progress_time": "ファイルごとの時間: ",
-            "progress_overall": "全体の進捗: ",
-            "progress_eta": "残り時間の見積もり: ",
-            "calculating": "計算中...",
-            
-            # Library descriptions
-            "recommended": "推奨",
-            "basic_formats": "基本フォーマット",
-            "fast_standard": "標準フォーマットの高速",
-            "fast_large": "大きな画像の高速",
-        },
-        "ko": {
-            # Settings tab
-            "settings": "설정",
-            "appearance": "외관",
-            "language": "언어",
-            "theme_light": "라이트",
-            "theme_dark": "다크",
-            "save_settings": "설정 저장",
-            "settings_saved": "설정이 저장되었습니다!",
-            # Convert tab
-            "convert": "변환",
-            "select_files": "파일 또는 폴더 선택",
-            "browse": "찾아보기",
-            "conversion_format": "변환 형식",
-            "convert_btn": "변환",
-            "success": "성공",
-            "error": "오류",
-            "select_folder": "폴더를 선택하시겠습니까? (아니오 - 파일 선택)",
-            "select_images": "이미지 선택",
-            "select_save_folder": "저장 폴더 선택",
-            "no_images": "변환할 이미지가 없습니다!",
-            "conversion_complete": "변환이 완료되었습니다!",
-            "conversion_error": "{} 변환 오류: {}",
-            # Merge tab
-            "merge": "병합",
-            "merge_direction": "병합 방향",
-            "horizontal": "가로",
-            "vertical": "세로",
-            "add_range": "범위 추가",
-            "image": "이미지",
-            "to": "에서",
-            "delete": "삭제",
-            "merge_btn": "병합",
-            "no_merge_images": "병합할 이미지가 없습니다!",
-            "invalid_range": "이미지 {}의 범위가 잘못되었습니다!",
-            "no_range_images": "범위 {}에 이미지가 없습니다!",
-            "loading_error": "이미지 로딩 오류: {}",
-            "saving_error": "이미지 {} 저장 오류: {}",
-            "merge_complete": "병합이 완료되었습니다!",
-            # About section
-            "about": "정보",
-            "version": "버전",
-            "github": "GitHub 저장소",
-            "github_link": "브라우저에서 열기",
-            "visible_formats": "표시 형식",
-            "merge_output_format": "병합 출력 형식",
-            # Progress bar translations
-            "progress_current": "현재 파일: ",
-            "progress_time": "파일당 시간: ",
-            "progress_overall": "전체 진행 상황: ",
-            "progress_eta": "예상 남은 시간: ",
-            "calculating": "계산 중...",
-            
-            # Library descriptions
-            "recommended": "추천",
-            "basic_formats": "기본 형식",
-            "fast_standard": "표준 형식에 빠름",
-            "fast_large": "큰 이미지에 빠름",
-        },
-        "es": {
-            # Settings tab
-            "settings": "Configuración",
-            "appearance": "Apariencia",
-            "language": "Idioma",
-            "theme_light": "Claro",
-            "theme_dark": "Oscuro",
-            "save_settings": "Guardar Configuración",
-            "settings_saved": "¡Configuración guardada exitosamente!",
-            # Convert tab
-            "convert": "Convertir",
-            "select_files": "Seleccionar archivos o carpeta",
-            "browse": "Explorar",
-            "conversion_format": "Formato de conversión",
-            "convert_btn": "Convertir",
-            "success": "Éxito",
-            "error": "Error",
-            "select_folder": "¿Seleccionar carpeta? (No - seleccionar archivos)",
-            "select_images": "Seleccionar imágenes",
-            "select_save_folder": "Seleccionar carpeta para guardar",
-            "no_images": "¡No hay imágenes para convertir!",
-            "conversion_complete": "¡Conversión completada!",
-            "conversion_error": "Error de conversión para {}: {}",
-            # Merge tab
-            "merge": "Fusionar",
-            "merge_direction": "Dirección de fusión",
-            "horizontal": "Horizontal",
-            "vertical": "Vertical",
-            "add_range": "Añadir Rango",
-            "image": "Imagen",
-            "to": "hasta",
-            "delete": "Eliminar",
-            "merge_btn": "Fusionar",
-            "no_merge_images": "¡No hay imágenes para fusionar!",
-            "invalid_range": "¡Rango inválido para la imagen {}!",
-            "no_range_images": "¡No hay imágenes en el rango {}!",
-            "loading_error": "Error al cargar imágenes: {}",
-            "saving_error": "Error al guardar la imagen {}: {}",
-            "merge_complete": "¡Fusión completada!",
-            # About section
-            "about": "Acerca de",
-            "version": "Versión",
-            "github": "Repositorio GitHub",
-            "github_link": "Abrir en navegador",
-            "visible_formats": "Formatos Visibles",
-            "merge_output_format": "Formato de Salida de Fusión",
-            # Progress bar translations
-            "progress_current": "Archivo actual: ",
-            "progress_time": "Tiempo por archivo: ",
-            "progress_overall": "Progreso general: ",
-            "progress_eta": "Tiempo estimado restante: ",
-            "calculating": "Calculando...",
-            
-            # Library descriptions
-            "recommended": "Recomendado",
-            "basic_formats": "Formatos básicos",
-            "fast_standard": "Rápido para formatos estándar",
-            "fast_large": "Rápido para imágenes grandes",
-        },
-        "fr": {
-            # Settings tab
-            "settings": "Paramètres",
-            "appearance": "Apparence",
-            "language": "Langue",
-            "theme_light": "Clair",
-            "theme_dark": "Sombre",
-            "save_settings": "Enregistrer les Paramètres",
-            "settings_saved": "Paramètres enregistrés avec succès !",
-            # Convert tab
-            "convert": "Convertir",
-            "select_files": "Sélectionner fichiers ou dossier",
-            "browse": "Parcourir",
-            "conversion_format": "Format de conversion",
-            "convert_btn": "Convertir",
-            "success": "Succès",
-            "error": "Erreur",
-            "select_folder": "Sélectionner un dossier ? (Non - sélectionner des fichiers)",
-            "select_images": "Sélectionner des images",
-            "select_save_folder": "Sélectionner le dossier de sauvegarde",
-            "no_images": "Aucune image à convertir !",
-            "conversion_complete": "Conversion terminée !",
-            "conversion_error": "Erreur de conversion pour {}: {}",
-            # Merge tab
-            "merge": "Fusionner",
-            "merge_direction": "Direction de fusion",
-            "horizontal": "Horizontale",
-            "vertical": "Verticale",
-            "add_range": "Ajouter une Plage",
-            "image": "Image",
-            "to": "à",
-            "delete": "Supprimer",
-            "merge_btn": "Fusionner",
-            "no_merge_images": "Aucune image à fusionner !",
-            "invalid_range": "Plage invalide pour l'image {} !",
-            "no_range_images": "Aucune image dans la plage {} !",
-            "loading_error": "Erreur de chargement des images : {}",
-            "saving_error": "Erreur lors de la sauvegarde de l'image {} : {}",
-            "merge_complete": "Fusion terminée !",
-            # About section
-            "about": "À propos",
-            "version": "Version",
-            "github": "Dépôt GitHub",
-            "github_link": "Ouvrir dans le navigateur",
-            "visible_formats": "Formats Visibles",
-            "merge_output_format": "Format de Sortie de Fusion",
-            # Progress bar translations
-            "progress_current": "Fichier actuel: ",
-            "progress_time": "Temps par fichier: ",
-            "progress_overall": "Progression globale: ",
-            "progress_eta": "Temps restant estimé: ",
-            "calculating": "Calcul...",
-            
-            # Library descriptions
-            "recommended": "Recommandé",
-            "basic_formats": "Formats de base",
-            "fast_standard": "Rapide pour les formats standard",
-            "fast_large": "Rapide pour les grandes images",
-        },
-        "de": {
-            # Settings tab
-            "settings": "Einstellungen",
-            "appearance": "Erscheinungsbild",
-            "language": "Sprache",
-            "theme_light": "Hell",
-            "theme_dark": "Dunkel",
-            "save_settings": "Einstellungen Speichern",
-            "settings_saved": "Einstellungen erfolgreich gespeichert!",
-            # Convert tab
-            "convert": "Konvertieren",
-            "select_files": "Dateien oder Ordner auswählen",
-            "browse": "Durchsuchen",
-            "conversion_format": "Konvertierungsformat",
-            "convert_btn": "Konvertieren",
-            "success": "Erfolg",
-            "error": "Fehler",
-            "select_folder": "Ordner auswählen? (Nein - Dateien auswählen)",
-            "select_images": "Bilder auswählen",
-            "select_save_folder": "Speicherordner auswählen",
-            "no_images": "Keine Bilder zum Konvertieren!",
-            "conversion_complete": "Konvertierung abgeschlossen!",
-            "conversion_error": "Konvertierungsfehler für {}: {}",
-            # Merge tab
-            "merge": "Zusammenführen",
-            "merge_direction": "Zusammenführungsrichtung",
-            "horizontal": "Horizontal",
-            "vertical": "Vertikal",
-            "add_range": "Bereich Hinzufügen",
-            "image": "Bild",
-            "to": "bis",
-            "delete": "Löschen",
-            "merge_btn": "Zusammenführen",
-            "no_merge_images": "Keine Bilder zum Zusammenführen!",
-            "invalid_range": "Ungültiger Bereich für Bild {}!",
-            "no_range_images": "Keine Bilder im Bereich {}!",
-            "loading_error": "Fehler beim Laden der Bilder: {}",
-            "saving_error": "Fehler beim Speichern des Bildes {}: {}",
-            "merge_complete": "Zusammenführung abgeschlossen!",
-            # About section
-            "about": "Über",
-            "version": "Version",
-            "github": "GitHub Repository",
-            "github_link": "Im Browser öffnen",
-            "visible_formats": "Sichtbare Formate",
-            "merge_output_format": "Ausgabeformat Zusammenführung",
-            # Progress bar translations
-            "progress_current": "Aktuelle Datei: ",
-            "progress_time": "Zeit pro Datei: ",
-            "progress_overall": "Gesamtfortschritt: ",
-            "progress_eta": "Geschätzte verbleibende Zeit: ",
-            "calculating": "Berechnung...",
-            
-            # Library descriptions
-            "recommended": "Empfohlen",
-            "basic_formats": "Grundformate",
-            "fast_standard": "Schnell für Standardformate",
-            "fast_large": "Schnell für große Bilder",
-        }
-    }
+    _cache = {}
 
-    def __init__(self):
-        self.current_language = "en"
-        self.load_settings()
+    def __init__(self, language="en"):
+        self.current_language = language if language in TRANSLATION_LOADERS else "en"
 
-    def load_settings(self):
-        try:
-            with open('settings.json', 'r') as f:
-                settings = json.load(f)
-                self.current_language = settings.get('language', 'en')
-        except FileNotFoundError:
-            pass
+    @classmethod
+    def translations(cls, language):
+        """Возвращает словарь языка, загружая его при первом обращении"""
+        table = cls._cache.get(language)
+        if table is None:
+            table = cls._cache[language] = TRANSLATION_LOADERS.get(language, _translations_en)()
+        return table
 
     def get(self, key):
-        return self.TRANSLATIONS[self.current_language].get(key, key)
+        value = self.translations(self.current_language).get(key)
+        if value is None and self.current_language != "en":
+            value = self.translations("en").get(key)
+        return LocalizedText(key if value is None else value, key)
 
     def set_language(self, language):
-        self.current_language = language
+        self.current_language = language if language in TRANSLATION_LOADERS else "en"
 
 
 class ToolTip:
@@ -862,7 +5142,8 @@ class ToolTip:
         
         label = ctk.CTkLabel(
             self.tooltip,
-            text=self.text,
+            # Текст может быть функцией - тогда он собирается на текущем языке
+            text=self.text() if callable(self.text) else self.text,
             justify="left",
             wraplength=300
         )
@@ -1012,16 +5293,118 @@ class SelectionDialog(ctk.CTkToplevel):
         if command:
             command()
 
+class ThumbnailBrowser(ctk.CTkToplevel):
+    """Виртуализированный список миниатюр: на холсте существуют только видимые строки"""
+    ROW_HEIGHT = THUMBNAIL_SIZE + 8
+    OVERSCAN = 2
+    
+    def __init__(self, parent, title, images, max_workers=4):
+        super().__init__(parent)
+        self.title(title)
+        self.geometry("460x640")
+        self.transient(parent)
+        self.images = images
+        
+        dark = ctk.get_appearance_mode() == "Dark"
+        self.text_color = "#dce4ee" if dark else "#1a1a1a"
+        self.canvas = tk.Canvas(self, highlightthickness=0, bg="#2b2b2b" if dark else "#ebebeb")
+        scrollbar = ctk.CTkScrollbar(self, command=self._on_scrollbar)
+        self.canvas.configure(
+            yscrollcommand=scrollbar.set,
+            scrollregion=(0, 0, 0, len(images) * self.ROW_HEIGHT)
+        )
+        scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", fill="both", expand=True)
+        
+        self._items = {}      # индекс -> (картинка, подпись) на холсте
+        self._photos = {}     # индекс -> PhotoImage видимых строк
+        self._pending = {}    # индекс -> Future миниатюры
+        self._results = queue.Queue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        
+        self.canvas.bind("<Configure>", lambda event: self._render())
+        self.canvas.bind("<MouseWheel>", self._on_wheel)
+        self.canvas.bind("<Button-4>", lambda event: self._scroll(-3))
+        self.canvas.bind("<Button-5>", lambda event: self._scroll(3))
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self._poll()
+    
+    def _on_scrollbar(self, *args):
+        self.canvas.yview(*args)
+        self._render()
+    
+    def _on_wheel(self, event):
+        self._scroll(-1 if event.delta > 0 else 1)
+    
+    def _scroll(self, units):
+        self.canvas.yview_scroll(units, "units")
+        self._render()
+    
+    def _visible_range(self):
+        top = self.canvas.canvasy(0)
+        first = max(0, int(top // self.ROW_HEIGHT) - self.OVERSCAN)
+        last = min(len(self.images), int((top + self.canvas.winfo_height()) // self.ROW_HEIGHT) + 1 + self.OVERSCAN)
+        return first, last
+    
+    def _render(self):
+        first, last = self._visible_range()
+        
+        # Ушедшие из вида строки удаляются вместе с картинками и незапущенными задачами
+        for index in [i for i in self._items if not first <= i < last]:
+            for item in self._items.pop(index):
+                self.canvas.delete(item)
+            self._photos.pop(index, None)
+        for index in [i for i in self._pending if not first <= i < last]:
+            if self._pending[index].cancel():
+                del self._pending[index]
+        
+        for index in range(first, last):
+            if index in self._items:
+                continue
+            y = index * self.ROW_HEIGHT
+            image_item = self.canvas.create_image(8, y + 4, anchor="nw")
+            text_item = self.canvas.create_text(
+                THUMBNAIL_SIZE + 20, y + self.ROW_HEIGHT // 2,
+                anchor="w",
+                text=f"{index + 1}. {os.path.basename(str(self.images[index]))}",
+                fill=self.text_color
+            )
+            self._items[index] = (image_item, text_item)
+            if index not in self._pending:
+                future = self._executor.submit(make_thumbnail, self.images[index])
+                future.add_done_callback(lambda f, i=index: self._results.put((i, f)))
+                self._pending[index] = future
+    
+    def _poll(self):
+        """Забирает готовые миниатюры из фоновых потоков (Tk трогаем только здесь)"""
+        while True:
+            try:
+                index, future = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if self._pending.get(index) is future:
+                del self._pending[index]
+            if future.cancelled() or future.exception() is not None or index not in self._items:
+                continue
+            photo = tk.PhotoImage(file=future.result())
+            self._photos[index] = photo
+            self.canvas.itemconfigure(self._items[index][0], image=photo)
+        self._poll_id = self.after(50, self._poll)
+    
+    def close(self):
+        self.after_cancel(self._poll_id)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.destroy()
+
 class AmiFile(ctk.CTk):
     def __init__(self):
         super().__init__()
         # Load settings
         self.load_settings()
         # Initialize localization
-        self.loc = Localization()
+        self.loc = Localization(self.settings.get('language', 'en'))
         # Apply theme from settings
         ctk.set_appearance_mode(self.settings.get('theme', 'dark'))
-        self.loc.current_language = self.settings.get('language', 'en')
         # Main window settings with fixed size
         self.title("Ami File")
         self.geometry("800x600")
@@ -1040,15 +5423,34 @@ class AmiFile(ctk.CTk):
         self.media_format_var = ctk.StringVar(value="mp4")
         self.range_entries = []
         # Add new variables
-        self.visible_formats = self.settings.get('visible_formats', [
-            "PNG", "JPEG", "GIF", "WEBP", "BMP", "TIFF", "SVG", "PDF", 
-            "EPS", "PSD", "HEIC", "AVIF", "JPEGXL", "ICO", "PPM",
-            "RLA", "PCX", "PNM", "XBM", "TGA", "DJVU"
-        ])
+        self.visible_formats = self.settings.get('visible_formats', list(DEFAULT_VISIBLE_FORMATS))
         self.merge_format_var = ctk.StringVar(value=self.settings.get('merge_format', 'png'))
         self.processing_lib = ctk.StringVar(value=self.settings.get('processing_lib', ProcessingLibrary.WAND))
+        self.page_mode_var = ctk.StringVar(value=self.settings.get('page_mode', PageMode.AUTO))
+        self.page_dpi_var = ctk.StringVar(value=str(self.settings.get('page_dpi', 150)))
+        self.merge_columns_var = ctk.StringVar(value=str(self.settings.get('merge_columns', 0)))
+        self.merge_tile_size_var = ctk.StringVar(value=str(self.settings.get('merge_tile_size', 0)))
+        self.merge_scale_to_fit_var = ctk.BooleanVar(value=self.settings.get('merge_scale_to_fit', False))
+        self.encoder_profile_var = ctk.StringVar(value=self.settings.get('encoder_profile', EncoderProfile.DEFAULT))
+        self.target_size_var = ctk.StringVar(value=str(self.settings.get('target_size_kb', 0)))
+        self.dedupe_frames_var = ctk.BooleanVar(value=self.settings.get('dedupe_frames', True))
+        self.reuse_palette_var = ctk.BooleanVar(value=self.settings.get('reuse_palette', False))
+        self.passthrough_hardlink_var = ctk.BooleanVar(value=self.settings.get('passthrough_hardlink', False))
+        self.metadata_policy_var = ctk.StringVar(value=self.settings.get('metadata_policy', MetadataPolicy.KEEP))
+        self.quality_metric_var = ctk.StringVar(value=self.settings.get('quality_metric', 'off'))
+        self.quality_threshold_var = ctk.StringVar(value=str(self.settings.get('quality_threshold', 0.98)))
+        self.transforms_var = ctk.StringVar(value=self.settings.get('transforms', ''))
+        self.archive_output_var = ctk.BooleanVar(value=self.settings.get('archive_output', False))
+        self.merge_cache_mb_var = ctk.StringVar(value=str(self.settings.get('merge_cache_mb', 512)))
+        self.merge_cache_spill_var = ctk.BooleanVar(value=self.settings.get('merge_cache_spill', False))
+        self.apply_cache_settings()
         self.conversion_running = False
         self.merge_running = False
+        # Токены отмены и потоки текущих задач ('convert' и 'merge')
+        self.job_tokens = {'convert': None, 'merge': None}
+        self.job_threads = {'convert': None, 'merge': None}
+        self.pause_buttons = {}
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
         # Создаем вкладки
         self.tabview = ctk.CTkTabview(self)
         self.tabview.pack(fill="both", expand=True, padx=20, pady=20)
@@ -1062,6 +5464,7 @@ class AmiFile(ctk.CTk):
         self.setup_convert_tab()
         self.setup_merge_tab()
         self.setup_settings_tab()
+        self._applied_formats = list(self.visible_formats)
 
     def center_window(self):
         """Центрирует окно приложения на экране"""
@@ -1077,91 +5480,120 @@ class AmiFile(ctk.CTk):
         self.geometry(f"800x600+{x}+{y}")
 
     def load_settings(self):
-        try:
-            with open('settings.json', 'r') as f:
-                self.settings = json.load(f)
-                if 'visible_formats' not in self.settings:
-                    self.settings['visible_formats'] = [
-                        "PNG", "JPEG", "GIF", "WEBP", "BMP", "TIFF", "SVG", "PDF", 
-                        "EPS", "PSD", "HEIC", "AVIF", "JPEGXL", "ICO", "PPM",
-                        "RLA", "PCX", "PNM", "XBM", "TGA", "DJVU"
-                    ]
-                if 'merge_format' not in self.settings:
-                    self.settings['merge_format'] = 'png'
-                if 'processing_lib' not in self.settings:
-                    self.settings['processing_lib'] = ProcessingLibrary.WAND
-        except FileNotFoundError:
-            self.settings = {
-                'theme': 'dark',
-                'language': 'en',
-                'visible_formats': [
-                    "PNG", "JPEG", "GIF", "WEBP", "BMP", "TIFF", "SVG", "PDF", 
-                    "EPS", "PSD", "HEIC", "AVIF", "JPEGXL", "ICO", "PPM",
-                    "RLA", "PCX", "PNM", "XBM", "TGA", "DJVU"
-                ],
-                'merge_format': 'png',
-                'processing_lib': ProcessingLibrary.WAND
-            }
+        self.settings_store = SettingsStore()
+        self.settings = self.settings_store.data
 
     def save_settings(self):
         self.settings['theme'] = self.theme_var.get()
         self.settings['language'] = self.language_var.get()
         self.settings['visible_formats'] = [fmt for fmt in self.visible_formats]
         self.settings['merge_format'] = self.merge_format_var.get()
-        
-        with open('settings.json', 'w') as f:
-            json.dump(self.settings, f)
+        self.settings['page_mode'] = self.page_mode_var.get()
+        try:
+            self.settings['page_dpi'] = max(1, int(self.page_dpi_var.get()))
+        except ValueError:
+            self.page_dpi_var.set(str(self.settings.get('page_dpi', 150)))
+        for key, var in [('merge_columns', self.merge_columns_var), ('merge_tile_size', self.merge_tile_size_var)]:
+            try:
+                self.settings[key] = max(0, int(var.get()))
+            except ValueError:
+                var.set(str(self.settings.get(key, 0)))
+        self.settings['merge_scale_to_fit'] = self.merge_scale_to_fit_var.get()
+        try:
+            self.settings['merge_cache_mb'] = max(0, int(self.merge_cache_mb_var.get()))
+        except ValueError:
+            self.merge_cache_mb_var.set(str(self.settings.get('merge_cache_mb', 512)))
+        self.settings['merge_cache_spill'] = self.merge_cache_spill_var.get()
+        self.settings['archive_output'] = self.archive_output_var.get()
+        self.settings['encoder_profile'] = self.encoder_profile_var.get()
+        try:
+            self.settings['target_size_kb'] = max(0, int(self.target_size_var.get()))
+        except ValueError:
+            self.target_size_var.set(str(self.settings.get('target_size_kb', 0)))
+        self.settings['quality_metric'] = self.quality_metric_var.get()
+        self.settings['metadata_policy'] = self.metadata_policy_var.get()
+        self.settings['passthrough_hardlink'] = self.passthrough_hardlink_var.get()
+        self.settings['dedupe_frames'] = self.dedupe_frames_var.get()
+        self.settings['reuse_palette'] = self.reuse_palette_var.get()
+        try:
+            self.settings['quality_threshold'] = float(self.quality_threshold_var.get())
+        except ValueError:
+            self.quality_threshold_var.set(str(self.settings.get('quality_threshold', 0.98)))
+        try:
+            parse_transforms(self.transforms_var.get())
+            self.settings['transforms'] = self.transforms_var.get().strip()
+        except ValueError as e:
+            messagebox.showerror(self.loc.get("error"), self.loc.get("invalid_transforms").format(str(e)))
+            self.transforms_var.set(self.settings.get('transforms', ''))
+        self.apply_cache_settings()
+        formats_changed = self.settings.get('visible_formats') != self._applied_formats
+        self.settings_store.save()
             
         # Apply settings immediately
         ctk.set_appearance_mode(self.theme_var.get())
-        self.loc.set_language(self.language_var.get())
-        
-        # Update interface and stay on settings tab
-        self.refresh_interface()
+        if self.language_var.get() != self.loc.current_language:
+            self.apply_language(self.language_var.get())
+        if formats_changed:
+            self.refresh_convert_tab()
 
-    def refresh_interface(self):
-        """Полностью обновляет интерфейс при изменении настроек"""
-        # Пересоздаём все вкладки
-        for widget in self.tab_convert.winfo_children():
-            widget.destroy()
-        for widget in self.tab_merge.winfo_children():
-            widget.destroy()
-        for widget in self.tab_settings.winfo_children():
-            widget.destroy()
-            
-        # Переустанавливаем все вкладки
-        self.setup_convert_tab()
-        self.setup_merge_tab()
-        self.setup_settings_tab()
-        
-        # Обновляем заголовки вкладок
-        self.tabview._tab_dict["Convert"].configure(text=self.loc.get("convert"))
-        self.tabview._tab_dict["Merge"].configure(text=self.loc.get("merge"))
-        self.tabview._tab_dict["Settings"].configure(text=self.loc.get("settings"))
+    def apply_cache_settings(self):
+        """Применяет настройки кэша склеивания"""
+        MERGE_CACHE.configure(
+            max_bytes=self.settings.get('merge_cache_mb', 512) * 1024 * 1024,
+            spill_dir=MERGE_CACHE_DIR if self.settings.get('merge_cache_spill', False) else None
+        )
+
+    def encoder_profile(self):
+        """Выбранный профиль кодера; None - прежние параметры библиотек"""
+        profile = self.settings.get('encoder_profile', EncoderProfile.DEFAULT)
+        return None if profile == EncoderProfile.DEFAULT else profile
+
+    def localize(self, widget, render, option="text"):
+        """Задает составной текст виджета (перевод плюс значения) функцией render.
         
-        # Возвращаемся на вкладку настроек
+        apply_language вызывает ее снова, поэтому счетчики, пути и версии
+        перерисовываются на новом языке вместе с переводом.
+        """
+        widget._ami_render = (option, render)
+        widget.configure(**{option: render()})
+        return widget
+
+    def apply_language(self, language):
+        """Меняет язык на месте: переписывает тексты виджетов без их пересоздания"""
+        tab_names = [self.loc.get(key) for key in ("convert", "merge", "settings")]
+        self.loc.set_language(language)
+        stack = [self]
+        while stack:
+            widget = stack.pop()
+            stack.extend(widget.winfo_children())
+            self._retranslate_widget(widget)
+        for key, old_name in zip(("convert", "merge", "settings"), tab_names):
+            new_name = self.loc.get(key)
+            if new_name != old_name:
+                self.tabview.rename(old_name, new_name)
         self.tabview.set(self.loc.get("settings"))
 
-    def update_interface(self):
-        """Update the interface when settings change"""
-        # Recreate convert tab with new formats
+    def _retranslate_widget(self, widget):
+        if not isinstance(widget, ctk.CTkBaseClass):
+            return
+        # Простые тексты - LocalizedText с ключом, составные - через localize
+        for option in ("text", "placeholder_text"):
+            try:
+                current = widget.cget(option)
+            except (ValueError, tk.TclError):
+                continue
+            if isinstance(current, LocalizedText):
+                widget.configure(**{option: self.loc.get(current.key)})
+        render = getattr(widget, '_ami_render', None)
+        if render is not None:
+            widget.configure(**{render[0]: render[1]()})
+
+    def refresh_convert_tab(self):
+        """Пересоздаёт только вкладку конвертации (список форматов зависит от настроек)"""
         for widget in self.tab_convert.winfo_children():
             widget.destroy()
         self.setup_convert_tab()
-        
-        # Update tab names
-        self.tabview.set("Convert")  # Switch to first tab
-        
-        # Update text in all frames
-        for widget in self.tab_settings.winfo_children():
-            if isinstance(widget, ctk.CTkScrollableFrame):
-                for child in widget.winfo_children():
-                    if isinstance(child, ctk.CTkLabel):
-                        if hasattr(child, "_text") and child._text in self.loc.TRANSLATIONS[self.loc.current_language]:
-                            child.configure(text=self.loc.get(child._text))
-        
-        # Force update
-        self.update()
+        self._applied_formats = list(self.visible_formats)
 
     def setup_settings_tab(self):
         # Create scrollable frame for settings
@@ -1266,7 +5698,7 @@ class AmiFile(ctk.CTk):
         formats = [
             "PNG", "JPEG", "GIF", "WEBP", "BMP", "TIFF", "SVG", "PDF", 
             "EPS", "PSD", "HEIC", "AVIF", "JPEGXL", "ICO", "PPM",
-            "RLA", "PCX", "PNM", "XBM", "TGA", "DJVU"
+            "RLA", "PCX", "PNM", "XBM", "TGA", "DJVU", "DZI"
         ]
         
         # Create checkboxes dictionary to store references
@@ -1299,6 +5731,149 @@ class AmiFile(ctk.CTk):
                 value=fmt.lower()
             ).pack(pady=2)
 
+        # Encoder profile settings
+        profile_frame = ctk.CTkFrame(settings_scroll)
+        profile_frame.pack(fill="x", pady=10)
+        
+        ctk.CTkLabel(profile_frame, text=self.loc.get("encoder_profile")).pack(pady=5)
+        
+        for profile in (EncoderProfile.DEFAULT,) + tuple(ENCODER_PROFILES):
+            ctk.CTkRadioButton(
+                profile_frame,
+                text=self.loc.get(f"profile_{profile}"),
+                variable=self.encoder_profile_var,
+                value=profile
+            ).pack(pady=2)
+        
+        target_frame = ctk.CTkFrame(profile_frame, fg_color="transparent")
+        target_frame.pack(pady=5)
+        ctk.CTkLabel(target_frame, text=self.loc.get("target_size")).pack(side="left", padx=5)
+        ctk.CTkEntry(target_frame, textvariable=self.target_size_var, width=70).pack(side="left", padx=5)
+        
+        ctk.CTkLabel(profile_frame, text=self.loc.get("quality_metric")).pack(pady=5)
+        metric_frame = ctk.CTkFrame(profile_frame, fg_color="transparent")
+        metric_frame.pack(pady=2)
+        for metric in ('off',) + QUALITY_METRICS:
+            ctk.CTkRadioButton(
+                metric_frame,
+                text=self.loc.get("off") if metric == 'off' else metric.upper(),
+                variable=self.quality_metric_var,
+                value=metric
+            ).pack(side="left", padx=5)
+        threshold_frame = ctk.CTkFrame(profile_frame, fg_color="transparent")
+        threshold_frame.pack(pady=5)
+        ctk.CTkLabel(threshold_frame, text=self.loc.get("quality_threshold")).pack(side="left", padx=5)
+        ctk.CTkEntry(threshold_frame, textvariable=self.quality_threshold_var, width=70).pack(side="left", padx=5)
+
+        # Metadata policy settings
+        metadata_frame = ctk.CTkFrame(settings_scroll)
+        metadata_frame.pack(fill="x", pady=10)
+        
+        ctk.CTkLabel(metadata_frame, text=self.loc.get("metadata_policy")).pack(pady=5)
+        
+        for policy in METADATA_POLICIES:
+            ctk.CTkRadioButton(
+                metadata_frame,
+                text=self.loc.get(f"metadata_{policy}"),
+                variable=self.metadata_policy_var,
+                value=policy
+            ).pack(pady=2)
+        
+        ctk.CTkCheckBox(
+            metadata_frame,
+            text=self.loc.get("passthrough_hardlink"),
+            variable=self.passthrough_hardlink_var
+        ).pack(pady=5)
+
+        # Transform settings
+        transform_frame = ctk.CTkFrame(settings_scroll)
+        transform_frame.pack(fill="x", pady=10)
+        
+        ctk.CTkLabel(transform_frame, text=self.loc.get("transforms")).pack(pady=5)
+        ctk.CTkEntry(transform_frame, textvariable=self.transforms_var, width=360).pack(pady=2)
+        ctk.CTkLabel(transform_frame, text=self.loc.get("transforms_hint")).pack(pady=5)
+
+        # Animation settings
+        animation_frame = ctk.CTkFrame(settings_scroll)
+        animation_frame.pack(fill="x", pady=10)
+        
+        ctk.CTkLabel(animation_frame, text=self.loc.get("animation")).pack(pady=5)
+        ctk.CTkCheckBox(
+            animation_frame,
+            text=self.loc.get("dedupe_frames"),
+            variable=self.dedupe_frames_var
+        ).pack(pady=2)
+        ctk.CTkCheckBox(
+            animation_frame,
+            text=self.loc.get("reuse_palette"),
+            variable=self.reuse_palette_var
+        ).pack(pady=2)
+
+        # Grid and contact sheet layout settings
+        layout_frame = ctk.CTkFrame(settings_scroll)
+        layout_frame.pack(fill="x", pady=10)
+        
+        ctk.CTkLabel(layout_frame, text=self.loc.get("merge_layout")).pack(pady=5)
+        
+        layout_grid = ctk.CTkFrame(layout_frame, fg_color="transparent")
+        layout_grid.pack(pady=5)
+        ctk.CTkLabel(layout_grid, text=self.loc.get("merge_columns")).grid(row=0, column=0, padx=5, pady=2, sticky="w")
+        ctk.CTkEntry(layout_grid, textvariable=self.merge_columns_var, width=70).grid(row=0, column=1, padx=5, pady=2)
+        ctk.CTkLabel(layout_grid, text=self.loc.get("merge_tile_size")).grid(row=1, column=0, padx=5, pady=2, sticky="w")
+        ctk.CTkEntry(layout_grid, textvariable=self.merge_tile_size_var, width=70).grid(row=1, column=1, padx=5, pady=2)
+        
+        ctk.CTkCheckBox(
+            layout_frame,
+            text=self.loc.get("merge_scale_to_fit"),
+            variable=self.merge_scale_to_fit_var
+        ).pack(pady=5)
+
+        # Merge cache settings
+        cache_frame = ctk.CTkFrame(settings_scroll)
+        cache_frame.pack(fill="x", pady=10)
+        
+        ctk.CTkLabel(cache_frame, text=self.loc.get("merge_cache")).pack(pady=5)
+        
+        cache_size_frame = ctk.CTkFrame(cache_frame, fg_color="transparent")
+        cache_size_frame.pack(pady=5)
+        ctk.CTkLabel(cache_size_frame, text=self.loc.get("merge_cache_size")).pack(side="left", padx=5)
+        ctk.CTkEntry(cache_size_frame, textvariable=self.merge_cache_mb_var, width=70).pack(side="left", padx=5)
+        
+        ctk.CTkCheckBox(
+            cache_frame,
+            text=self.loc.get("merge_cache_spill"),
+            variable=self.merge_cache_spill_var
+        ).pack(pady=5)
+
+        # Multi-page document settings
+        pages_frame = ctk.CTkFrame(settings_scroll)
+        pages_frame.pack(fill="x", pady=10)
+        
+        ctk.CTkLabel(pages_frame, text=self.loc.get("multipage")).pack(pady=5)
+        
+        for mode in [PageMode.AUTO, PageMode.PAGES, PageMode.CONTAINER, PageMode.SINGLE]:
+            ctk.CTkRadioButton(
+                pages_frame,
+                text=self.loc.get(f"page_mode_{mode}"),
+                variable=self.page_mode_var,
+                value=mode
+            ).pack(pady=2)
+        
+        dpi_frame = ctk.CTkFrame(pages_frame, fg_color="transparent")
+        dpi_frame.pack(pady=5)
+        ctk.CTkLabel(dpi_frame, text=self.loc.get("page_dpi")).pack(side="left", padx=5)
+        ctk.CTkEntry(dpi_frame, textvariable=self.page_dpi_var, width=70).pack(side="left", padx=5)
+
+        # Archive output settings
+        archive_frame = ctk.CTkFrame(settings_scroll)
+        archive_frame.pack(fill="x", pady=10)
+        
+        ctk.CTkCheckBox(
+            archive_frame,
+            text=self.loc.get("archive_output"),
+            variable=self.archive_output_var
+        ).pack(pady=10)
+
         # Processing library selection with tooltips
         library_frame = ctk.CTkFrame(settings_scroll)
         library_frame.pack(fill="x", pady=10)
@@ -1327,19 +5902,19 @@ class AmiFile(ctk.CTk):
         # Создаем строки с поддерживаемыми форматами для каждой библиотеки
         library_info = {
             ProcessingLibrary.WAND: {
-                'name': f"ImageMagick/Wand ({self.loc.get('recommended')})",
+                'name': lambda: f"ImageMagick/Wand ({self.loc.get('recommended')})",
                 'formats': SUPPORTED_FORMATS['wand']
             },
             ProcessingLibrary.PIL: {
-                'name': f"Pillow/PIL ({self.loc.get('basic_formats')})",
+                'name': lambda: f"Pillow/PIL ({self.loc.get('basic_formats')})",
                 'formats': SUPPORTED_FORMATS['pil']
             },
             ProcessingLibrary.CV2: {
-                'name': f"OpenCV ({self.loc.get('fast_standard')})",
+                'name': lambda: f"OpenCV ({self.loc.get('fast_standard')})",
                 'formats': SUPPORTED_FORMATS['cv2']
             },
             ProcessingLibrary.VIPS: {
-                'name': f"Pyvips ({self.loc.get('fast_large')})",
+                'name': lambda: f"Pyvips ({self.loc.get('fast_large')})",
                 'formats': SUPPORTED_FORMATS['vips']
             }
         }
@@ -1347,8 +5922,8 @@ class AmiFile(ctk.CTk):
         def create_library_tooltip():
             tooltip_text = f"{self.loc.get('supported_formats')}:\n\n"
             for lib_key, lib_info in library_info.items():
-                if getattr(sys.modules[__name__], f'HAVE_{lib_key.upper()}'):
-                    tooltip_text += f"{lib_info['name']}:\n"
+                if get_backend(lib_key).probe():
+                    tooltip_text += f"{lib_info['name']()}:\n"
                     tooltip_text += f"{self.loc.get('input_formats')}"
                     tooltip_text += format_supported_formats(lib_info['formats']['input'])
                     tooltip_text += f"\n{self.loc.get('output_formats')}"
@@ -1356,50 +5931,50 @@ class AmiFile(ctk.CTk):
                     tooltip_text += "\n\n"
             return tooltip_text
         
-        create_tooltip(info_btn, create_library_tooltip())
+        create_tooltip(info_btn, create_library_tooltip)
         
         # Создаем радио-кнопки для каждой доступной библиотеки
         if HAVE_WAND:
             radio = ctk.CTkRadioButton(
                 library_frame,
-                text=library_info[ProcessingLibrary.WAND]['name'],
                 variable=self.processing_lib,
                 value=ProcessingLibrary.WAND,
                 command=self.update_format_visibility
             )
+            self.localize(radio, library_info[ProcessingLibrary.WAND]['name'])
             radio.pack(pady=2)
             create_tooltip(radio, format_supported_formats(library_info[ProcessingLibrary.WAND]['formats']['output']))
         
         if HAVE_PIL:
             radio = ctk.CTkRadioButton(
                 library_frame,
-                text=library_info[ProcessingLibrary.PIL]['name'],
                 variable=self.processing_lib,
                 value=ProcessingLibrary.PIL,
                 command=self.update_format_visibility
             )
+            self.localize(radio, library_info[ProcessingLibrary.PIL]['name'])
             radio.pack(pady=2)
             create_tooltip(radio, format_supported_formats(library_info[ProcessingLibrary.PIL]['formats']['output']))
         
         if HAVE_CV2:
             radio = ctk.CTkRadioButton(
                 library_frame,
-                text=library_info[ProcessingLibrary.CV2]['name'],
                 variable=self.processing_lib,
                 value=ProcessingLibrary.CV2,
                 command=self.update_format_visibility
             )
+            self.localize(radio, library_info[ProcessingLibrary.CV2]['name'])
             radio.pack(pady=2)
             create_tooltip(radio, format_supported_formats(library_info[ProcessingLibrary.CV2]['formats']['output']))
         
         if HAVE_VIPS:
             radio = ctk.CTkRadioButton(
                 library_frame,
-                text=library_info[ProcessingLibrary.VIPS]['name'],
                 variable=self.processing_lib,
                 value=ProcessingLibrary.VIPS,
                 command=self.update_format_visibility
             )
+            self.localize(radio, library_info[ProcessingLibrary.VIPS]['name'])
             radio.pack(pady=2)
             create_tooltip(radio, format_supported_formats(library_info[ProcessingLibrary.VIPS]['formats']['output']))
 
@@ -1430,20 +6005,18 @@ class AmiFile(ctk.CTk):
         version_frame = ctk.CTkFrame(about_frame)
         version_frame.pack(fill="x", pady=5)
         
-        ctk.CTkLabel(
-            version_frame,
-            text=f"{self.loc.get('version')}: 1.2",
-            anchor="w"
+        self.localize(
+            ctk.CTkLabel(version_frame, anchor="w"),
+            lambda: f"{self.loc.get('version')}: 1.2"
         ).pack(side="left", padx=10)
         
         # GitHub link
         github_frame = ctk.CTkFrame(about_frame)
         github_frame.pack(fill="x", pady=5)
         
-        ctk.CTkLabel(
-            github_frame,
-            text=self.loc.get("github") + ":",
-            anchor="w"
+        self.localize(
+            ctk.CTkLabel(github_frame, anchor="w"),
+            lambda: self.loc.get("github") + ":"
         ).pack(side="left", padx=10)
         
         def open_github():
@@ -1517,16 +6090,17 @@ class AmiFile(ctk.CTk):
             fg_color="green",
             hover_color="#006400"
         )
-        convert_btn.pack(pady=20)
+        convert_btn.pack(pady=(20, 5))
+        self.create_job_controls(self.tab_convert, 'convert')
         
         # Progress frame with translations
         progress_frame = ctk.CTkFrame(self.tab_convert)
         progress_frame.pack(fill="x", padx=20, pady=10)
         
         # Current file progress
-        self.current_progress_label = ctk.CTkLabel(
-            progress_frame, 
-            text=f"{self.loc.get('progress_current')}0/0"
+        self.current_progress_label = self.localize(
+            ctk.CTkLabel(progress_frame),
+            lambda: f"{self.loc.get('progress_current')}0/0"
         )
         self.current_progress_label.pack(pady=2)
         
@@ -1534,16 +6108,16 @@ class AmiFile(ctk.CTk):
         self.progress_convert.pack(pady=2)
         self.progress_convert.set(0)
         
-        self.current_time_label = ctk.CTkLabel(
-            progress_frame, 
-            text=f"{self.loc.get('progress_time')}--"
+        self.current_time_label = self.localize(
+            ctk.CTkLabel(progress_frame),
+            lambda: f"{self.loc.get('progress_time')}--"
         )
         self.current_time_label.pack(pady=2)
         
         # Overall progress
-        self.total_progress_label = ctk.CTkLabel(
-            progress_frame, 
-            text=f"{self.loc.get('progress_overall')}0/0"
+        self.total_progress_label = self.localize(
+            ctk.CTkLabel(progress_frame),
+            lambda: f"{self.loc.get('progress_overall')}0/0"
         )
         self.total_progress_label.pack(pady=2)
         
@@ -1551,12 +6125,74 @@ class AmiFile(ctk.CTk):
         self.total_progress.pack(pady=2)
         self.total_progress.set(0)
         
-        self.eta_label = ctk.CTkLabel(
-            progress_frame, 
-            text=f"{self.loc.get('progress_eta')}--"
+        self.eta_label = self.localize(
+            ctk.CTkLabel(progress_frame),
+            lambda: f"{self.loc.get('progress_eta')}--"
         )
         self.eta_label.pack(pady=2)
 
+    def create_job_controls(self, parent, job):
+        """Кнопки паузы и отмены для конвертации или склейки"""
+        controls = ctk.CTkFrame(parent, fg_color="transparent")
+        controls.pack(pady=(0, 10))
+        token = self.job_tokens[job]
+        pause_btn = ctk.CTkButton(
+            controls,
+            text=self.loc.get("resume" if token is not None and token.paused else "pause"),
+            width=120
+        )
+        pause_btn.configure(command=lambda: self.toggle_pause(job))
+        pause_btn.pack(side="left", padx=5)
+        ctk.CTkButton(
+            controls,
+            text=self.loc.get("cancel"),
+            command=lambda: self.cancel_job(job),
+            fg_color="red",
+            hover_color="#8B0000",
+            width=120
+        ).pack(side="left", padx=5)
+        self.pause_buttons[job] = pause_btn
+
+    def toggle_pause(self, job):
+        """Приостанавливает выдачу новых задач или возобновляет ее"""
+        token = self.job_tokens[job]
+        if token is None:
+            return
+        if token.paused:
+            token.resume()
+        else:
+            token.pause()
+        self.pause_buttons[job].configure(text=self.loc.get("resume" if token.paused else "pause"))
+
+    def cancel_job(self, job):
+        token = self.job_tokens[job]
+        if token is not None:
+            token.cancel()
+
+    def start_job(self, job, target):
+        """Запускает задачу в фоновом потоке со своим токеном отмены"""
+        token = CancellationToken()
+        self.job_tokens[job] = token
+        self.pause_buttons[job].configure(text=self.loc.get("pause"))
+        thread = threading.Thread(target=target, args=(token,), daemon=True)
+        self.job_threads[job] = thread
+        thread.start()
+
+    def on_close(self):
+        """Закрытие окна: прерываем задачи и ждем воркеры, чтобы не оставить недописанные файлы"""
+        for token in self.job_tokens.values():
+            if token is not None:
+                token.cancel(abort=True)
+        self._close_when_idle(time.monotonic() + CLOSE_TIMEOUT)
+
+    def _close_when_idle(self, deadline):
+        # Главный поток не блокируется: воркеры еще могут обращаться к окну через after
+        busy = any(thread is not None and thread.is_alive() for thread in self.job_threads.values())
+        if busy and time.monotonic() < deadline:
+            self.after(PROGRESS_POLL_MS, lambda: self._close_when_idle(deadline))
+        else:
+            self.destroy()
+
     def setup_merge_tab(self):
         """Setup merge tab UI"""
         # File selection frame
@@ -1574,6 +6210,12 @@ class AmiFile(ctk.CTk):
             command=self.select_input_merge
         )
         browse_btn.pack(side="left", padx=10)
+        ctk.CTkButton(
+            file_frame,
+            text=self.loc.get("preview"),
+            command=self.open_thumbnail_browser,
+            width=90
+        ).pack(side="left", padx=(0, 10))
         
         # Merge direction frame
         direction_frame = ctk.CTkFrame(self.tab_merge)
@@ -1582,18 +6224,24 @@ class AmiFile(ctk.CTk):
             direction_frame,
             text=self.loc.get("merge_direction")
         ).pack(pady=5)
-        ctk.CTkRadioButton(
-            direction_frame,
-            text=self.loc.get("horizontal"),
-            variable=self.direction_var,
-            value="horizontal"
-        ).pack(pady=2)
-        ctk.CTkRadioButton(
-            direction_frame,
-            text=self.loc.get("vertical"),
-            variable=self.direction_var,
-            value="vertical"
-        ).pack(pady=2)
+        # Раскладки в одну строку, чтобы вкладка помещалась в окно
+        layouts_row = ctk.CTkFrame(direction_frame, fg_color="transparent")
+        layouts_row.pack(pady=2)
+        for layout in [MergeLayout.HORIZONTAL, MergeLayout.VERTICAL, MergeLayout.GRID, MergeLayout.CONTACT_SHEET]:
+            ctk.CTkRadioButton(
+                layouts_row,
+                text=self.loc.get(layout),
+                variable=self.direction_var,
+                value=layout
+            ).pack(side="left", padx=5, pady=2)
+        
+        # Range expression: "1-10, 11-20", "every 8", "height 20000"
+        self.range_expression_entry = ctk.CTkEntry(
+            self.tab_merge,
+            placeholder_text=self.loc.get("range_expression"),
+            width=500
+        )
+        self.range_expression_entry.pack(padx=20, pady=(10, 0))
         
         # Scrollable frame for ranges
         self.scrollable_frame = ctk.CTkScrollableFrame(self.tab_merge, height=200)
@@ -1615,7 +6263,8 @@ class AmiFile(ctk.CTk):
             fg_color="green",
             hover_color="#006400"
         )
-        merge_btn.pack(pady=20)
+        merge_btn.pack(pady=(20, 5))
+        self.create_job_controls(self.tab_merge, 'merge')
         
         # Progress bar
         self.progress_merge = ctk.CTkProgressBar(self.tab_merge, width=400)
@@ -1633,7 +6282,7 @@ class AmiFile(ctk.CTk):
         def select_files():
             files = filedialog.askopenfilenames(
                 title=self.loc.get("select_images"),
-                filetypes=[("Image Files", "*.png *.jpg *.jpeg *.bmp *.gif *.tiff *.webp *.ico *.ppm *.svg *.pdf *.eps *.psd *.heic *.avif *.jpegxl *.rla *.pcx *.pnm *.xbm *.tga *.djvu")]
+                filetypes=[("Image Files", "*.png *.jpg *.jpeg *.bmp *.gif *.tiff *.webp *.ico *.ppm *.svg *.pdf *.eps *.psd *.heic *.avif *.jpegxl *.rla *.pcx *.pnm *.xbm *.tga *.djvu"), ("Archives", "*.zip *.cbz *.tar *.cbt")]
             )
             if files:
                 path = ";".join(files)
@@ -1659,7 +6308,7 @@ class AmiFile(ctk.CTk):
         def select_files():
             files = filedialog.askopenfilenames(
                 title=self.loc.get("select_images"),
-                filetypes=[("Image Files", "*.png *.jpg *.jpeg *.bmp *.gif *.tiff *.webp *.ico *.ppm *.svg *.pdf *.eps *.psd *.heic *.avif *.jpegxl *.rla *.pcx *.pnm *.xbm *.tga *.djvu")]
+                filetypes=[("Image Files", "*.png *.jpg *.jpeg *.bmp *.gif *.tiff *.webp *.ico *.ppm *.svg *.pdf *.eps *.psd *.heic *.avif *.jpegxl *.rla *.pcx *.pnm *.xbm *.tga *.djvu"), ("Archives", "*.zip *.cbz *.tar *.cbt")]
             )
             if files:
                 path = ";".join(files)
@@ -1674,12 +6323,21 @@ class AmiFile(ctk.CTk):
             select_files
         )
 
+    def open_thumbnail_browser(self):
+        """Показывает миниатюры с номерами, по которым задаются диапазоны"""
+        input_path = self.entry_merge.get()
+        images = collect_merge_images(input_path) if input_path else []
+        if not images:
+            messagebox.showerror(self.loc.get("error"), self.loc.get("no_merge_images"))
+            return
+        ThumbnailBrowser(self, self.loc.get("merge_order"), images)
+
     def add_range(self):
         range_frame = ctk.CTkFrame(self.scrollable_frame)
         range_frame.pack(fill="x", pady=5)
-        ctk.CTkLabel(
-            range_frame,
-            text=f"{self.loc.get('image')} {len(self.range_entries) + 1}:"
+        self.localize(
+            ctk.CTkLabel(range_frame),
+            lambda number=len(self.range_entries) + 1: f"{self.loc.get('image')} {number}:"
         ).pack(side="left", padx=5)
         start_entry = ctk.CTkEntry(range_frame, width=70)
         start_entry.pack(side="left", padx=5)
@@ -1702,35 +6360,34 @@ class AmiFile(ctk.CTk):
         
         self.range_entries.append((start_entry, end_entry))
 
-    def update_progress(self, file_progress, progress_info):
-        """Обновляет информацию о прогрессе"""
-        self.after(0, lambda: self._update_progress_ui(file_progress, progress_info))
+    def watch_progress(self, progress, last=None):
+        """Опрашивает сводный прогресс из цикла Tk с частотой PROGRESS_POLL_MS, пока работа не закончится"""
+        # finished читается до снимка, чтобы последний снимок точно включал все файлы
+        finished = progress.finished
+        snap = progress.snapshot()
+        # Виджеты перерисовываются только при изменении счетчиков
+        if (snap.done, snap.total) != last:
+            self._update_progress_ui(snap)
+        if not finished:
+            self.after(PROGRESS_POLL_MS, lambda: self.watch_progress(progress, (snap.done, snap.total)))
 
-    def _update_progress_ui(self, file_progress, progress_info):
+    def _update_progress_ui(self, snap):
         """Обновляет UI прогресса в главном потоке с переводами"""
         # Обновляем прогресс текущего файла
-        self.progress_convert.set(file_progress)
-        self.current_progress_label.configure(
-            text=f"{self.loc.get('progress_current')}{progress_info.processed_files}/{progress_info.total_files}"
-        )
+        self.progress_convert.set(snap.done / snap.total if snap.total else 0)
+        self.localize(self.current_progress_label,
+                      lambda: f"{self.loc.get('progress_current')}{snap.done}/{snap.total}")
         
         # Обновляем общий прогресс
-        total_progress = progress_info.processed_files / progress_info.total_files
-        self.total_progress.set(total_progress)
-        self.total_progress_label.configure(
-            text=f"{self.loc.get('progress_overall')}{progress_info.processed_files}/{progress_info.total_files}"
-        )
+        self.total_progress.set(snap.done / snap.total if snap.total else 0)
+        self.localize(self.total_progress_label,
+                      lambda: f"{self.loc.get('progress_overall')}{snap.done}/{snap.total}")
         
         # Обновляем метки времени
-        if progress_info.avg_file_time > 0:
-            time_per_file = f"{self.loc.get('progress_time')}{progress_info.avg_file_time:.1f}s"
-            self.current_time_label.configure(text=time_per_file)
-            
-            eta = progress_info.get_eta()
-            self.eta_label.configure(text=f"{self.loc.get('progress_eta')}{eta}")
-        
-        # Обновляем UI
-        self.update_idletasks()
+        if snap.done:
+            self.localize(self.current_time_label,
+                          lambda: f"{self.loc.get('progress_time')}{snap.elapsed / snap.done:.1f}s")
+            self.localize(self.eta_label, lambda: f"{self.loc.get('progress_eta')}{format_duration(snap.eta)}")
 
     def convert_images(self):
         """Обновленная версия с поддержкой расширенного прогресса"""
@@ -1759,14 +6416,14 @@ class AmiFile(ctk.CTk):
         
         # Get image files
         if os.path.isdir(input_path):
-            images = [
-                os.path.join(input_path, f) for f in os.listdir(input_path)
-                if os.path.splitext(f.lower())[1] in valid_extensions
-            ]
+            candidates = [os.path.join(input_path, f) for f in os.listdir(input_path)]
         else:
-            images = [f for f in input_path.split(";") if os.path.splitext(f.lower())[1] in valid_extensions]
+            candidates = input_path.split(";")
+        images = [f for f in candidates if os.path.splitext(f.lower())[1] in valid_extensions]
+        # Архивы конвертируются без распаковки на диск
+        archives = [f for f in candidates if is_archive(f)]
         
-        if not images:
+        if not images and not archives:
             messagebox.showerror(self.loc.get("error"), self.loc.get("no_images"))
             self.conversion_running = False
             return
@@ -1782,38 +6439,96 @@ class AmiFile(ctk.CTk):
         images = [img for img in images 
                  if os.path.splitext(img.lower())[1][1:] in supported_input]
         
-        if not images:
+        if not images and not archives:
             messagebox.showerror(self.loc.get("error"), 
                                "No supported images found for selected processing library")
             self.conversion_running = False
             return
 
+        job_options = {
+            'profile': self.encoder_profile(),
+            'target_size': self.settings.get('target_size_kb', 0) * 1024,
+            'metadata': self.settings.get('metadata_policy', MetadataPolicy.KEEP),
+            'hardlink': self.settings.get('passthrough_hardlink', False),
+            'backend': lib,
+            'dedupe_frames': self.settings.get('dedupe_frames', True),
+            'reuse_palette': self.settings.get('reuse_palette', False)
+        }
+        if self.settings.get('quality_metric', 'off') in QUALITY_METRICS:
+            job_options['quality_metric'] = self.settings['quality_metric']
+            job_options['quality_threshold'] = self.settings.get('quality_threshold', 0.98)
+        if self.settings.get('transforms'):
+            job_options['transforms'] = parse_transforms(self.settings['transforms'])
         for input_path in images:
             output_path = os.path.join(
                 output_folder,
                 f"{os.path.splitext(os.path.basename(input_path))[0]}.{output_format}"
             )
-            conversion_args.append((input_path, output_path, output_format, needs_alpha_removal))
+            conversion_args.append((input_path, output_path, output_format, needs_alpha_removal, job_options))
 
+        # Воркеры только считают, окно само опрашивает прогресс из своего цикла
+        self.progress_convert.set(0)
+        self.total_progress.set(0)
+        progress = ProgressAggregator()
+        self.watch_progress(progress)
+        
         # Запускаем конвертацию в отдельном потоке
-        def conversion_thread():
+        def conversion_thread(token):
             try:
-                # Сбрасываем прогресс
-                self.progress_convert.set(0)
-                self.total_progress.set(0)
+                # Многостраничные документы разбиваем на задачи по страницам
+                tasks, assemblies = expand_multipage_tasks(
+                    conversion_args,
+                    page_mode=self.settings.get('page_mode', PageMode.AUTO),
+                    dpi=self.settings.get('page_dpi', 150)
+                )
+                
+                progress.add_total(len(tasks))
                 
                 # Конвертируем изображения
-                errors = batch_convert(conversion_args, self.update_progress, batch_size=10)
+                reports = []
+                stats = collections.Counter()
+                errors = batch_convert(tasks, batch_size=10, reports=reports, stats=stats,
+                                       progress=progress, token=token)
+                if token.cancelled:
+                    discard_multipage_outputs(assemblies)
+                else:
+                    errors.extend(assemble_multipage_outputs(assemblies))
                 
-                # Показываем результаты
-                self.after(0, lambda: self.show_conversion_results(errors))
+                for archive_path in archives:
+                    if token.cancelled:
+                        break
+                    errors.extend(convert_archive(
+                        archive_path,
+                        output_folder,
+                        output_format,
+                        to_archive=self.settings.get('archive_output', False),
+                        options=job_options,
+                        progress=progress,
+                        token=token
+                    ))
+                
+                # Показываем результаты (при закрытии окна показывать некому)
+                if not token.aborted:
+                    self.after(0, lambda: self.show_conversion_results(
+                        errors, reports, stats[PASSTHROUGH], cancelled=token.cancelled
+                    ))
             finally:
+                progress.finish()
+                self.job_tokens['convert'] = None
                 self.conversion_running = False
         
-        threading.Thread(target=conversion_thread, daemon=True).start()
+        self.start_job('convert', conversion_thread)
 
-    def show_conversion_results(self, errors):
+    def show_conversion_results(self, errors, reports=None, passthrough=0, cancelled=False):
         """Показывает результаты конвертации с улучшенным дизайном"""
+        # Подобранное качество по файлам (первые 20)
+        report_lines = [format_quality_report(path, report) for path, report in (reports or [])[:20]]
+        if reports and len(reports) > 20:
+            report_lines.append(f"... +{len(reports) - 20}")
+        if passthrough:
+            report_lines.insert(0, self.loc.get("passthrough_count").format(passthrough))
+        if cancelled:
+            report_lines.insert(0, self.loc.get("job_cancelled"))
         if errors:
             dialog = CustomDialog(
                 self,
@@ -1829,7 +6544,7 @@ class AmiFile(ctk.CTk):
             dialog = CustomDialog(
                 self,
                 title=self.loc.get("success"),
-                message=self.loc.get("conversion_complete"),
+                message="\n".join([self.loc.get("conversion_complete")] + report_lines),
                 button_color="green",
                 button_hover_color="#006400"
             )
@@ -1855,8 +6570,9 @@ class AmiFile(ctk.CTk):
             self.merge_running = False
             return
 
-        # Проверяем были ли добавлены диапазоны
-        if not self.range_entries:
+        images = collect_merge_images(input_path)
+        
+        if not images:
             dialog = CustomDialog(
                 self,
                 title=self.loc.get("error"),
@@ -1867,26 +6583,21 @@ class AmiFile(ctk.CTk):
             dialog.wait_window()
             self.merge_running = False
             return
-
-        # Кэшируем проверку расширений
-        valid_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff', 
-                           '.webp', '.svg', '.pdf', '.eps', '.psd', '.heic',
-                           '.avif', '.jpegxl', '.ico', '.ppm', '.rla', '.pcx',
-                           '.pnm', '.xbm', '.tga', '.djvu'}
-
-        if os.path.isdir(input_path):
-            images = sorted([
-                os.path.join(input_path, f) for f in os.listdir(input_path)
-                if os.path.splitext(f.lower())[1] in valid_extensions
-            ])
-        else:
-            images = sorted([f for f in input_path.split(";") if os.path.splitext(f.lower())[1] in valid_extensions])
         
-        if not images:
+        # Выражение и строки диапазонов проверяются целиком до начала работы
+        direction = self.direction_var.get()
+        expression = ",".join(
+            [self.range_expression_entry.get()] +
+            [f"{start_entry.get()}-{end_entry.get()}" for start_entry, end_entry in self.range_entries
+             if start_entry.get().strip() or end_entry.get().strip()]
+        )
+        try:
+            ranges = parse_range_expression(expression, images, direction)
+        except ValueError as e:
             dialog = CustomDialog(
                 self,
                 title=self.loc.get("error"),
-                message=self.loc.get("no_merge_images"),
+                message=self.loc.get("invalid_ranges").format(str(e)),
                 button_color="red",
                 button_hover_color="#8B0000"
             )
@@ -1899,105 +6610,395 @@ class AmiFile(ctk.CTk):
             self.merge_running = False
             return
         
-        def merge_thread():
+        # Параметры сетки и контактного листа
+        layout_options = {
+            'columns': self.settings.get('merge_columns', 0),
+            'tile_size': self.settings.get('merge_tile_size', 0),
+            'scale_to_fit': self.settings.get('merge_scale_to_fit', False)
+        }
+        output_format = self.merge_format_var.get()
+        jobs = plan_merge_jobs(images, ranges, output_folder, output_format)
+        
+        def merge_thread(token):
             try:
-                self.progress_merge.start()
+                self.after(0, lambda: self.progress_merge.set(0))
                 
-                for i, (start_entry, end_entry) in enumerate(self.range_entries):
-                    try:
-                        start_index = int(start_entry.get()) - 1
-                        end_index = int(end_entry.get())
-                        range_images = images[start_index:end_index]
-                        
-                        if not range_images:
-                            raise ValueError(f"No images in range {i + 1}")
-                            
-                        output_path = os.path.join(output_folder, f"{i + 1}.{self.merge_format_var.get()}")
-                        merge_images_optimized(
-                            range_images, 
-                            direction=self.direction_var.get(),
-                            output_path=output_path,
-                            output_format=self.merge_format_var.get()
-                        )
-                        
-                        # Обновляем прогресс
-                        progress = (i + 1) / len(self.range_entries)
-                        self.after(0, lambda p=progress: self.progress_merge.set(p))
-                        
-                    except Exception as e:
-                        self.after(0, lambda: CustomDialog(
-                            self,
-                            title=self.loc.get("error"),
-                            message=self.loc.get("saving_error").format(i + 1, str(e)),
-                            button_color="red",
-                            button_hover_color="#8B0000"
-                        ).wait_window())
-                        continue
+                # Все диапазоны склеиваются параллельно за один проход
+                errors = run_merge_jobs(
+                    jobs,
+                    direction,
+                    output_format,
+                    layout_options=layout_options,
+                    profile=self.encoder_profile(),
+                    token=token,
+                    on_done=lambda done, total: self.after(0, lambda: self.progress_merge.set(done / total))
+                )
                 
-                # Показываем сообщение об успешном завершении
-                self.after(0, lambda: CustomDialog(
-                    self,
-                    title=self.loc.get("success"),
-                    message=self.loc.get("merge_complete"),
-                    button_color="green",
-                    button_hover_color="#006400"
-                ).wait_window())
+                # Показываем итог (при закрытии окна показывать некому)
+                if token.aborted:
+                    return
+                if errors:
+                    self.after(0, lambda: CustomDialog(
+                        self,
+                        title=self.loc.get("error"),
+                        message="\n".join(self.loc.get("saving_error").format(number, error)
+                                          for number, error in errors),
+                        button_color="red",
+                        button_hover_color="#8B0000"
+                    ).wait_window())
+                else:
+                    self.after(0, lambda: CustomDialog(
+                        self,
+                        title=self.loc.get("success"),
+                        message=self.loc.get("job_cancelled" if token.cancelled else "merge_complete"),
+                        button_color="green",
+                        button_hover_color="#006400"
+                    ).wait_window())
                 
             finally:
+                self.job_tokens['merge'] = None
                 self.merge_running = False
-                self.after(0, lambda: self.progress_merge.stop())
-                self.after(0, lambda: self.progress_merge.set(1))
         
         # Запускаем процесс склейки в отдельном потоке
-        threading.Thread(target=merge_thread, daemon=True).start()
+        self.start_job('merge', merge_thread)
 
     def update_format_visibility(self):
         """Обновляет видимость форматов в зависимости от выбранной библиотеки"""
         lib = self.processing_lib.get()
         supported = SUPPORTED_FORMATS[lib]['output']
+        # Пирамиду DZI строит сам Ami File через PIL или pyvips, какую бы библиотеку ни выбрали
+        if HAVE_PIL or HAVE_VIPS:
+            supported = supported | PIPELINE_FORMATS
         
-        # Автоматически восстанавливаем форматы в зависимости от библиотеки
-        if lib == ProcessingLibrary.WAND:
-            # Для Wand включаем все форматы
-            self.visible_formats = [
-                "PNG", "JPEG", "GIF", "WEBP", "BMP", "TIFF", "SVG", "PDF", 
-                "EPS", "PSD", "HEIC", "AVIF", "JPEGXL", "ICO", "PPM",
-                "RLA", "PCX", "PNM", "XBM", "TGA", "DJVU"
-            ]
-        elif lib == ProcessingLibrary.VIPS:
-            # Для Pyvips включаем поддерживаемые форматы
-            self.visible_formats = [
-                fmt.upper() for fmt in SUPPORTED_FORMATS['vips']['output']
-            ]
-        elif lib == ProcessingLibrary.PIL:
-            # Для PIL включаем только поддерживаемые форматы
-            self.visible_formats = [
-                fmt.upper() for fmt in SUPPORTED_FORMATS['pil']['output']
-            ]
-        else:  # CV2
-            # Для OpenCV включаем только его форматы
-            self.visible_formats = [
-                fmt.upper() for fmt in SUPPORTED_FORMATS['cv2']['output']
-            ]
+        # Показываем только форматы, которые библиотека реально умеет писать
+        self.visible_formats = [fmt for fmt in DEFAULT_VISIBLE_FORMATS if fmt.lower() in supported]
         
         # Обновляем чекбоксы
         for fmt, var in self.format_vars.items():
-            if lib == ProcessingLibrary.WAND:
-                # Для Wand включаем все форматы
+            if fmt.lower() in supported:
                 var.set(fmt in self.visible_formats)
                 self.format_vars[fmt]._checkbox.configure(state="normal")
             else:
-                # Для других библиотек проверяем поддержку
-                if fmt.lower() in supported:
-                    var.set(True)  # Автоматически включаем поддерживаемые форматы
-                    self.format_vars[fmt]._checkbox.configure(state="normal")
-                else:
-                    var.set(False)
-                    self.format_vars[fmt]._checkbox.configure(state="disabled")
+                var.set(False)
+                self.format_vars[fmt]._checkbox.configure(state="disabled")
         
-        # Обновляем интерфейс
-        self.refresh_interface()
+        # Обновляем список форматов на вкладке конвертации
+        self.refresh_convert_tab()
 
-if __name__ == "__main__":
+def run_watch(args):
+    """Режим наблюдения за папкой из командной строки"""
+    os.makedirs(args.output, exist_ok=True)
+    options = {'profile': args.profile, 'target_size': int(args.target_kb * 1024),
+               'metadata': args.metadata, 'hardlink': args.hardlink,
+               'dedupe_frames': not args.no_dedupe, 'reuse_palette': args.reuse_palette,
+               'transforms': args.transform}
+    if args.min_ssim is not None:
+        options.update(quality_metric='ssim', quality_threshold=args.min_ssim)
+    elif args.min_psnr is not None:
+        options.update(quality_metric='psnr', quality_threshold=args.min_psnr)
+    watcher = FolderWatcher(
+        args.input,
+        args.output,
+        args.format.lower(),
+        pool=ConversionPool(args.workers),
+        settle_time=args.settle,
+        use_polling=args.poll,
+        process_existing=args.existing,
+        options=options
+    )
+    watcher.run_forever()
+    return 0
+
+def run_serve(args):
+    """HTTP-сервис конвертации из командной строки"""
+    service = ConversionService(
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        batch_size=args.batch_size,
+        bulk_cap=args.bulk_cap,
+        path_root=args.path_root
+    )
+    try:
+        asyncio.run(service.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def transform_argument(text):
+    """Тип аргумента --transform: цепочка шагов parse_transforms"""
+    try:
+        return parse_transforms(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def collect_images(inputs):
+    """Собирает изображения из списка файлов и папок"""
+    images = []
+    for path in inputs:
+        if os.path.isdir(path):
+            images.extend(sorted(
+                os.path.join(path, f) for f in os.listdir(path)
+                if os.path.splitext(f.lower())[1] in IMAGE_EXTENSIONS
+            ))
+        elif os.path.splitext(path.lower())[1] in IMAGE_EXTENSIONS:
+            images.append(path)
+    return images
+
+def run_convert(args):
+    """Пакетная конвертация из командной строки с выводом прогресса"""
+    os.makedirs(args.output, exist_ok=True)
+    output_format = args.format.lower()
+    needs_alpha_removal = output_format in ['jpg', 'jpeg', 'bmp']
+    options = {'profile': args.profile, 'metadata': args.metadata, 'transforms': args.transform}
+    conversion_args = [
+        (path, os.path.join(args.output, f"{os.path.splitext(os.path.basename(path))[0]}.{output_format}"),
+         output_format, needs_alpha_removal, options)
+        for path in collect_images(args.inputs)
+    ]
+    archives = [path for path in args.inputs if os.path.isfile(path) and is_archive(path)]
+    if not conversion_args and not archives:
+        print("No images found")
+        return 1
+    
+    tasks, assemblies = expand_multipage_tasks(conversion_args)
+    progress = ProgressAggregator(len(tasks))
+    reporter = ConsoleProgressReporter(progress).start()
+    try:
+        errors = batch_convert(tasks, batch_size=args.batch_size, progress=progress)
+        errors.extend(assemble_multipage_outputs(assemblies))
+        for archive_path in archives:
+            errors.extend(convert_archive(archive_path, args.output, output_format, options=options, progress=progress))
+    finally:
+        progress.finish()
+        reporter.stop()
+    
+    for path, error in errors:
+        print(f"Failed {path}: {error}", file=sys.stderr)
+    return 1 if errors else 0
+
+def run_coordinate(args):
+    """Раздаёт конвертацию узлам-воркерам и печатает общий прогресс"""
+    output_folder = os.path.abspath(args.output)
+    os.makedirs(output_folder, exist_ok=True)
+    output_format = args.format.lower()
+    needs_alpha_removal = output_format in ['jpg', 'jpeg', 'bmp']
+    options = {'profile': args.profile, 'metadata': args.metadata, 'transforms': args.transform}
+    # Абсолютные пути: у узлов другая текущая папка
+    conversion_args = [
+        (os.path.abspath(path),
+         os.path.join(output_folder, f"{os.path.splitext(os.path.basename(path))[0]}.{output_format}"),
+         output_format, needs_alpha_removal, options)
+        for path in collect_images(args.inputs)
+    ]
+    if not conversion_args:
+        print("No images found")
+        return 1
+    
+    tasks, assemblies = expand_multipage_tasks(conversion_args)
+    progress = ProgressAggregator(len(tasks))
+    coordinator = DistributedCoordinator(
+        tasks, host=args.host, port=args.port, secret=args.secret, lease_size=args.lease_size,
+        heartbeat_timeout=args.heartbeat_timeout, progress=progress
+    ).start()
+    print(f"Coordinator listening on http://{args.host}:{coordinator.port} ({len(tasks)} tasks)")
+    reporter = ConsoleProgressReporter(progress).start()
+    try:
+        errors = coordinator.wait()
+        errors.extend(assemble_multipage_outputs(assemblies))
+    finally:
+        progress.finish()
+        reporter.stop()
+    
+    for path, error in errors:
+        print(f"Failed {path}: {error}", file=sys.stderr)
+    return 1 if errors else 0
+
+def run_worker(args):
+    """Узел распределённой конвертации"""
+    worker = DistributedWorker(args.url, workers=args.workers, secret=args.secret, name=args.name)
+    print(f"Worker {worker.name} connected to {worker.url} with {worker.workers} processes")
+    completed = worker.run()
+    print(f"Worker {worker.name} finished {completed} tasks")
+    return 0
+
+def run_merge(args):
+    """Склейка по выражению диапазонов из командной строки"""
+    images = collect_merge_images(args.input)
+    if not images:
+        print("No images found")
+        return 1
+    try:
+        ranges = parse_range_expression(args.ranges, images, args.layout)
+    except ValueError as e:
+        print(f"Invalid ranges: {e}", file=sys.stderr)
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    output_format = args.format.lower()
+    
+    progress = ProgressAggregator(len(ranges))
+    reporter = ConsoleProgressReporter(progress).start()
+    try:
+        errors = run_merge_jobs(
+            plan_merge_jobs(images, ranges, args.output, output_format),
+            args.layout,
+            output_format,
+            layout_options={'columns': args.columns},
+            profile=args.profile,
+            max_workers=args.workers,
+            on_done=lambda done, total: progress.advance()
+        )
+    finally:
+        progress.finish()
+        reporter.stop()
+    
+    for number, error in errors:
+        print(f"Failed range {number}: {error}", file=sys.stderr)
+    return 1 if errors else 0
+
+def run_formats(args):
+    """Печатает форматы, найденные пробой установленных библиотек"""
+    for backend in BACKENDS:
+        if not backend.probe():
+            print(f"{backend.label}: not installed")
+            continue
+        source = "probed" if backend.probed is not None else "declared"
+        print(f"{backend.label} {backend.version()} ({source})")
+        print(f"  read:  {', '.join(sorted(backend.formats('input')))}")
+        print(f"  write: {', '.join(sorted(backend.formats('output')))}")
+    print(f"cache: {capability_cache_path()}")
+    return 0
+
+def run_bench(args):
+    """Сравнение профилей кодера из командной строки"""
+    images = collect_images(args.inputs)
+    if not images:
+        print("No images found")
+        return 1
+    profiles = args.profiles.split(",") if args.profiles else None
+    input_bytes, rows = benchmark_profiles(images, args.format.lower(), profiles)
+    print(format_benchmark_summary(input_bytes, rows))
+    return 0
+
+def main(argv=None):
+    # Нужно для пулов процессов в собранном exe
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(prog="ami_file", description="Ami File image converter")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    watch_parser = subparsers.add_parser("watch", help="watch a folder and convert new files")
+    watch_parser.add_argument("input", help="folder to watch")
+    watch_parser.add_argument("output", help="folder for converted files")
+    watch_parser.add_argument("--format", default="png", help="output format (default: png)")
+    watch_parser.add_argument("--workers", type=int, default=None, help="number of conversion workers")
+    watch_parser.add_argument("--settle", type=float, default=0.5,
+                              help="seconds a file must stay unchanged before conversion")
+    watch_parser.add_argument("--poll", action="store_true", help="use polling instead of file system events")
+    watch_parser.add_argument("--existing", action="store_true", help="also convert files already in the folder")
+    watch_parser.add_argument("--profile", choices=list(ENCODER_PROFILES), default=None, help="encoder profile")
+    watch_parser.add_argument("--target-kb", type=float, default=0, help="keep lossy outputs under this size")
+    watch_parser.add_argument("--metadata", choices=METADATA_POLICIES, default=MetadataPolicy.KEEP,
+                              help="metadata policy (default: keep)")
+    watch_parser.add_argument("--hardlink", action="store_true",
+                              help="hardlink files that need no conversion instead of copying them")
+    watch_parser.add_argument("--no-dedupe", action="store_true", help="keep identical animation frames")
+    watch_parser.add_argument("--reuse-palette", action="store_true", help="reuse the source GIF palette")
+    watch_parser.add_argument("--min-ssim", type=float, default=None,
+                              help="pick the lowest quality reaching this SSIM (e.g. 0.98)")
+    watch_parser.add_argument("--min-psnr", type=float, default=None,
+                              help="pick the lowest quality reaching this PSNR in dB (e.g. 40)")
+    watch_parser.add_argument("--transform", type=transform_argument, default=None,
+                              help="transforms between decode and encode, e.g. \"auto_orient; resize 1600x1600\"")
+    
+    serve_parser = subparsers.add_parser("serve", help="run a local HTTP conversion service")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="address to bind (default: 127.0.0.1)")
+    serve_parser.add_argument("--port", type=int, default=8765, help="port to listen on (default: 8765)")
+    serve_parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    serve_parser.add_argument("--queue-size", type=int, default=64, help="pending requests before 503")
+    serve_parser.add_argument("--batch-size", type=int, default=8, help="max small requests per worker call")
+    serve_parser.add_argument("--bulk-cap", type=int, default=None,
+                              help="max concurrent tasks per bulk job (default: all slots but one)")
+    serve_parser.add_argument("--path-root", default=None,
+                              help="allow path=/output= for files inside this folder (off by default)")
+    
+    coordinate_parser = subparsers.add_parser("coordinate", help="hand a conversion out to worker nodes")
+    coordinate_parser.add_argument("inputs", nargs="+", help="image files or folders on storage shared with the workers")
+    coordinate_parser.add_argument("-o", "--output", required=True, help="shared folder for converted files")
+    coordinate_parser.add_argument("--format", default="png", help="output format (default: png)")
+    coordinate_parser.add_argument("--profile", choices=list(ENCODER_PROFILES), default=None, help="encoder profile")
+    coordinate_parser.add_argument("--metadata", choices=METADATA_POLICIES, default=MetadataPolicy.KEEP,
+                                   help="metadata policy (default: keep)")
+    coordinate_parser.add_argument("--transform", type=transform_argument, default=None,
+                                   help="transforms between decode and encode, e.g. \"auto_orient; resize 1600x1600\"")
+    coordinate_parser.add_argument("--host", default="127.0.0.1", help="address to bind (default: 127.0.0.1)")
+    coordinate_parser.add_argument("--port", type=int, default=8770, help="port to listen on (default: 8770)")
+    coordinate_parser.add_argument("--secret", default=None, help="shared secret workers must send")
+    coordinate_parser.add_argument("--lease-size", type=int, default=8, help="max tasks handed out per request")
+    coordinate_parser.add_argument("--heartbeat-timeout", type=float, default=15.0,
+                                   help="seconds of silence before a worker's tasks are reassigned")
+    
+    worker_parser = subparsers.add_parser("worker", help="convert tasks handed out by a coordinator")
+    worker_parser.add_argument("url", help="coordinator address, e.g. http://10.0.0.5:8770")
+    worker_parser.add_argument("--workers", type=int, default=None, help="conversion processes on this node")
+    worker_parser.add_argument("--secret", default=None, help="shared secret of the coordinator")
+    worker_parser.add_argument("--name", default=None, help="worker name (default: host-pid)")
+    
+    convert_parser = subparsers.add_parser("convert", help="convert files, folders and archives")
+    convert_parser.add_argument("inputs", nargs="+", help="image files, folders or archives")
+    convert_parser.add_argument("-o", "--output", required=True, help="folder for converted files")
+    convert_parser.add_argument("--format", default="png", help="output format (default: png)")
+    convert_parser.add_argument("--profile", choices=list(ENCODER_PROFILES), default=None, help="encoder profile")
+    convert_parser.add_argument("--metadata", choices=METADATA_POLICIES, default=MetadataPolicy.KEEP,
+                                help="metadata policy (default: keep)")
+    convert_parser.add_argument("--transform", type=transform_argument, default=None,
+                                help="transforms between decode and encode, e.g. \"auto_orient; resize 1600x1600\"")
+    convert_parser.add_argument("--batch-size", type=int, default=10, help="files per thread pool batch")
+    
+    merge_parser = subparsers.add_parser("merge", help="merge image ranges from a folder or archive")
+    merge_parser.add_argument("input", help="folder, archive or ';'-separated files")
+    merge_parser.add_argument("-o", "--output", required=True, help="folder for merged files")
+    merge_parser.add_argument("--ranges", default="every 10",
+                              help="range expression, e.g. '1-10,11-20', 'every 8' or 'height 20000'")
+    merge_parser.add_argument("--layout", default=MergeLayout.VERTICAL,
+                              choices=[MergeLayout.HORIZONTAL, MergeLayout.VERTICAL, MergeLayout.GRID,
+                                       MergeLayout.CONTACT_SHEET], help="merge layout (default: vertical)")
+    merge_parser.add_argument("--columns", type=int, default=0, help="grid columns (0 = automatic)")
+    merge_parser.add_argument("--format", default="png", help="output format (default: png)")
+    merge_parser.add_argument("--profile", choices=list(ENCODER_PROFILES), default=None, help="encoder profile")
+    merge_parser.add_argument("--workers", type=int, default=None, help="ranges merged at the same time")
+    
+    formats_parser = subparsers.add_parser("formats", help="list the formats each installed library supports")
+    formats_parser.add_argument("--refresh", action="store_true", help="probe the libraries again, ignoring the cache")
+    
+    bench_parser = subparsers.add_parser("bench", help="compare encoder profiles on sample images")
+    bench_parser.add_argument("inputs", nargs="+", help="image files or folders")
+    bench_parser.add_argument("--format", default="webp", help="output format (default: webp)")
+    bench_parser.add_argument("--profiles", default=None, help="comma-separated profiles (default: all)")
+    
+    args = parser.parse_args(argv)
+    # Возможности библиотек: из кэша, если их версии не менялись
+    probe_capabilities(refresh=getattr(args, 'refresh', False))
+    if args.command == "formats":
+        return run_formats(args)
+    if args.command == "bench":
+        return run_bench(args)
+    if args.command == "convert":
+        return run_convert(args)
+    if args.command == "merge":
+        return run_merge(args)
+    if args.command == "watch":
+        return run_watch(args)
+    if args.command == "coordinate":
+        return run_coordinate(args)
+    if args.command == "worker":
+        return run_worker(args)
+    if args.command == "serve":
+        return run_serve(args)
+    
     app = AmiFile()
     app.mainloop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,529 @@
+import asyncio
+import collections
+import concurrent.futures
+import io
+import json
+import math
+import os
+import queue
+import random
+import threading
+import time
+import zipfile
+
+import pytest
+
+pytest.importorskip("tkinter")
+pytest.importorskip("customtkinter")
+
+import ami_file
+
+
+def test_generate_pyramid_levels_and_tiles(tmp_path):
+    PILImage = pytest.importorskip("PIL.Image")
+    source = tmp_path / "big.png"
+    PILImage.new('RGB', (600, 300), (200, 10, 10)).save(source)
+    output = tmp_path / "big.dzi"
+
+    assert ami_file.generate_pyramid(str(source), str(output), tile_size=254, overlap=1, tile_format='png')
+
+    descriptor = output.read_text(encoding='utf-8')
+    assert 'TileSize="254"' in descriptor and 'Overlap="1"' in descriptor
+    assert '<Size Width="600" Height="300"/>' in descriptor
+    tiles = tmp_path / "big_files"
+    # Уровни от 1x1 до полного размера: ceil(log2(600)) + 1
+    assert sorted(int(level) for level in os.listdir(tiles)) == list(range(11))
+    assert sorted(os.listdir(tiles / "10")) == ["0_0.png", "0_1.png", "1_0.png", "1_1.png", "2_0.png", "2_1.png"]
+    with PILImage.open(tiles / "10" / "1_0.png") as tile:
+        assert tile.size == (256, 255)
+    with PILImage.open(tiles / "0" / "0_0.png") as tile:
+        assert tile.size == (1, 1)
+
+
+def test_page_tasks_keep_only_transforms(tmp_path):
+    PILImage = pytest.importorskip("PIL.Image")
+    source = tmp_path / "doc.tiff"
+    pages = [PILImage.new('RGB', (20, 10), color) for color in ((255, 0, 0), (0, 255, 0), (0, 0, 255))]
+    pages[0].save(source, save_all=True, append_images=pages[1:])
+    options = {'profile': ami_file.EncoderProfile.SMALLEST, 'target_size': 1024,
+               'transforms': ami_file.parse_transforms("rotate 90")}
+    output = tmp_path / "out.tiff"
+
+    tasks, assemblies = ami_file.expand_multipage_tasks([(str(source), str(output), 'tiff', False, options)])
+    assert len(tasks) == 3
+    for i, task in enumerate(tasks):
+        assert task[2] == 'png'
+        assert task[4] == {'transforms': options['transforms'], 'page': i, 'dpi': 150}
+    assert assemblies[0][5] is options
+
+    for task in tasks:
+        assert ami_file.convert_image(task) is True
+    assert ami_file.assemble_multipage_outputs(assemblies) == []
+    with PILImage.open(output) as document:
+        assert document.n_frames == 3 and document.size == (10, 20)
+
+
+def test_decoded_image_cache_spills_and_reloads(tmp_path):
+    PILImage = pytest.importorskip("PIL.Image")
+    paths = []
+    for i in range(2):
+        path = tmp_path / f"{i}.png"
+        PILImage.new('RGB', (8, 8), (i * 100, 0, 0)).save(path)
+        paths.append(str(path))
+    # Бюджет на одно изображение: второе вытесняет первое на диск
+    cache = ami_file.DecodedImageCache(max_bytes=8 * 8 * 3, spill_dir=str(tmp_path / "spill"))
+    cache.get(paths[0], ami_file._load_pil_image)
+    cache.get(paths[1], ami_file._load_pil_image)
+    assert cache.current_bytes == 8 * 8 * 3 and cache.spill_bytes > 0
+
+    def fail(path):
+        raise AssertionError("decoded again")
+
+    assert cache.get(paths[0], fail).getpixel((0, 0)) == (0, 0, 0)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_row_merge_reuses_the_cache(tmp_path):
+    PILImage = pytest.importorskip("PIL.Image")
+    images = []
+    for i in range(3):
+        path = tmp_path / f"{i}.png"
+        PILImage.new('RGB', (10, 10), (0, i * 100, 0)).save(path)
+        images.append(str(path))
+    cache = ami_file.DecodedImageCache()
+    for _ in range(2):
+        ami_file.merge_images_optimized(images, ami_file.MergeLayout.HORIZONTAL, str(tmp_path / "out.png"),
+                                        'png', cache=cache, backend=ami_file.ProcessingLibrary.PIL)
+    assert (cache.hits, cache.misses) == (3, 3)
+
+
+def test_grid_layout_places_images_in_cells():
+    size, placements = ami_file.plan_merge_layout([(10, 10)] * 5, ami_file.MergeLayout.GRID, spacing=2)
+    # 5 изображений - сетка 3x2
+    assert size == (34, 22)
+    assert placements[4] == (12, 12, 10, 10)
+    # Ячейка 20x15 по средним пропорциям, изображения вписываются с сохранением пропорций
+    size, placements = ami_file.plan_merge_layout([(20, 20), (40, 20)], ami_file.MergeLayout.GRID,
+                                                  columns=2, tile_size=20)
+    assert size == (40, 15)
+    assert placements == [(2, 0, 15, 15), (20, 2, 20, 10)]
+
+
+def test_contact_sheet_rows_do_not_overlap():
+    sizes = [(40, 30), (30, 30), (60, 30), (20, 30), (50, 30), (30, 30), (45, 30)]
+    size, placements = ami_file.plan_merge_layout(sizes, ami_file.MergeLayout.CONTACT_SHEET, spacing=3)
+    for i, (x, y, w, h) in enumerate(placements):
+        assert x + w <= size[0] and y + h <= size[1]
+        for ox, oy, ow, oh in placements[i + 1:]:
+            assert x + w <= ox or ox + ow <= x or y + h <= oy or oy + oh <= y
+    # В одном ряду все изображения одной высоты
+    rows = collections.defaultdict(set)
+    for _, y, _, h in placements:
+        rows[y].add(h)
+    assert all(len(heights) == 1 for heights in rows.values())
+
+
+class RecordingPool:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, args, job='default', priority=ami_file.JobPriority.INTERACTIVE, cap=None):
+        self.submitted.append((args[0], priority))
+        future = concurrent.futures.Future()
+        future.set_result(True)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize("use_polling", [True, False])
+def test_folder_watcher_queues_existing_files_as_bulk(tmp_path, use_polling):
+    if not use_polling and not ami_file.HAVE_WATCHDOG:
+        pytest.skip("watchdog is not installed")
+    input_folder, output_folder = tmp_path / "in", tmp_path / "out"
+    input_folder.mkdir()
+    output_folder.mkdir()
+    for name in ("a.png", "b.png"):
+        (input_folder / name).write_bytes(b"old")
+
+    pool = RecordingPool()
+    watcher = ami_file.FolderWatcher(str(input_folder), str(output_folder), 'webp', pool=pool,
+                            settle_time=0, poll_interval=0.01, use_polling=use_polling,
+                            process_existing=True, log=lambda message: None)
+    watcher.start()
+    try:
+        _wait_for(lambda: len(pool.submitted) == 2)
+        (input_folder / "c.png").write_bytes(b"new")
+        _wait_for(lambda: len(pool.submitted) == 3)
+    finally:
+        watcher.stop()
+
+    priorities = {os.path.basename(path): priority for path, priority in pool.submitted}
+    assert priorities == {"a.png": ami_file.JobPriority.BULK, "b.png": ami_file.JobPriority.BULK,
+                          "c.png": ami_file.JobPriority.INTERACTIVE}
+
+
+def test_service_refuses_local_paths_by_default(tmp_path):
+    service = ami_file.ConversionService(workers=1)
+    status, _, _ = asyncio.run(service._convert({'to': 'png', 'path': __file__}, b''))
+    assert status == 403
+    status, _, _ = asyncio.run(service._convert({'to': 'png', 'output': str(tmp_path / "x.png")}, b'x'))
+    assert status == 403
+
+
+def test_service_keeps_local_paths_inside_the_root(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    service = ami_file.ConversionService(workers=1, path_root=str(root))
+    assert service._local_path(str(root / "in.png")) == os.path.realpath(root / "in.png")
+    assert service._local_path(str(root / ".." / "in.png")) is None
+    assert service._local_path(str(tmp_path / "rootless.png")) is None
+    for query in ({'path': __file__}, {'path': str(root / "in.png"), 'output': str(tmp_path / "out.png")}):
+        status, _, _ = asyncio.run(service._convert({'to': 'png', **query}, b''))
+        assert status == 403
+
+
+def test_archive_listing_skips_unsafe_names_and_converts(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    Image.new('RGB', (4, 4), 'red').save(buffer, format='PNG')
+    archive = tmp_path / "comic.cbz"
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr("b/02.png", buffer.getvalue())
+        zf.writestr("01.png", buffer.getvalue())
+        zf.writestr("../evil.png", buffer.getvalue())
+        zf.writestr("/abs.png", buffer.getvalue())
+        zf.writestr("notes.txt", b"text")
+
+    assert ami_file.list_archive_images(str(archive)) == ["01.png", "b/02.png"]
+    assert ami_file.ArchiveMember(str(archive), "01.png").read() == buffer.getvalue()
+
+    output = tmp_path / "out"
+    output.mkdir()
+    assert ami_file.convert_archive(str(archive), str(output), 'webp', max_workers=1) == []
+    assert (output / "comic" / "b" / "02.webp").exists()
+    assert ami_file.convert_archive(str(archive), str(output), 'webp', to_archive=True, max_workers=1) == []
+    with zipfile.ZipFile(output / "comic.cbz") as zf:
+        assert sorted(zf.namelist()) == ["01.webp", "b/02.webp"]
+
+
+def test_benchmark_profiles_decodes_once(tmp_path, monkeypatch):
+    PILImage = pytest.importorskip("PIL.Image")
+    if not ami_file.HAVE_CV2:
+        pytest.skip("OpenCV is needed for the fallback path")
+    source = tmp_path / "in.png"
+    PILImage.new('RGB', (32, 32), (30, 60, 90)).save(source)
+    # Без PIL файл декодирует OpenCV, и только один раз на все профили
+    monkeypatch.setattr(ami_file, 'HAVE_PIL', False)
+    backend = ami_file.get_backend(ami_file.ProcessingLibrary.CV2)
+    calls = []
+    decode = backend.decode
+    monkeypatch.setattr(backend, 'decode', lambda *args: calls.append(args) or decode(*args))
+
+    input_bytes, rows = ami_file.benchmark_profiles([str(source)], 'png')
+    assert input_bytes == source.stat().st_size
+    assert [row['profile'] for row in rows] == list(ami_file.ENCODER_PROFILES)
+    assert all(row['files'] == 1 and row['errors'] == 0 and row['bytes'] > 0 for row in rows)
+    assert len(calls) == 1
+
+
+def test_encode_to_target_size_fits_the_limit():
+    Image = pytest.importorskip("PIL.Image")
+    # Шум плохо сжимается, поэтому максимальное качество в лимит не влезает
+    image = Image.frombytes('RGB', (96, 96), random.Random(0).randbytes(96 * 96 * 3))
+    full, quality = ami_file.encode_to_target_size(image, 'jpeg', 10 ** 7)
+    assert quality == 95
+    data, quality = ami_file.encode_to_target_size(image, 'jpeg', len(full) // 2)
+    assert len(data) <= len(full) // 2 and quality < 95
+    assert Image.open(io.BytesIO(data)).format == 'JPEG'
+    # У PNG нет качества: если не влезает, подбирать нечего
+    with pytest.raises(ValueError):
+        ami_file.encode_to_target_size(image, 'png', 1024)
+
+
+def test_quality_metrics_and_target():
+    Image = pytest.importorskip("PIL.Image")
+    np = pytest.importorskip("numpy")
+    reference = np.arange(64 * 64, dtype=np.float64).reshape(64, 64) % 256
+    assert ami_file.compute_ssim(reference, reference) == pytest.approx(1.0)
+    assert ami_file.compute_psnr(reference, reference) == math.inf
+    assert ami_file.compute_ssim(reference, 255 - reference) < 0.5
+
+    image = Image.frombytes('RGB', (96, 96), random.Random(0).randbytes(96 * 96 * 3))
+    data, quality, score = ami_file.encode_to_quality_target(image, 'jpeg', 'ssim', 0.9)
+    assert score >= 0.9 and 10 <= quality <= 95
+    # Порог ниже даёт качество не выше
+    _, lower, _ = ami_file.encode_to_quality_target(image, 'jpeg', 'ssim', 0.5)
+    assert lower <= quality
+
+
+def _jpeg_with_exif(orientation=6):
+    PILImage = pytest.importorskip("PIL.Image")
+    image = PILImage.new('RGB', (16, 8), (10, 200, 10))
+    exif = PILImage.Exif()
+    exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+def test_strip_jpeg_metadata_keeps_the_image_data():
+    PILImage = pytest.importorskip("PIL.Image")
+    data = _jpeg_with_exif()
+    assert ami_file.jpeg_exif_orientation(data) == 6
+    stripped = ami_file.strip_jpeg_metadata(data)
+    assert ami_file.jpeg_exif_orientation(stripped) is None
+    assert b'Exif\0\0' not in stripped
+    # Сжатые данные копируются как есть
+    assert data[data.index(b'\xff\xda'):] == stripped[stripped.index(b'\xff\xda'):]
+    with PILImage.open(io.BytesIO(stripped)) as image:
+        assert image.size == (16, 8)
+
+
+def test_route_backends_keeps_the_chosen_library_under_keep():
+    if not (ami_file.HAVE_CV2 and ami_file.HAVE_PIL):
+        pytest.skip("OpenCV and Pillow are needed")
+    cv2_name, pil_name = ami_file.ProcessingLibrary.CV2, ami_file.ProcessingLibrary.PIL
+    names = [b.name for b in ami_file.route_backends('png', 'png', preferred=cv2_name)]
+    assert names[0] == cv2_name
+    # Без выбора OpenCV, который не пишет метаданные, идёт после Pillow
+    names = [b.name for b in ami_file.route_backends('png', 'png')]
+    assert names.index(pil_name) < names.index(cv2_name)
+
+
+def test_is_identity():
+    assert ami_file._is_identity('jpg', 'jpeg', False, {})
+    assert ami_file._is_identity('tif', 'tiff', False, {'metadata': ami_file.MetadataPolicy.KEEP})
+    assert ami_file._is_identity('jpeg', 'jpg', True, {})
+    assert not ami_file._is_identity('png', 'png', True, {})
+    assert not ami_file._is_identity('png', 'webp', False, {})
+    assert not ami_file._is_identity('png', 'png', False, {'metadata': ami_file.MetadataPolicy.STRIP})
+    profile = ami_file.EncoderProfile.SMALLEST
+    assert not ami_file._is_identity('jpeg', 'jpeg', False, {'profile': profile})
+    assert not ami_file._is_identity('jpeg', 'jpeg', False, {'quality': 80})
+    transforms = ami_file.parse_transforms("rotate 90")
+    assert not ami_file._is_identity('png', 'png', False, {'transforms': transforms})
+
+
+def _animated_gif(durations):
+    PILImage = pytest.importorskip("PIL.Image")
+    frames = [PILImage.new('RGB', (12, 12), (60 * i, 0, 0)) for i in range(len(durations))]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:], duration=durations, loop=0)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("output_format", ['gif', 'webp', 'png'])
+def test_convert_animation_keeps_frames_and_durations(output_format, monkeypatch):
+    from PIL import Image as PILImage
+    monkeypatch.setattr(ami_file, 'HAVE_VIPS', False)
+    data = _animated_gif([100, 200, 300])
+    assert ami_file.is_animated(data)
+
+    result = ami_file.convert_animation(data, None, output_format, {'dedupe_frames': False})
+    with PILImage.open(io.BytesIO(result)) as image:
+        durations = []
+        for index in range(image.n_frames):
+            image.seek(index)
+            image.load()
+            durations.append(image.info.get('duration'))
+    assert durations == [100, 200, 300]
+
+
+def test_convert_bytes_keeps_animation(monkeypatch):
+    from PIL import Image as PILImage
+    monkeypatch.setattr(ami_file, 'HAVE_VIPS', False)
+    result = ami_file.convert_bytes(_animated_gif([100, 100]), to='webp')
+    with PILImage.open(io.BytesIO(result)) as image:
+        assert image.n_frames == 2
+
+
+def test_progress_aggregator_sums_per_thread_counters():
+    progress = ami_file.ProgressAggregator(10)
+
+    def work():
+        progress.add_total(250)
+        for i in range(250):
+            progress.advance(failed=i % 50 == 0)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    snap = progress.snapshot()
+    assert (snap.total, snap.done, snap.failed) == (1010, 1000, 20)
+
+
+def test_parse_range_expression():
+    images = [f"{i}.png" for i in range(10)]
+    assert ami_file.parse_range_expression("1-3, 5; 7-", images) == [(0, 3), (4, 5), (6, 10)]
+    assert ami_file.parse_range_expression("every 4", images) == [(0, 4), (4, 8), (8, 10)]
+
+
+@pytest.mark.parametrize("expression", ["", "0", "3-2", "1-11", "every 0", "a-b"])
+def test_parse_range_expression_rejects(expression):
+    with pytest.raises(ValueError):
+        ami_file.parse_range_expression(expression, [f"{i}.png" for i in range(10)])
+
+
+def test_incomplete_backend_cannot_be_created():
+    class JpegOnly(ami_file.ImageBackend):
+        name = label = "jpeg-only"
+
+        def decode(self, source, input_format=None, page=None, dpi=None):
+            return None
+
+        def encode(self, image, output_format, target=None, needs_alpha_removal=False,
+                   profile=None, metadata="keep"):
+            return None
+
+    with pytest.raises(TypeError):
+        JpegOnly()
+    with pytest.raises(TypeError):
+        ami_file.register_backend(object())
+
+
+def test_merge_with_opencv(tmp_path):
+    if not (ami_file.HAVE_CV2 and ami_file.HAVE_PIL):
+        pytest.skip("OpenCV and Pillow are needed")
+    from PIL import Image as PILImage
+    names = [b.name for b in ami_file.route_backends(None, 'png', operation='merge')]
+    assert ami_file.ProcessingLibrary.CV2 in names
+    images = []
+    for i, color in enumerate([(255, 0, 0), (0, 0, 255)]):
+        path = tmp_path / f"{i}.png"
+        PILImage.new('RGB', (10, 20), color).save(path)
+        images.append(str(path))
+    output = tmp_path / "merged.png"
+    ami_file.merge_images_optimized(images, ami_file.MergeLayout.VERTICAL, str(output), 'png',
+                                    cache=None, backend=ami_file.ProcessingLibrary.CV2)
+    with PILImage.open(output) as merged:
+        assert merged.size == (10, 40)
+        assert merged.convert('RGB').getpixel((5, 30)) == (0, 0, 255)
+
+
+def test_probe_capabilities_caches_by_library_version(tmp_path, monkeypatch):
+    if not ami_file.HAVE_PIL:
+        pytest.skip("Pillow is needed")
+    cache_path = tmp_path / "capabilities.json"
+    formats = ami_file.probe_capabilities(str(cache_path), refresh=True)
+    assert 'png' in formats[ami_file.ProcessingLibrary.PIL]['output']
+    cached = json.loads(cache_path.read_text(encoding='utf-8'))
+    assert cached['fingerprint'][ami_file.ProcessingLibrary.PIL] == ami_file.get_backend(ami_file.ProcessingLibrary.PIL).version()
+
+    # Актуальный кэш читается без проб
+    backend = ami_file.get_backend(ami_file.ProcessingLibrary.PIL)
+    calls = []
+    monkeypatch.setattr(backend, 'probe_formats', lambda: calls.append(1) or ({'png'}, {'png'}))
+    assert ami_file.probe_capabilities(str(cache_path)) == formats
+    assert calls == []
+    # Другая версия библиотеки сбрасывает кэш
+    monkeypatch.setattr(backend, 'version', lambda: "0.0")
+    ami_file.probe_capabilities(str(cache_path))
+    assert calls == [1]
+    assert 'png' in backend.formats('output')
+    assert 'gif' not in backend.formats('output')
+    # Возвращаем настоящие возможности для остальных тестов
+    monkeypatch.undo()
+    ami_file.probe_capabilities(str(cache_path), refresh=True)
+
+
+def test_distributed_coordinator_leases_steals_and_requeues():
+    tasks = [(f"{i}.png", f"{i}.webp", 'webp', False) for i in range(4)]
+    coordinator = ami_file.DistributedCoordinator(tasks, lease_size=2)
+    assert [task_id for task_id, _ in coordinator.handle('/lease', {'worker': 'a'})['tasks']] == [0, 1]
+    assert [task_id for task_id, _ in coordinator.handle('/lease', {'worker': 'b'})['tasks']] == [2, 3]
+    coordinator.handle('/heartbeat', {'worker': 'b', 'started': [2]})
+    coordinator.handle('/complete', {'worker': 'a', 'results': [[0, None], [1, ["1.png", "boom"]]]})
+    assert coordinator.errors == [("1.png", "boom")]
+
+    # Очередь пуста: простаивающий узел забирает не начатую задачу у другого
+    assert [task_id for task_id, _ in coordinator.handle('/lease', {'worker': 'a'})['tasks']] == [3]
+    assert coordinator.handle('/heartbeat', {'worker': 'b'})['revoked'] == [3]
+
+    # Узел a замолчал - его задача возвращается в очередь
+    coordinator.workers['a'] = time.monotonic() - 100
+    coordinator.handle('/complete', {'worker': 'b', 'results': [[2, None]]})
+    assert coordinator.status()['pending'] == 1
+    assert [task_id for task_id, _ in coordinator.handle('/lease', {'worker': 'b'})['tasks']] == [3]
+    assert coordinator.handle('/complete', {'worker': 'b', 'results': [[3, None]]})['done']
+
+
+def test_distributed_convert_leaves_no_partial_files(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    source = tmp_path / "a.png"
+    Image.new('RGB', (8, 8), 'blue').save(source)
+    output = tmp_path / "out" / "a.webp"
+    assert not isinstance(ami_file._distributed_convert([str(source), str(output), 'webp', False]), list)
+    assert output.exists()
+    failed = ami_file._distributed_convert([str(tmp_path / "missing.png"), str(output.with_name("b.webp")), 'webp', False])
+    assert isinstance(failed, list)
+    assert sorted(p.name for p in output.parent.iterdir()) == ["a.webp"]
+
+
+def test_fair_scheduler_lets_interactive_jump_the_bulk_queue():
+    scheduler = ami_file.FairScheduler()
+    for i in range(10):
+        scheduler.put(f"bulk-{i}", job='bulk', priority=ami_file.JobPriority.BULK)
+    assert scheduler.get_nowait() == ('bulk', 'bulk-0')
+    scheduler.put("new", job='watch', priority=ami_file.JobPriority.INTERACTIVE)
+    assert scheduler.get_nowait() == ('watch', 'new')
+    assert len(scheduler) == 9
+
+
+def test_fair_scheduler_cap_and_queue_limit():
+    scheduler = ami_file.FairScheduler(max_queued=2)
+    assert scheduler.put(1, job='a', cap=1)
+    assert scheduler.put(2, job='a')
+    assert not scheduler.put(3, job='a')
+    assert scheduler.get_nowait() == ('a', 1)
+    # Лимит одновременных задач: вторая задача ждёт task_done
+    assert scheduler.get_nowait() is None
+    scheduler.task_done('a')
+    assert scheduler.get_nowait() == ('a', 2)
+    with pytest.raises(ValueError):
+        scheduler.put(4, job='b', cap=0)
+
+
+def test_conversion_pool_fails_rejected_tasks():
+    # Воркеров нет, поэтому вторая задача упирается в лимит очереди
+    pool = ami_file.ConversionPool(max_workers=1, scheduler=ami_file.FairScheduler(max_queued=1))
+    pool.shutdown()
+    pool.submit(("a.png", "a.webp", 'webp', False), job='bulk')
+    rejected = pool.submit(("b.png", "b.webp", 'webp', False), job='bulk')
+    with pytest.raises(queue.Full):
+        rejected.result(timeout=1)
+
+
+def test_parse_transforms_chain():
+    chain = "auto_orient; resize 1600x1600 area; crop 0,0,1200,800; rotate -90; flip H"
+    assert ami_file.parse_transforms(chain) == [
+        ('auto_orient',),
+        ('resize', 1600, 1600, 'area', False),
+        ('crop', 0, 0, 1200, 800),
+        ('rotate', 270),
+        ('flip', 'h'),
+    ]
+
+
+def test_parse_transforms_resize_forms():
+    assert ami_file.parse_transforms("resize 800") == [('resize', 800, 0, 'lanczos', False)]
+    assert ami_file.parse_transforms("resize x600 bicubic") == [('resize', 0, 600, 'bicubic', False)]
+    assert ami_file.parse_transforms("resize 800x600!") == [('resize', 800, 600, 'lanczos', True)]
+    assert ami_file.parse_transforms("") == []
+
+
+@pytest.mark.parametrize("text", ["resize", "resize 800x600 sinc", "rotate 45", "crop 0,0,0,10",
+                                  "flip d", "colorspace cmyk", "sharpen 2"])
+def test_parse_transforms_rejects(text):
+    with pytest.raises(ValueError):
+        ami_file.parse_transforms(text)